@@ -0,0 +1,349 @@
+import json
+import time
+import sqlite3
+import argparse
+import threading
+from pathlib import Path
+
+import numpy as np
+
+import rules
+import journal
+
+"""
+對戰紀錄的批次統計：把紀錄一批一批轉成欄位陣列，用 numpy 做 group-by。
+結果（處理到哪裡、還沒結束的對戰）存成快取，重跑只處理新紀錄。
+快取是 .npz（allow_pickle=False 讀）：陣列原樣存，其他欄位轉成 JSON 字串，讀快取不會執行檔案裡的任何東西。
+
+兩種來源：
+  - lobby DB 的 match_history（預設，lobby 的 player_stats 用）：雙方確認過的對戰一場一列，
+    出牌摘要是兩邊 client 在 GAME_OVER 的 status_report 各自帶上來的，主機端在哪台機器都一樣有資料。
+    依 id 遞增一次讀 HISTORY_CHUNK 列。
+  - 本機的 journal 目錄（--journal）：主機端自己記的逐回合紀錄，以 segment 為單位 memmap。
+    START 之後超過 OPEN_MAX_AGE 還沒看到 END 的對戰（斷線、程式被砍）會從 open 表丟掉。
+
+每位玩家的統計：
+  - 勝率（依第一回合的出法分組）
+  - 平均每回合出牌點數
+  - rematch 率（雙方同意再來一局的比例）
+  - 對每位對手的戰績
+"""
+
+STORAGE = Path(__file__).resolve().parent / "storage"
+DB_PATH = STORAGE / "users.db"                          # 跟 lobby2.DB_PATH 同一個檔
+CACHE_PATH = STORAGE / "analytics.npz"                  # match_history 來源的快取
+JOURNAL_CACHE_PATH = STORAGE / "analytics-journal.npz"  # journal 來源的快取
+CACHE_VERSION = 3
+CACHE_ARRAYS = ("open_ids", "open_pa", "open_pb", "open_first_a", "open_first_b", "open_ts",
+                "matches", "wins", "rematches", "rounds", "round_sum", "open_games", "open_wins")
+HANDS = rules.FULL_HAND + 1
+HISTORY_CHUNK = 100000
+OPEN_MAX_AGE = 6 * 3600.0   # 秒；開始這麼久還沒結束的對戰當作已經中斷
+
+class PlayerStats:
+    """db_path 跟 journal_dir 給一個：match_history 或本機 journal。"""
+    def __init__(self, db_path=DB_PATH, journal_dir=None, cache_path=None):
+        self.db_path = None if journal_dir else Path(db_path)
+        self.journal_dir = Path(journal_dir) if journal_dir else None
+        self.source = f"journal:{self.journal_dir}" if journal_dir else f"db:{self.db_path}"
+        self.cache_path = Path(cache_path or (JOURNAL_CACHE_PATH if journal_dir else CACHE_PATH))
+        self.lock = threading.Lock()
+        self._reset()
+        self._load_cache()
+
+    def _reset(self):
+        self.offsets = {}                    # segment 檔名 -> 已處理紀錄數（journal）
+        self.last_id = 0                     # 處理到的 match_history id（DB）
+        self.names = []                      # player index -> 名字
+        self.index = {}                      # 名字 -> player index
+        # 還沒看到 END 的對戰：match_id -> 玩家、第一回合出法
+        self.open_ids = np.zeros(0, dtype=np.uint64)
+        self.open_pa = np.zeros(0, dtype=np.int64)
+        self.open_pb = np.zeros(0, dtype=np.int64)
+        self.open_first_a = np.zeros(0, dtype=np.int64)
+        self.open_first_b = np.zeros(0, dtype=np.int64)
+        self.open_ts = np.zeros(0, dtype=np.float64)
+        # 每位玩家的累計值
+        self.matches = np.zeros(0, dtype=np.int64)
+        self.wins = np.zeros(0, dtype=np.int64)
+        self.rematches = np.zeros(0, dtype=np.int64)
+        self.rounds = np.zeros(0, dtype=np.int64)
+        self.round_sum = np.zeros(0, dtype=np.int64)
+        self.open_games = np.zeros((0, HANDS), dtype=np.int64)
+        self.open_wins = np.zeros((0, HANDS), dtype=np.int64)
+        self.h2h = {}                         # (i, j) -> [i 贏 j 的場數, 對戰場數]
+
+    # ===== 快取 =====
+    def _load_cache(self):
+        try:
+            with np.load(self.cache_path, allow_pickle=False) as z:
+                meta = json.loads(str(z["meta"]))
+                if meta.get("version") != CACHE_VERSION or meta.get("source") != self.source:
+                    return
+                arrays = {k: z[k] for k in CACHE_ARRAYS}
+                h2h = z["h2h"]
+        except (OSError, KeyError, ValueError):
+            return
+        self.__dict__.update(arrays)
+        self.offsets = meta["offsets"]
+        self.last_id = meta["last_id"]
+        self.names = meta["names"]
+        self.index = {n: i for i, n in enumerate(self.names)}
+        self.h2h = {(int(i), int(j)): [int(w), int(g)] for i, j, w, g in h2h.tolist()}
+
+    def _save_cache(self):
+        meta = {"version": CACHE_VERSION, "source": self.source,
+                "offsets": self.offsets, "last_id": self.last_id, "names": self.names}
+        h2h = np.array([(i, j, w, g) for (i, j), (w, g) in self.h2h.items()], dtype=np.int64).reshape(-1, 4)
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), h2h=h2h, **{k: getattr(self, k) for k in CACHE_ARRAYS})
+        tmp.replace(self.cache_path)
+
+    # ===== 增量處理 =====
+    def update(self) -> int:
+        """處理新紀錄，回傳這次處理的筆數。"""
+        with self.lock:
+            if self.journal_dir is None:
+                total = self._update_history()
+            else:
+                total = self._update_journal()
+            if total:
+                self._save_cache()
+            return total
+
+    def _update_history(self) -> int:
+        try:
+            # 唯讀開，DB 還不存在（lobby 沒跑過）就當沒資料，不會順手建一個空檔
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True)
+        except sqlite3.OperationalError:
+            return 0
+        total = 0
+        try:
+            while True:
+                rows = conn.execute(
+                    "SELECT id, winner, loser, COALESCE(w_first, 0), COALESCE(w_rounds, 0), COALESCE(w_sum, 0), "
+                    "COALESCE(l_first, 0), COALESCE(l_rounds, 0), COALESCE(l_sum, 0), rematch "
+                    "FROM match_history WHERE id > ? ORDER BY id LIMIT ?", (self.last_id, HISTORY_CHUNK)).fetchall()
+                if not rows:
+                    break
+                ids, winners, losers, *cols = zip(*rows)
+                self._process_history(winners, losers, np.array(cols, dtype=np.int64))
+                self.last_id = ids[-1]
+                total += len(rows)
+        except sqlite3.OperationalError:
+            pass    # 舊版 DB 還沒有 match_history
+        finally:
+            conn.close()
+        return total
+
+    def _update_journal(self) -> int:
+        total = 0
+        for path in journal.segments(self.journal_dir):
+            arr = journal.load_segment(path)
+            done = self.offsets.get(path.name, 0)
+            if len(arr) <= done:
+                continue
+            self._process(arr, done, journal.segment_names(path, arr))
+            total += len(arr) - done
+            self.offsets[path.name] = len(arr)
+        # 斷線、程式被砍的對戰永遠等不到 END，太舊的就不留在 open 表裡
+        keep = self.open_ts >= time.time() - OPEN_MAX_AGE
+        if not keep.all():
+            self._keep_open(keep)
+            total = total or 1      # open 表變了，快取也要更新
+        return total
+
+    def _keep_open(self, keep):
+        self.open_ids = self.open_ids[keep]
+        self.open_pa = self.open_pa[keep]
+        self.open_pb = self.open_pb[keep]
+        self.open_first_a = self.open_first_a[keep]
+        self.open_first_b = self.open_first_b[keep]
+        self.open_ts = self.open_ts[keep]
+
+    def _player_ids(self, names):
+        out = np.empty(len(names), dtype=np.int64)
+        for k, n in enumerate(names):
+            i = self.index.get(n)
+            if i is None:
+                i = self.index[n] = len(self.names)
+                self.names.append(n)
+            out[k] = i
+        grow = len(self.names) - len(self.matches)
+        if grow > 0:
+            pad1 = np.zeros(grow, dtype=np.int64)
+            pad2 = np.zeros((grow, HANDS), dtype=np.int64)
+            self.matches = np.concatenate([self.matches, pad1])
+            self.wins = np.concatenate([self.wins, pad1])
+            self.rematches = np.concatenate([self.rematches, pad1])
+            self.rounds = np.concatenate([self.rounds, pad1])
+            self.round_sum = np.concatenate([self.round_sum, pad1])
+            self.open_games = np.concatenate([self.open_games, pad2])
+            self.open_wins = np.concatenate([self.open_wins, pad2])
+        return out
+
+    def _lookup(self, ids):
+        """match_id 陣列 -> open 表的位置（找不到為 -1）。"""
+        if not len(self.open_ids):
+            return np.full(len(ids), -1, dtype=np.int64)
+        order = np.argsort(self.open_ids, kind="stable")
+        sorted_ids = self.open_ids[order]
+        pos = np.searchsorted(sorted_ids, ids).clip(0, len(sorted_ids) - 1)
+        return np.where(sorted_ids[pos] == ids, order[pos], -1)
+
+    def _process(self, seg, start, name_rows):
+        # name_rows 是整個 segment 的名字表（START 只存 id，名字可能在之前處理過的部分就登記了）
+        arr = seg[start:]
+        kind = arr["kind"]
+
+        # --- START：登記新對戰 ---
+        st = arr[kind == journal.KIND_START]
+        if len(st):
+            id_a = [name_rows.get(int(x), "?") for x in st["aux"]]
+            id_b = [name_rows.get(int(x), "?") for x in st["player_b"]]
+            pa = self._player_ids(id_a)
+            pb = self._player_ids(id_b)
+            self.open_ids = np.concatenate([self.open_ids, st["match_id"].astype(np.uint64)])
+            self.open_pa = np.concatenate([self.open_pa, pa])
+            self.open_pb = np.concatenate([self.open_pb, pb])
+            self.open_first_a = np.concatenate([self.open_first_a, np.zeros(len(st), np.int64)])
+            self.open_first_b = np.concatenate([self.open_first_b, np.zeros(len(st), np.int64)])
+            self.open_ts = np.concatenate([self.open_ts, st["ts"].astype(np.float64)])
+
+        # --- ROUND：點數總和、第一回合出法 ---
+        rd = arr[kind == journal.KIND_ROUND]
+        if len(rd):
+            pos = self._lookup(rd["match_id"].astype(np.uint64))
+            ok = pos >= 0
+            rd, pos = rd[ok], pos[ok]
+            pa, pb = self.open_pa[pos], self.open_pb[pos]
+            np.add.at(self.rounds, pa, 1)
+            np.add.at(self.rounds, pb, 1)
+            np.add.at(self.round_sum, pa, rd["sum_a"].astype(np.int64))
+            np.add.at(self.round_sum, pb, rd["sum_b"].astype(np.int64))
+            first = rd["round"] == 1
+            self.open_first_a[pos[first]] = rd["play_a"][first]
+            self.open_first_b[pos[first]] = rd["play_b"][first]
+
+        # --- END：勝負、開局出法勝率、rematch、對戰紀錄 ---
+        en = arr[kind == journal.KIND_END]
+        if len(en):
+            pos = self._lookup(en["match_id"].astype(np.uint64))
+            ok = pos >= 0
+            en, pos = en[ok], pos[ok]
+            b_won = ((en["flags"] & journal.FLAG_B_WON) != 0).astype(np.int64)
+            rematch = ((en["flags"] & journal.FLAG_REMATCH) != 0).astype(np.int64)
+            self._add_results(self.open_pa[pos], self.open_pb[pos], b_won,
+                              self.open_first_a[pos], self.open_first_b[pos], rematch)
+            # 結束的對戰移出 open 表
+            keep = np.ones(len(self.open_ids), dtype=bool)
+            keep[pos] = False
+            self._keep_open(keep)
+
+    def _process_history(self, winners, losers, cols):
+        """match_history 的一批（cols 的列：w_first w_rounds w_sum l_first l_rounds l_sum rematch）。"""
+        w_first, w_rounds, w_sum, l_first, l_rounds, l_sum, rematch = cols
+        pw = self._player_ids(winners)
+        pl = self._player_ids(losers)
+        np.add.at(self.rounds, pw, w_rounds)
+        np.add.at(self.rounds, pl, l_rounds)
+        np.add.at(self.round_sum, pw, w_sum)
+        np.add.at(self.round_sum, pl, l_sum)
+        # 贏家當 A：b_won 全部是 0
+        self._add_results(pw, pl, np.zeros(len(pw), dtype=np.int64), w_first, l_first, rematch)
+
+    def _add_results(self, pa, pb, b_won, fa, fb, rematch):
+        """一批結束的對戰：勝負、開局出法勝率、rematch、對戰紀錄（b_won / rematch 是 0/1 陣列）。"""
+        a_won = 1 - b_won
+        np.add.at(self.matches, pa, 1)
+        np.add.at(self.matches, pb, 1)
+        np.add.at(self.wins, pa, a_won)
+        np.add.at(self.wins, pb, b_won)
+        np.add.at(self.rematches, pa, rematch)
+        np.add.at(self.rematches, pb, rematch)
+        np.add.at(self.open_games, (pa, fa), 1)
+        np.add.at(self.open_games, (pb, fb), 1)
+        np.add.at(self.open_wins, (pa, fa), a_won)
+        np.add.at(self.open_wins, (pb, fb), b_won)
+        # 對戰紀錄：以 (贏家, 輸家) 配對 group-by，再併進 dict
+        winner = np.where(b_won == 1, pb, pa)
+        loser = np.where(b_won == 1, pa, pb)
+        n = max(len(self.names), 1)
+        keys, counts = np.unique(winner * n + loser, return_counts=True)
+        for key, c in zip(keys.tolist(), counts.tolist()):
+            w, l = divmod(key, n)
+            rec = self.h2h.setdefault((w, l), [0, 0])
+            rec[0] += c
+            rec[1] += c
+            rev = self.h2h.setdefault((l, w), [0, 0])
+            rev[1] += c
+
+    # ===== 查詢 =====
+    def player(self, name: str):
+        with self.lock:
+            i = self.index.get(name)
+            if i is None:
+                return None
+            m = int(self.matches[i])
+            openings = {}
+            for play in np.nonzero(self.open_games[i])[0].tolist():
+                if play == 0:
+                    continue    # 沒有第一回合紀錄
+                g = int(self.open_games[i, play])
+                openings["+".join(map(str, rules.mask_to_cards(play)))] = {
+                    "games": g, "win_rate": round(int(self.open_wins[i, play]) / g, 4)}
+            h2h = {}
+            for (a, b), (w, g) in self.h2h.items():
+                if a == i:
+                    h2h[self.names[b]] = {"wins": w, "losses": g - w}
+            return {
+                "player": name,
+                "matches": m,
+                "wins": int(self.wins[i]),
+                "win_rate": round(int(self.wins[i]) / m, 4) if m else None,
+                "avg_round_sum": round(int(self.round_sum[i]) / int(self.rounds[i]), 3) if self.rounds[i] else None,
+                "rematch_rate": round(int(self.rematches[i]) / m, 4) if m else None,
+                "by_opening": openings,
+                "head_to_head": h2h,
+            }
+
+_engine = None
+_engine_lock = threading.Lock()
+_last_update = 0.0
+MIN_REFRESH = 5.0   # 秒；lobby 查詢時最多這麼久掃一次新紀錄
+
+def get_player_stats(name: str, db_path=DB_PATH):
+    """lobby 的 player_stats action 用：共用一個 match_history 引擎，必要時先增量更新。"""
+    global _engine, _last_update
+    with _engine_lock:
+        if _engine is None:
+            _engine = PlayerStats(db_path)
+        if time.time() - _last_update >= MIN_REFRESH:
+            _engine.update()
+            _last_update = time.time()
+    return _engine.player(name)
+
+def main():
+    ap = argparse.ArgumentParser(description="Per-player statistics from the lobby match history or a local journal")
+    ap.add_argument("players", nargs="*")
+    ap.add_argument("--db", default=str(DB_PATH), help="lobby database (match_history)")
+    ap.add_argument("--journal", nargs="?", const=str(journal.JOURNAL_DIR), default=None, metavar="DIR",
+                    help="read a local match journal instead of the lobby database")
+    ap.add_argument("--cache", default=None)
+    ap.add_argument("--rebuild", action="store_true", help="ignore the cache")
+    args = ap.parse_args()
+
+    eng = PlayerStats(args.db, args.journal, args.cache)
+    if args.rebuild:
+        eng.cache_path.unlink(missing_ok=True)
+        eng._reset()
+    t0 = time.perf_counter()
+    n = eng.update()
+    print(f"processed {n} new records in {time.perf_counter() - t0:.2f}s; {len(eng.names)} players")
+    for name in args.players or eng.names:
+        print(eng.player(name))
+
+if __name__ == "__main__":
+    main()
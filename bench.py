@@ -0,0 +1,570 @@
+import asyncio
+import json
+import os
+import random
+import socket
+import selectors
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import argparse
+from multiprocessing import Pool, Process, Pipe
+
+import presence
+import roomhost
+import rules
+from tt import pls
+
+"""
+效能量測腳本。
+  python bench.py rooms --rooms 10 100 1000
+  python bench.py hand
+  python bench.py lobby --workers 1 2 4 --procs 4 --conns 50
+  python bench.py sessions --threads 8 64
+  python bench.py idle --clients 1000 10000 50000 --budget-kb 8
+  python bench.py micro --save / python bench.py compare
+"""
+
+# ===== 多房間主機 =====
+async def _bot_player(port, room_id, name, rng, lat):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    await roomhost.send_line(writer, {"type": "HELLO", "room": room_id, "name": name})
+    hand = list(range(1, 8))
+    sent = 0.0
+    try:
+        while True:
+            msg = await roomhost.recv_line(reader)
+            t = msg.get("type")
+            if t == "MOVE":
+                k = 1 if len(hand) == 1 else rng.choice((1, 2))
+                pick = rng.sample(hand, k)
+                sent = time.perf_counter()
+                await roomhost.send_line(writer, {"type": "MOVE", "cards": pick})
+                for c in pick:
+                    hand.remove(c)
+            elif t == "ROUND_RESULT":
+                lat.append(time.perf_counter() - sent)
+            elif t in ("GAME_OVER", "DISCONNECT"):
+                break
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def _run_rooms(n_rooms, seed):
+    server = await roomhost.RoomServer("127.0.0.1", 0).start()
+    rng = random.Random(seed)
+    lat = []
+    t0 = time.perf_counter()
+    await asyncio.gather(*(
+        _bot_player(server.port, f"r{i}", f"p{i}{side}", random.Random(rng.random()), lat)
+        for i in range(n_rooms) for side in "ab"
+    ))
+    elapsed = time.perf_counter() - t0
+    server.close()
+    return elapsed, lat
+
+def bench_rooms(sizes, seed=0):
+    print(f"{'rooms':>7} {'secs':>8} {'rounds/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for n in sizes:
+        elapsed, lat = asyncio.run(_run_rooms(n, seed))
+        lat.sort()
+        rounds = len(lat) / 2  # 每回合兩位玩家各記一次
+        p50 = lat[len(lat) // 2] * 1e3 if lat else 0.0
+        p99 = lat[int(len(lat) * 0.99)] * 1e3 if lat else 0.0
+        print(f"{n:>7} {elapsed:>8.2f} {rounds / elapsed:>10.0f} {p50:>8.2f} {p99:>8.2f}")
+
+# ===== 手牌表示法：bitmask pls vs 舊的 list 版本 =====
+class _ListHand:
+    """改成 bitmask 之前的 pls（只留量測需要的部分）。"""
+    def __init__(self):
+        self.winRound = 0
+        self.cards = [i for i in range(1,8)]
+    def use_cards(self, cards_to_use):
+        for card in cards_to_use:
+            if card not in self.cards:
+                return "error"
+        for card in cards_to_use:
+            self.cards.remove(card)
+        return sum(cards_to_use)
+    def plays(self):
+        cs = self.cards
+        return [[a] for a in cs] + [[a, b] for i, a in enumerate(cs) for b in cs[i+1:]]
+
+def bench_hand(number=200000):
+    lh, bh = _ListHand(), pls()
+    play = rules.cards_to_mask([3, 5])
+
+    def _use_list():
+        h = _ListHand(); h.use_cards([1, 2]); h.use_cards([7])
+
+    def _use_bit():
+        h = pls(); h.use_cards([1, 2]); h.use_cards([7])
+
+    cases = [
+        ("new + use 1,2 + use 7", _use_list, _use_bit),
+        ("legal? play [3,5]", lambda: all(c in lh.cards for c in (3, 5)), lambda: play & bh.mask == play),
+        ("enumerate plays (full hand)", lh.plays, bh.plays),
+    ]
+    print(f"{'case':<30} {'list us':>9} {'bitmask us':>11} {'speedup':>8}")
+    for name, list_fn, bit_fn in cases:
+        t_list = timeit.timeit(list_fn, number=number)
+        t_bit = timeit.timeit(bit_fn, number=number)
+        print(f"{name:<30} {t_list / number * 1e6:>9.3f} {t_bit / number * 1e6:>11.3f} {t_list / t_bit:>7.1f}x")
+
+# ===== lobby 吞吐量：1..N 個 SO_REUSEPORT worker =====
+def _lobby_client(job):
+    """一個壓測 process：conns 條連線各自一問一答（closed loop），跑 duration 秒。"""
+    port, conns, duration, idx, action = job
+    sel = selectors.DefaultSelector()
+    # 帶 username 的請求都會走一次 refresh_active（多 worker 時就是共享上線表）
+    req = json.dumps({"action": action, "username": f"bench{idx}", "target": f"bench{idx}"}).encode()
+    sent_at = {}
+    for _ in range(conns):
+        s = socket.create_connection(("127.0.0.1", port))
+        s.setblocking(False)
+        sel.register(s, selectors.EVENT_READ)
+        s.send(req)
+        sent_at[s] = time.perf_counter()
+    lat = []
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        for key, _ in sel.select(timeout=0.5):
+            s = key.fileobj
+            try:
+                data = s.recv(4096)
+            except BlockingIOError:
+                continue
+            if not data:
+                sel.unregister(s)
+                continue
+            now = time.perf_counter()
+            lat.append(now - sent_at[s])
+            s.send(req)
+            sent_at[s] = now
+    for s in sent_at:
+        s.close()
+    return lat
+
+def _wait_port(port, timeout=10.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+def bench_lobby(worker_counts, procs=4, conns=50, duration=5.0, port=16500, action="noop"):
+    """
+    每個 worker 數各起一個 lobby2（--workers N），再用 procs 個 process 打請求。
+    預設的 noop 是不存在的 action（收 -> 解析 -> refresh_active -> 回 ERROR_UNKNOWN_ACTION），
+    量的是請求處理本身；--action rating 會多一次 DB 查詢。
+    壓測端與 server 在同一台機器上，核心數要夠多才看得出線性成長。
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f"cpus={os.cpu_count()} procs={procs} conns/proc={conns} duration={duration}s action={action}")
+    print(f"{'workers':>7} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for n in worker_counts:
+        srv = subprocess.Popen([sys.executable, os.path.join(here, "lobby2.py"), "--host", "127.0.0.1",
+                                "--port", str(port), "--workers", str(n)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not _wait_port(port):
+                print(f"{n:>7} lobby did not start")
+                continue
+            with Pool(procs) as pool:
+                parts = pool.map(_lobby_client, [(port, conns, duration, i, action) for i in range(procs)])
+            lat = sorted(x for p in parts for x in p)
+            p50 = lat[len(lat) // 2] * 1e3 if lat else 0.0
+            p99 = lat[int(len(lat) * 0.99)] * 1e3 if lat else 0.0
+            print(f"{n:>7} {len(lat) / duration:>10.0f} {p50:>8.2f} {p99:>8.2f}")
+        finally:
+            srv.terminate()
+            srv.wait()
+
+# ===== 上線表：單一 sessions_lock vs 分 shard 的 SessionRegistry =====
+class _GlobalLockSessions:
+    """改成 SessionRegistry 之前 lobby2 的寫法（一個 dict、一把鎖）。"""
+    def __init__(self):
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.acquired = self.contended = 0
+
+    def _acquire(self):
+        if not self.lock.acquire(blocking=False):
+            self.lock.acquire()
+            self.contended += 1
+        self.acquired += 1
+
+    def set(self, name, owner):
+        self._acquire()
+        try:
+            self.sessions[name] = {"conn": owner, "last_seen": time.time()}
+        finally:
+            self.lock.release()
+
+    def refresh(self, name):
+        self._acquire()
+        try:
+            sess = self.sessions.get(name)
+            if sess:
+                sess["last_seen"] = time.time()
+        finally:
+            self.lock.release()
+
+    def expired(self, ttl):
+        now = time.time()
+        with self.lock:
+            return [n for n, s in self.sessions.items() if now - s["last_seen"] > ttl]
+
+def _heartbeat_burst(reg, n_threads, users, beats):
+    """n_threads 條執行緒同時對各自的一批使用者狂打 refresh，另一條不停做 cleanup 掃描。"""
+    for u in range(users):
+        reg.set(f"u{u}", None)
+    stop = {"stop": False}
+
+    def _scan():
+        while not stop["stop"]:
+            reg.expired(15)
+            time.sleep(0.001)
+
+    def _beat(k):
+        names = [f"u{u}" for u in range(k, users, n_threads)]
+        for _ in range(beats):
+            for n in names:
+                reg.refresh(n)
+
+    scanner = threading.Thread(target=_scan)
+    threads = [threading.Thread(target=_beat, args=(k,)) for k in range(n_threads)]
+    scanner.start()
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    dt = time.perf_counter() - t0
+    stop["stop"] = True
+    scanner.join()
+    return users * beats / dt
+
+def bench_sessions(thread_counts, users=5000, beats=20):
+    print(f"{'threads':>7} {'impl':<10} {'refresh/s':>10} {'acquired':>10} {'contended':>10}")
+    for n in thread_counts:
+        for name, reg in (("global", _GlobalLockSessions()), ("sharded", presence.SessionRegistry())):
+            rate = _heartbeat_burst(reg, n, users, beats)
+            acq = reg.acquired if name == "global" else sum(reg.acquired)
+            con = reg.contended if name == "global" else sum(reg.contended)
+            print(f"{n:>7} {name:<10} {rate:>10.0f} {acq:>10} {con:>10}")
+
+# ===== 閒置連線的記憶體：RSS / 連線 =====
+def _proc_status(pid):
+    out = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            k, _, v = line.partition(":")
+            out[k] = v.split()[0] if v.split() else ""
+    return out
+
+def _idle_holder(port, n, pipe):
+    """開 n 條閒置連線，回報開成功幾條，等 pipe 說可以了再全部關掉。"""
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    socks = []
+    try:
+        for _ in range(n):
+            socks.append(socket.create_connection(("127.0.0.1", port), timeout=5.0))
+    except OSError:
+        pass
+    pipe.send(len(socks))
+    pipe.recv()
+    for s in socks:
+        s.close()
+
+def bench_idle(client_counts, budget_kb=8.0, low_mem=True, port=16600, per_proc=15000):
+    """
+    起一個 lobby2，量 N 條閒置連線（連上但不送東西）之後多出來的 RSS，換算成每條連線的 KB。
+    超過 budget_kb 就回傳 False。N 受限於開檔上限與 threads-max，開不到 N 會照實際數字算。
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    cmd = [sys.executable, os.path.join(here, "lobby2.py"), "--host", "127.0.0.1", "--port", str(port)]
+    if low_mem:
+        cmd.append("--low-mem")
+    print(f"low_mem={low_mem} budget={budget_kb:.0f}KB/conn")
+    print(f"{'clients':>8} {'accepted':>9} {'threads':>8} {'base MB':>8} {'RSS MB':>8} {'KB/conn':>8} {'':>6}")
+    ok = True
+    for n in client_counts:
+        srv = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        holders = []
+        try:
+            if not _wait_port(port):
+                print(f"{n:>8} lobby did not start")
+                ok = False
+                continue
+            time.sleep(0.5)
+            base = int(_proc_status(srv.pid)["VmRSS"])
+            base_threads = int(_proc_status(srv.pid)["Threads"])
+            base_fds = len(os.listdir(f"/proc/{srv.pid}/fd"))
+            for k in range(0, n, per_proc):
+                a, b = Pipe()
+                p = Process(target=_idle_holder, args=(port, min(per_proc, n - k), b))
+                p.start()
+                holders.append((p, a))
+            connected = sum(a.recv() for _, a in holders)
+            # 等 server 把連線都收完（看它開著的 fd 數）
+            deadline = time.time() + 30
+            while time.time() < deadline:
+                if len(os.listdir(f"/proc/{srv.pid}/fd")) - base_fds >= connected:
+                    break
+                time.sleep(0.2)
+            accepted = len(os.listdir(f"/proc/{srv.pid}/fd")) - base_fds
+            st = _proc_status(srv.pid)
+            rss = int(st["VmRSS"])
+            per = (rss - base) / accepted if accepted > 0 else 0.0
+            verdict = "ok" if per <= budget_kb else "OVER"
+            ok = ok and per <= budget_kb
+            print(f"{n:>8} {accepted:>9} {int(st['Threads']) - base_threads:>8} {base / 1024:>8.1f} "
+                  f"{rss / 1024:>8.1f} {per:>8.1f} {verdict:>6}")
+        finally:
+            for p, a in holders:
+                try:
+                    a.send("done")
+                except OSError:
+                    pass
+                p.join(timeout=10)
+            srv.terminate()
+            srv.wait()
+            time.sleep(0.5)
+    return ok
+
+# ===== 熱點 micro-benchmark + baseline 比對 =====
+# 每個 case 回傳 (次數, 秒數)，跑 repeat 次取最快的一次，單位一律是 ops/s（越大越好）。
+#   python bench.py micro                     # 跑全部，印表
+#   python bench.py micro --save              # 存成 baseline（預設 bench_baseline.json，跟著 repo 一起 commit）
+#   python bench.py compare --tolerance 0.2   # 再跑一次跟 baseline 比，有 case 慢超過 20% 就 exit 1
+# DB 相關的 case 用暫存目錄裡的新 DB，不會動到 storage/users.db。
+# baseline 放在 repo 根目錄而不是 storage/（那裡整個被 .gitignore 掉）；換機器比之前先在那台 --save 一次
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+MICRO = {}
+
+def micro(name):
+    def deco(fn):
+        MICRO[name] = fn
+        return fn
+    return deco
+
+@micro("json_line_socketpair")
+def _micro_json_lines(n=20000, threads=None):
+    from tt import send_json_line, recv_json_line
+    a, b = socket.socketpair()
+    msg = {"type": "MOVE", "cards": [3, 5]}
+
+    def _send():
+        for _ in range(n):
+            send_json_line(a, msg)
+
+    t = threading.Thread(target=_send)
+    t0 = time.perf_counter()
+    t.start()
+    buf = b""
+    for _ in range(n):
+        _, buf = recv_json_line(b, buf)
+    dt = time.perf_counter() - t0
+    t.join()
+    a.close()
+    b.close()
+    return n, dt
+
+@micro("pls_use_cards")
+def _micro_use_cards(n=200000, threads=None):
+    def _one():
+        h = pls()
+        h.use_cards([1, 2])
+        h.use_cards([7])
+    return n, timeit.timeit(_one, number=n)
+
+class _NullConn:
+    def sendall(self, data):
+        pass
+
+class _QuietUI:
+    def __getattr__(self, name):
+        return lambda *a, **k: None
+
+@micro("host_round_result")
+def _micro_host_round(n=50000, threads=None):
+    from client import HostGame
+    g = HostGame(_NullConn(), "peer", None, "alice", "bob", ui=_QuietUI())
+    g.target_wins = 1 << 30
+
+    def _one():
+        g.playr1.winRound = g.playr2.winRound = 0
+        g._handle_round_result(5, 3, [2, 3], [3])
+    return n, timeit.timeit(_one, number=n)
+
+def _micro_db_setup():
+    """lobby2 改用暫存 DB，建好 schema 與 users 行；回傳 lobby2 模組。"""
+    import tempfile
+    from pathlib import Path
+    import lobby2
+    if not getattr(lobby2, "_bench_db", None):
+        lobby2._bench_db = tempfile.mkdtemp(prefix="ttbench-")
+        lobby2.DB_PATH = Path(lobby2._bench_db) / "users.db"
+        lobby2.ensure_schema()
+        for u in range(64):
+            lobby2.get_status(f"bench{u}")
+    return lobby2
+
+def _micro_threads(fn, n, threads):
+    """threads 條執行緒一起跑，總共 n 次 fn(i)。"""
+    per = max(n // threads, 1)
+
+    def _run(k):
+        for i in range(per):
+            fn(k * per + i)
+
+    ts = [threading.Thread(target=_run, args=(k,)) for k in range(threads)]
+    t0 = time.perf_counter()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return per * threads, time.perf_counter() - t0
+
+@micro("db_update_status")
+def _micro_db_update(n=2000, threads=8):
+    lobby2 = _micro_db_setup()
+    return _micro_threads(lambda i: lobby2.update_status(f"bench{i % 64}", {"wins": 1}), n, threads)
+
+@micro("db_get_status")
+def _micro_db_get(n=5000, threads=8):
+    lobby2 = _micro_db_setup()
+    return _micro_threads(lambda i: lobby2.get_status(f"bench{i % 64}"), n, threads)
+
+@micro("db_login_count")
+def _micro_db_login(n=2000, threads=8):
+    lobby2 = _micro_db_setup()
+    return _micro_threads(lambda i: lobby2.inc_login_count_and_online(f"bench{i % 64}"), n, threads)
+
+@micro("bcrypt_hashpw")
+def _micro_bcrypt(n=3, threads=None):
+    import bcrypt
+    # 跟 register 一樣用預設 cost；login 的 checkpw 成本相同
+    t0 = time.perf_counter()
+    for _ in range(n):
+        bcrypt.hashpw(b"password", bcrypt.gensalt())
+    return n, time.perf_counter() - t0
+
+@micro("sessions_refresh")
+def _micro_sessions(n=200000, threads=8):
+    import lobby2
+    for u in range(5000):
+        lobby2.set_active(f"u{u}", None)
+
+    def _one(i):
+        name = f"u{i % 5000}"
+        lobby2.refresh_active(name)
+        lobby2.is_active(name)
+    return _micro_threads(_one, n, threads)
+
+def run_micro(names=None, repeat=5, threads=8):
+    results = {}
+    print(f"{'case':<24} {'ops/s':>12} {'us/op':>10}")
+    for name, fn in MICRO.items():
+        if names and name not in names:
+            continue
+        best = 0.0
+        for _ in range(repeat):
+            ops, dt = fn(threads=threads)
+            best = max(best, ops / dt)
+        results[name] = best
+        print(f"{name:<24} {best:>12.1f} {1e6 / best:>10.2f}")
+    return results
+
+def save_baseline(results, path=BASELINE_PATH):
+    import platform
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    print(f"baseline saved to {path}")
+
+def compare_baseline(results, path=BASELINE_PATH, tolerance=0.2) -> bool:
+    """比 baseline 慢超過 tolerance 的 case 算退步；回傳是否全部通過。"""
+    with open(path, encoding="utf-8") as f:
+        base = json.load(f)
+    print(f"\nbaseline {path} ({base.get('created')}, python {base.get('python')}, cpus {base.get('cpus')})")
+    print(f"{'case':<24} {'baseline':>12} {'now':>12} {'change':>8}")
+    ok = True
+    for name, now in results.items():
+        old = base["results"].get(name)
+        if not old:
+            print(f"{name:<24} {'-':>12} {now:>12.0f} {'new':>8}")
+            continue
+        change = now / old - 1.0
+        mark = ""
+        if change < -tolerance:
+            mark = "  REGRESSION"
+            ok = False
+        print(f"{name:<24} {old:>12.1f} {now:>12.1f} {change:>+7.1%}{mark}")
+    return ok
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmarks")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("rooms", help="concurrent rooms on one roomhost process (bots run in the same loop)")
+    p.add_argument("--rooms", type=int, nargs="+", default=[10, 100, 1000])
+    sub.add_parser("hand", help="bitmask pls vs list hand micro-benchmark")
+    p = sub.add_parser("lobby", help="lobby2 request throughput vs number of SO_REUSEPORT workers")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--procs", type=int, default=4, help="load generator processes")
+    p.add_argument("--conns", type=int, default=50, help="connections per load generator process")
+    p.add_argument("--duration", type=float, default=5.0)
+    p.add_argument("--port", type=int, default=16500)
+    p.add_argument("--action", default="noop", help="lobby action to send (noop = unknown action)")
+    p = sub.add_parser("sessions", help="heartbeat burst: one global lock vs the sharded SessionRegistry")
+    p.add_argument("--threads", type=int, nargs="+", default=[1, 8, 64])
+    p.add_argument("--users", type=int, default=5000)
+    p = sub.add_parser("idle", help="lobby2 RSS per idle connection; exits 1 if over --budget-kb")
+    p.add_argument("--clients", type=int, nargs="+", default=[1000, 10000, 50000])
+    p.add_argument("--budget-kb", type=float, default=8.0)
+    p.add_argument("--no-low-mem", action="store_true", help="measure the default mode instead")
+    p.add_argument("--port", type=int, default=16600)
+    for cmd, desc in (("micro", "hot-path micro-benchmarks (protocol, game, DB, bcrypt, sessions)"),
+                      ("compare", "run the micro-benchmarks and compare with a saved baseline")):
+        p = sub.add_parser(cmd, help=desc)
+        p.add_argument("--only", nargs="+", choices=list(MICRO), help="run just these cases")
+        p.add_argument("--repeat", type=int, default=5, help="runs per case, the fastest one counts")
+        p.add_argument("--threads", type=int, default=8, help="threads for the DB and session cases")
+        p.add_argument("--baseline", default=BASELINE_PATH)
+    p.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before failing (0.2 = 20%%)")
+    sub.choices["micro"].add_argument("--save", action="store_true", help="store the results as the baseline")
+    args = ap.parse_args()
+
+    if args.cmd == "rooms":
+        bench_rooms(args.rooms)
+    elif args.cmd == "hand":
+        bench_hand()
+    elif args.cmd == "lobby":
+        bench_lobby(args.workers, args.procs, args.conns, args.duration, args.port, args.action)
+    elif args.cmd == "sessions":
+        bench_sessions(args.threads, args.users)
+    elif args.cmd == "idle":
+        if not bench_idle(args.clients, args.budget_kb, not args.no_low_mem, args.port):
+            sys.exit(1)
+    elif args.cmd == "micro":
+        results = run_micro(args.only, args.repeat, args.threads)
+        if args.save:
+            save_baseline(results, args.baseline)
+    elif args.cmd == "compare":
+        results = run_micro(args.only, args.repeat, args.threads)
+        if not compare_baseline(results, args.baseline, args.tolerance):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+import socket
+import json
+import time
+import queue
+import random
+import threading
+import argparse
+import contextlib
+import os
+import sys
+
+import rules
+import client
+import tracing
+import recv
+from journal import MatchJournal
+from tt import GameUI, TurnTimeout, send_json_line
+
+"""
+無頭 bot：guest 端（回 SEARCH、自動接受 INVITE、打 client_game）與 host 端（掃描、邀請、跑 HostGame），
+出牌由可抽換的策略決定，可設定思考時間與 rematch 機率。一個 process 可以跑很多隻，用來做壓測。
+
+  python bots.py guests --count 100 --base-port 20000
+  python bots.py hosts  --count 100 --targets 127.0.0.1:20000-20099
+  python bots.py selftest --pairs 50 --duration 30
+"""
+
+def make_policy(name, side="A", target_wins=3):
+    """rules.STRATEGIES 的名字，或 "solver"（查表均衡策略）。"""
+    if name == "solver":
+        import solver
+        return solver.get_table(target_wins).policy(side)
+    return rules.STRATEGIES[name]
+
+class BotStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.matches = 0
+        self.rounds = 0
+        self.forfeits = 0
+        self.round_lat = []     # 送出自己的牌 -> 看到回合結果（秒）
+        self.match_dur = []
+
+    def add_round(self, lat):
+        with self.lock:
+            self.rounds += 1
+            self.round_lat.append(lat)
+
+    def add_match(self, dur):
+        with self.lock:
+            self.matches += 1
+            self.match_dur.append(dur)
+
+    def add_forfeit(self):
+        with self.lock:
+            self.forfeits += 1
+
+    def report(self, elapsed):
+        with self.lock:
+            lat = sorted(self.round_lat)
+            dur = sorted(self.match_dur)
+            matches, rounds, forfeits = self.matches, self.rounds, self.forfeits
+
+        def pct(xs, q):
+            return xs[min(len(xs) - 1, int(len(xs) * q))] * 1e3 if xs else 0.0
+        return (f"matches={matches} ({matches / elapsed:.1f}/s) forfeits={forfeits} rounds={rounds} ({rounds / elapsed:.1f}/s) "
+                f"round p50={pct(lat, .5):.1f}ms p99={pct(lat, .99):.1f}ms "
+                f"match p50={pct(dur, .5):.0f}ms p99={pct(dur, .99):.0f}ms")
+
+class BotUI(GameUI):
+    """不印東西、不讀鍵盤的 GameUI：記住雙方手牌與比分，get_player_move 交給策略。"""
+    def __init__(self, policy, think=(0.0, 0.0), rematch_prob=0.0, stats=None, rng=None):
+        self.policy = policy
+        self.think = think
+        self.rematch_prob = rematch_prob
+        self.stats = stats
+        self.rng = rng or random.Random()
+        self.my_hand = rules.FULL_HAND
+        self.op_hand = rules.FULL_HAND
+        self.my_wins = 0
+        self.op_wins = 0
+        self.sent_at = None
+
+    def show_game_start(self, target_wins):
+        self.my_wins = self.op_wins = 0
+
+    def show_round(self, round_num):
+        pass
+
+    def show_cards(self, cards):
+        self.my_hand = rules.cards_to_mask(cards)
+
+    def show_opponents_cards(self, op_name, cards):
+        self.op_hand = rules.cards_to_mask(cards or [])
+
+    def get_player_move(self, deadline=None, poll=None):
+        lo, hi = self.think
+        if hi > 0:
+            wait = self.rng.uniform(lo, hi)
+            if deadline is not None and time.time() + wait > deadline:
+                # 想太久：跟真人一樣被回合時鐘切掉
+                time.sleep(max(deadline - time.time(), 0.0))
+                raise TurnTimeout()
+            time.sleep(wait)
+        play = self.policy(self.my_hand, self.op_hand, self.my_wins, self.op_wins, self.rng)
+        self.sent_at = time.perf_counter()
+        return rules.mask_to_cards(play)
+
+    def ask_rematch(self, deadline=None):
+        return self.rng.random() < self.rematch_prob
+
+    def show_round_result(self, my_play, op_play, winner, my_wins, op_wins):
+        self.my_wins, self.op_wins = my_wins, op_wins
+        if self.stats and self.sent_at is not None:
+            self.stats.add_round(time.perf_counter() - self.sent_at)
+            self.sent_at = None
+
+    def show_game_over(self, a_wins, b_wins, winner, my_role):
+        pass
+
+    def show_link(self, link):
+        pass
+
+    def show_turn_warning(self, remaining, mine=True):
+        pass
+
+    def show_forfeit(self, loser_is_me, reason):
+        if self.stats:
+            self.stats.add_forfeit()
+
+    def print_info(self, msg):
+        pass
+
+class GuestBot(threading.Thread):
+    """recv.py 的無頭版：SEARCH 由 responder 回，INVITE 一律接受（對戰中則拒絕）。"""
+    def __init__(self, name, port, policy_name="random", think=(0.0, 0.0), rematch_prob=0.0,
+                 stats=None, host="0.0.0.0"):
+        super().__init__(daemon=True)
+        self.name = name
+        self.policy = make_policy(policy_name, "B")
+        self.think = think
+        self.rematch_prob = rematch_prob
+        self.stats = stats
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((host, port))
+        self.stop_flag = {"stop": False}
+
+    def run(self):
+        available = {"on": True}
+        inbox, responder = recv.start_udp_responder(self.udp, self.name, available)
+        pending, deadline = None, 0.0
+        while not self.stop_flag["stop"]:
+            try:
+                msg, addr = inbox.get(timeout=0.5)
+            except queue.Empty:
+                if pending and time.time() >= deadline:
+                    pending = None
+                continue
+            t = msg.get("type")
+            if t == "INVITE":
+                if pending is None:
+                    pending, deadline = addr, time.time() + recv.WAIT_WINDOW
+                    self.udp.sendto(json.dumps({"type": "ACCEPT"}).encode(), addr)
+                    recv._drop_queued_invites(inbox, addr)
+                elif addr != pending:
+                    self.udp.sendto(json.dumps({"type": "DECLINE"}).encode(), addr)
+            elif t == "CANCEL" and addr == pending:
+                pending = None
+            elif t == "TCP_INFO" and addr == pending:
+                available["on"] = False
+                self._play(addr[0], int(msg["port"]), msg.get("token"), msg.get("trace"))
+                available["on"] = True
+                pending = None
+                # 對戰期間排隊的邀請多半已經過期，清掉等新的
+                while True:
+                    try:
+                        inbox.get_nowait()
+                    except queue.Empty:
+                        break
+        responder["stop"] = True
+
+    def _play(self, ip, port, token, trace_id=None):
+        ui = BotUI(self.policy, self.think, self.rematch_prob, self.stats)
+        t0 = time.perf_counter()
+        tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            with tracing.span("tcp_connect", trace_id, role="B"):
+                tcp.connect((ip, port))
+                send_json_line(tcp, {"type": "HELLO", "token": token, "trace": trace_id, "ping": True})
+            recv.client_game(tcp, lobby_sock=None, username=self.name, ui=ui, trace_id=trace_id)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            tcp.close()
+        if self.stats:
+            self.stats.add_match(time.perf_counter() - t0)
+
+SEARCH_WINDOW = 0.2     # HostBot 每次掃描最多等幾秒
+
+class HostBot(threading.Thread):
+    """client.py 的無頭版：掃描 targets、邀請其中一位、用共用的 GameListener 開局。"""
+    def __init__(self, name, targets, listener, policy_name="random", think=(0.0, 0.0),
+                 rematch_prob=0.0, seed=None, journal=None, turn_secs=None):
+        super().__init__(daemon=True)
+        self.name = name
+        self.targets = targets
+        self.listener = listener
+        self.policy = make_policy(policy_name, "A")
+        self.think = think
+        self.rematch_prob = rematch_prob
+        self.rng = random.Random(seed)
+        self.journal = journal
+        self.turn_secs = turn_secs
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.settimeout(1.0)
+        self.stop_flag = {"stop": False}
+
+    def run(self):
+        while not self.stop_flag["stop"]:
+            trace_id = tracing.new_id()
+            with tracing.span("search", trace_id, role="A", user=self.name) as sp:
+                # 有一隻空著的 guest 回了就夠，不用等滿 1 秒的掃描時間；
+                # guest 剛打完還在收尾時不回 SEARCH，短 window 沒找到就馬上再掃
+                found = client.search_game(self.udp, self.targets, enough=1, window=SEARCH_WINDOW)
+                sp.set(found=len(found))
+            if not found:
+                time.sleep(self.rng.uniform(0.01, 0.05))
+                continue
+            target = self.rng.choice(found)
+            if client.Selected_opponent(self.udp, self.name, target, trace_id) != "ACCEPT":
+                time.sleep(self.rng.uniform(0.05, 0.2))
+                continue
+            # 回合與對戰統計只在 guest 端記，避免同一場算兩次
+            ui = BotUI(self.policy, self.think, self.rematch_prob, rng=self.rng)
+            client.tcp_gameplay(self.udp, [target], lobbySock=None, username=self.name,
+                                listener=self.listener, ui=ui, journal=self.journal, trace_id=trace_id,
+                                turn_secs=self.turn_secs)
+
+def _parse_targets(spec):
+    """"ip:port" 或 "ip:lo-hi"，逗號分隔。"""
+    out = []
+    for part in spec.split(","):
+        ip, ports = part.rsplit(":", 1)
+        if "-" in ports:
+            lo, hi = map(int, ports.split("-"))
+            out.extend((ip, p) for p in range(lo, hi + 1))
+        else:
+            out.append((ip, int(ports)))
+    return out
+
+def _wait_and_report(stats, duration):
+    t0 = time.time()
+    try:
+        while duration <= 0 or time.time() - t0 < duration:
+            # 最後一段只睡到 duration 為止，不會多跑一整個 5 秒
+            time.sleep(5.0 if duration <= 0 else min(5.0, t0 + duration - time.time()))
+            print(f"[BOTS] {stats.report(time.time() - t0)}", file=sys.__stdout__, flush=True)
+    except KeyboardInterrupt:
+        pass
+    print(f"[BOTS] final: {stats.report(time.time() - t0)}", file=sys.__stdout__, flush=True)
+
+def main():
+    ap = argparse.ArgumentParser(description="Headless bot players for load testing")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    for name in ("guests", "hosts", "selftest"):
+        p = sub.add_parser(name)
+        p.add_argument("--policy", default="random", choices=sorted(rules.STRATEGIES) + ["solver"])
+        p.add_argument("--think", type=float, nargs=2, default=[0.0, 0.0], metavar=("MIN", "MAX"))
+        p.add_argument("--rematch", type=float, default=0.0, help="rematch probability")
+        p.add_argument("--duration", type=float, default=0.0, help="seconds, 0 = until Ctrl+C")
+        p.add_argument("--verbose", action="store_true", help="keep the game output")
+        if name == "guests":
+            p.add_argument("--count", type=int, default=10)
+            p.add_argument("--base-port", type=int, default=20000)
+        elif name == "hosts":
+            p.add_argument("--count", type=int, default=10)
+            p.add_argument("--targets", required=True)
+        else:
+            p.add_argument("--pairs", type=int, default=10)
+            p.add_argument("--base-port", type=int, default=20000)
+        if name != "guests":
+            p.add_argument("--journal", default=None, help="match journal directory for the host bots")
+            p.add_argument("--turn-secs", type=float, default=None, help="per-turn clock enforced by the host bots")
+    args = ap.parse_args()
+
+    stats = BotStats()
+    common = dict(policy_name=args.policy, think=tuple(args.think), rematch_prob=args.rematch)
+    with open(os.devnull, "w") as devnull, \
+            (contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)):
+        bots = []
+        if args.cmd in ("guests", "selftest"):
+            n = args.count if args.cmd == "guests" else args.pairs
+            bots += [GuestBot(f"guest{i}", args.base_port + i, stats=stats, **common) for i in range(n)]
+        if args.cmd in ("hosts", "selftest"):
+            listener = client.GameListener()
+            journal = MatchJournal(args.journal) if args.journal else None
+            if args.cmd == "hosts":
+                targets = _parse_targets(args.targets)
+                bots += [HostBot(f"host{i}", targets, listener, seed=i, journal=journal,
+                                 turn_secs=args.turn_secs, **common)
+                         for i in range(args.count)]
+            else:
+                # 一對一配對，避免壓測時大家搶同一隻 guest
+                bots += [HostBot(f"host{i}", [("127.0.0.1", args.base_port + i)], listener, seed=i,
+                                 journal=journal, turn_secs=args.turn_secs, **common)
+                         for i in range(args.pairs)]
+        for b in bots:
+            b.start()
+        _wait_and_report(stats, args.duration)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
 import socket
 import json
+import argparse
 import time
-import random
+import queue
+import secrets
+import threading
 
-from tt import GameUI, gameplay, send_json_line, recv_json_line, start_status_reporter, safe_logout
+import rules
+import tracing
+from journal import MatchJournal, JOURNAL_DIR
+from tt import (GameUI, gameplay, PeerChannel, TurnClock, TurnTimeout, recv_json_line, start_status_reporter,
+                safe_logout, match_summary, TURN_SECS, TURN_GRACE, REMATCH_SECS)
 
 HOST = '140.113.17.11'
 PORT = 16000
@@ -12,47 +19,72 @@ SERVER_IP = ['140.113.17.11', '140.113.17.12', '140.113.17.13', '140.113.17.14']
 INVITE_RETRY_INTERVAL = 0.01
 INVITE_WAIT_WINDOW    = 30.0
 ACK_TYPES = {"ACCEPT", "DECLINE"}
-TCP_BASE_PORT = 10000
-TCP_TRY_COUNT = 100
+TCP_ACCEPT_WINDOW = 10.0
+HELLO_TIMEOUT = 3.0
 
 class HostGame(gameplay):
-    def __init__(self, conn, peer_name: str, lobby_sock, username: str, op_name: str):
+    def __init__(self, conn, peer_name: str, lobby_sock, username: str, op_name: str, buf=b"", ui=None,
+                 journal=None, trace_id=None, peer_ping=False, turn_secs=None):
         super().__init__()
         self.conn = conn
+        self.chan = PeerChannel(conn, buf)  # 對戰訊息都走這裡；PING/PONG 在背景處理
+        self.peer_ping = peer_ping          # 對方 HELLO 有說看得懂 PING 才送
         self.peer_name = peer_name
         self.target_wins = 3
         self.round = 1
-        self.buf = b""
-        self.ui = GameUI()
+        self.ui = ui or GameUI()
         self.my_role = "A"
         self.lobby_sock = lobby_sock
         self.username = username
         self.op_name = op_name
+        self.journal = journal      # journal.MatchJournal，None 就不記
+        self.match_id = None
+        self.winner_side = None
+        self.trace_id = trace_id    # tracing：跟 B 共用的 trace id
+        self.turn_secs = turn_secs or TURN_SECS
+        self.forfeited = False
+        self.my_plays = []          # 這場自己每回合出的牌（給 lobby 的 match 摘要）
+        self.is_rematch = False
 
     def start_game(self):
+        self.chan.start()
+        if self.peer_ping:
+            self.chan.enable_ping()
         try:
             while True:  # 支援多局
                 self.ui.show_game_start(self.target_wins)
                 self._send_new_start()
-
-                while True:
-                    if not self._play_round():
-                        break
-
-                print("對戰結束。你可以選擇是否在 5 秒內與對方同時發起 REMATCH。")
-                ok = self._rematch_both_sides()
+                if self.journal:
+                    self.match_id = self.journal.start_match(self.username, self.op_name, self.target_wins)
+
+                with tracing.span("match", self.trace_id, role="A", user=self.username):
+                    while True:
+                        with tracing.span("round", self.trace_id, role="A", round=self.round):
+                            more = self._play_round()
+                        if not more:
+                            break
+
+                if self.forfeited:
+                    ok = False      # 有人超時就不問 rematch，直接收掉連線
+                else:
+                    print("對戰結束。你可以選擇是否在 5 秒內與對方同時發起 REMATCH。")
+                    ok = self._rematch_both_sides()
+                if self.journal and self.match_id is not None:
+                    self.journal.end_match(self.match_id, self.winner_side, self.playr1.winRound,
+                                           self.playr2.winRound, ok)
                 if ok:
                     print("雙方都同意再來一局，重置牌庫與比分。")
                     self._reset_match()
-                    self._send_new_start()
-                    continue
+                    continue    # 迴圈開頭會送新的 START
+                elif self.forfeited:
+                    break
                 else:
                     print("對方未在 5 秒內同意或你選擇不再一局，結束遊戲。")
                     break
         except KeyboardInterrupt:
             # 通知對手我已中斷
             try:
-                send_json_line(self.conn, {"type": "DISCONNECT", "reason": "KeyboardInterrupt"})
+                self.chan.send({"type": "DISCONNECT", "reason": "KeyboardInterrupt"})
             except Exception:
                 pass
             # 回報不在遊戲中（可選）
@@ -71,17 +103,31 @@ class HostGame(gameplay):
 
     def _play_round(self):
         self.ui.show_round(self.round)
+        self.ui.show_link(self.chan.link.summary())
         if not self._check_cards():
             return False
             
-        send_json_line(self.conn, {"type": "MOVE", "cards": self.playr1.cards})
+        # 兩邊同時開始想，回合時鐘從送出 MOVE 開始算
+        clock = TurnClock(self.turn_secs)
+        self.chan.send({"type": "MOVE", "cards": self.playr1.cards, "turn": self.turn_secs})
         # 取得自己的出牌
-        my_cards = self._get_my_move()
+        with tracing.span("round.input", self.trace_id, role="A", round=self.round) as sp:
+            try:
+                my_cards = self._get_my_move(clock)
+            except TurnTimeout:
+                sp.set(timeout=True)
+                self._forfeit("A", "timeout")
+                return False
         if my_cards is None:
             return False
         
         # 接收對手出牌
-        msg, self.buf = recv_json_line(self.conn, self.buf)
+        with tracing.span("round.wait_peer", self.trace_id, role="A", round=self.round) as sp:
+            msg = self._wait_peer_move(clock)
+            if msg is None:
+                sp.set(timeout=True)
+                self._forfeit("B", "timeout")
+                return False
 
         t = msg.get("type")
         if t == "DISCONNECT":
@@ -102,7 +148,13 @@ class HostGame(gameplay):
             return False
         
         op_cards = msg.get("cards", [])
+        # 對手的出牌跟 roomhost 一樣用 rules.check_move 驗：重複出、出過的牌、範圍外、非整數都判負
+        if not isinstance(op_cards, list) or rules.check_move(op_cards, self.playr2.mask) is not None:
+            self._forfeit("B", "invalid_move")
+            return False
         
+        self.my_plays.append(list(my_cards))
+
         # 計算結果
         my_sum = sum(my_cards)
         op_sum = sum(op_cards)
@@ -112,14 +164,16 @@ class HostGame(gameplay):
         self.playr2.use_cards(op_cards)
         
         self.round += 1
-        return self._handle_round_result(my_sum, op_sum)
+        return self._handle_round_result(my_sum, op_sum, my_cards, op_cards)
 
-    def _get_my_move(self):
+    def _get_my_move(self, clock=None):
         self.ui.show_cards(self.playr1.cards)
         self.ui.show_opponents_cards( self.op_name, self.playr2.cards)
+        deadline = clock.deadline if clock else None
+        poll = (lambda: self._tick(clock, mine=True)) if clock else None
         while True:
             try:
-                pick = self.ui.get_player_move()
+                pick = self.ui.get_player_move(deadline=deadline, poll=poll)
                 if self._validate_move(pick, self.playr1.cards):
                     return pick
             except ValueError:
@@ -127,6 +181,47 @@ class HostGame(gameplay):
             except KeyboardInterrupt:
                 raise
 
+    def _tick(self, clock, mine):
+        # 時鐘是兩邊共用的：到了警告時間自己這邊印，也通知 B（B 已經出完牌的話會忽略）
+        if clock.due_warning():
+            left = max(clock.left(), 0.0)
+            self.ui.show_turn_warning(left, mine=mine)
+            try:
+                self.chan.send({"type": "TURN_WARNING", "remaining": round(left, 1)})
+            except OSError:
+                pass
+
+    def _wait_peer_move(self, clock):
+        """等 B 的 MOVE（或 DISCONNECT）；超過時限加寬限回傳 None。"""
+        while True:
+            left = clock.left() + TURN_GRACE
+            if left <= 0:
+                return None
+            self._tick(clock, mine=False)
+            try:
+                return self.chan.recv(timeout=min(left, 1.0))
+            except socket.timeout:
+                continue
+
+    def _forfeit(self, loser, reason):
+        """loser 是 "A"（自己）或 "B"；通知對方、回報 lobby，這場到此為止。"""
+        self.forfeited = True
+        self.winner_side = "B" if loser == "A" else "A"
+        winner = self.username if self.winner_side == "A" else self.op_name
+        try:
+            self.chan.send({
+                "type": "FORFEIT",
+                "loser": loser,
+                "reason": reason,
+                "winner": winner,
+                "a_wins": self.playr1.winRound,
+                "b_wins": self.playr2.winRound
+            })
+        except OSError:
+            pass
+        self.ui.show_forfeit(loser == "A", reason)
+        self._report_result()
+
     def _check_cards(self):
         if not self.playr1.has_cards():
             print("你沒有牌了，PlayerB 勝！")
@@ -139,33 +234,24 @@ class HostGame(gameplay):
         return True
 
     def _validate_move(self, cards, available_cards):
-        if len(cards) not in (1,2):
-            print("必須出 1 或 2 張牌")
-            return False
-        if any(c<1 or c>7 for c in cards):
-            print("牌的數字必須在 1-7 之間")
-            return False
-        if len(cards)==2 and cards[0]==cards[1]:
-            print("不能出相同的牌")
-            return False
-        if any(c not in available_cards for c in cards):
-            print("你沒有這張牌")
+        err = rules.check_move(cards, rules.cards_to_mask(available_cards))
+        if err:
+            print(err)
             return False
         return True
 
-    def _handle_round_result(self, a_sum, b_sum):
-        aa = float(a_sum)
-        bb = float(b_sum)
-        if aa == bb:
-            aa += random.choice([0.1, -0.1])
-        
-        winner = self.username if aa > bb else self.op_name
-        if winner == self.username:
+    def _handle_round_result(self, a_sum, b_sum, a_cards=(), b_cards=()):
+        side, tied = rules.resolve_round(a_sum, b_sum)
+        winner = self.username if side == "A" else self.op_name
+        if side == "A":
             self.playr1.winRound += 1
         else:
             self.playr2.winRound += 1
+        if self.journal and self.match_id is not None:
+            self.journal.record_round(self.match_id, self.round - 1, a_cards, b_cards, a_sum, b_sum, tied, side,
+                                      self.playr1.winRound, self.playr2.winRound)
         
-        self.ui.show_round_result(int(aa), int(bb), winner, self.playr1.winRound, self.playr2.winRound)
+        self.ui.show_round_result(a_sum, b_sum, winner, self.playr1.winRound, self.playr2.winRound)
         self._send_round_result(a_sum, b_sum, winner)
 
         if self.playr1.winRound >= self.target_wins or self.playr2.winRound >= self.target_wins:
@@ -174,7 +260,7 @@ class HostGame(gameplay):
         return True
 
     def _send_round_result(self, a_sum, b_sum, winner):
-        send_json_line(self.conn, {
+        self.chan.send({
             "type": "ROUND_RESULT",
             "a_play": a_sum, 
             "b_play": b_sum,
@@ -186,25 +272,32 @@ class HostGame(gameplay):
         })
 
     def _send_game_over(self, winner):
-        send_json_line(self.conn, {
+        self.winner_side = "A" if winner in ("A", self.username) else "B"
+        self.chan.send({
             "type": "GAME_OVER",
             "winner": winner,
             "a_wins": self.playr1.winRound,
             "b_wins": self.playr2.winRound
         })
         self.ui.show_game_over(self.playr1.winRound, self.playr2.winRound, winner, self.my_role)
+        self._report_result()
 
+    def _report_result(self):
         try:
-            wins_delta   = 1 if winner == "A" else 0
-            losses_delta = 1 if winner == "B" else 0
+            # winner 可能是 "A"/"B"（有人沒牌）或玩家名字，統一看 winner_side
+            wins_delta   = 1 if self.winner_side == "A" else 0
+            losses_delta = 1 - wins_delta
             payload = {
                 "action": "status_report",
                 "username": self.username,
                 "status": {
                     "wins_delta": wins_delta,
                     "losses_delta": losses_delta,
+                    "opponent": self.op_name,
                     "in_game": False
-                }
+                },
+                "link": self.chan.link.summary(),   # 這場的 RTT，lobby 拿來做配對參考
+                "match": match_summary(self.my_plays, self.is_rematch)     # lobby 的 player_stats 用
             }
             self.lobby_sock.sendall(json.dumps(payload).encode("utf-8"))
         except Exception as e:
@@ -218,12 +311,16 @@ class HostGame(gameplay):
         self.playr1.winRound = 0
         self.playr2.winRound = 0
         self.round = 1
+        self.my_plays = []
+        self.is_rematch = True
 
     def _send_new_start(self):
-        send_json_line(self.conn, {
+        self.chan.send({
             "type": "START",
             "name": self.username,
-            "target_wins": self.target_wins
+            "target_wins": self.target_wins,
+            "ping": True,
+            "turn": self.turn_secs
         })
 
     def _rematch_both_sides(self) -> bool:
@@ -231,19 +328,17 @@ class HostGame(gameplay):
         問自己是否要 rematch；若選 y：送 REMATCH，並在 5 秒內等待對方也送 REMATCH。
         雙方都送出才回 True，由主機負責送新的 START；否則回 False。
         """
-        ans = input("Rematch? (y/n): ").strip().lower()
-        if ans != "y":
+        if not self.ui.ask_rematch(deadline=time.time() + REMATCH_SECS):
             return False
 
         # 等待對方的 REMATCH（5 秒），期間忽略其他訊息
-        buf = b""
+        deadline = time.time() + REMATCH_SECS
         try:
-            self.conn.settimeout(5.0)
             while True:
-                msg, buf = recv_json_line(self.conn, buf)
+                msg = self.chan.recv(timeout=max(deadline - time.time(), 0.0))
                 t = msg.get("type")
                 if t == "REMATCH":
-                    send_json_line(self.conn, {"type": "REMATCH"})
+                    self.chan.send({"type": "REMATCH"})
                     return True
                 if t == "DISCONNECT":
                     print("[!] 對手中斷連線（DISCONNECT）。無法 rematch。")
@@ -251,71 +346,123 @@ class HostGame(gameplay):
                 # 其他型別忽略
         except Exception:
             return False
-        finally:
-            try:
-                self.conn.settimeout(None)
-            except Exception:
-                pass
 
-def tcp_gameplay(udp, op, lobbySock, username, host = '0.0.0.0', port = None):
-    op_ip, op_port, name = op[0]
-    tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    
-    selected_port = None
-    try:
-        tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # === 循環找可用埠 ===
-        base = TCP_BASE_PORT if port is None else port
-        for p in range(base, base + TCP_TRY_COUNT):
+class GameListener:
+    """
+    每個 client 程序只建立一次的對戰 TCP listener。
+    bind 到 OS 指派的 port（不用再一個一個試），accept 後讀對方第一行 HELLO，
+    依 (對手 IP, match token) 把連線交給正在等待的邀請。
+    """
+    def __init__(self, host='0.0.0.0'):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind((host, 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.pending = {}   # (ip, token) -> Queue(maxsize=1)
+        self.lock = threading.Lock()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        print(f"Game listener on {host}:{self.port}")
+
+    def expect(self, ip: str) -> str:
+        token = secrets.token_hex(8)
+        with self.lock:
+            self.pending[(ip, token)] = queue.Queue(maxsize=1)
+        return token
+
+    def wait(self, ip: str, token: str, timeout: float):
+        """等對手連進來；回傳 (conn, 剩餘 buf, HELLO 訊息)，逾時回傳 None。"""
+        with self.lock:
+            slot = self.pending.get((ip, token))
+        if slot is None:
+            return None
+        try:
+            got = slot.get(timeout=timeout)
+        except queue.Empty:
+            got = None
+        # _handshake 只在鎖裡、而且 slot 還登記著時才交連線，所以拿掉登記之後不會再有連線進來
+        with self.lock:
+            self.pending.pop((ip, token), None)
+            if got is None and not slot.empty():
+                got = slot.get_nowait()     # 剛好在逾時那一刻交進來的，照樣接走
+        return got
+
+    def cancel(self, ip: str, token: str):
+        """沒等到 wait 就放棄這個邀請時呼叫：拿掉登記，已經交進來的連線關掉。"""
+        with self.lock:
+            slot = self.pending.pop((ip, token), None)
+        if slot is not None and not slot.empty():
+            slot.get_nowait()[0].close()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except Exception:
+            pass
+
+    def _accept_loop(self):
+        while True:
             try:
-                tcp.bind((host, p))
-                selected_port = p
-                if p != base:
-                    print(f"[PORT SWITCH] TCP port {base} in-use, switched to {p}")
-                break
+                conn, addr = self.sock.accept()
             except OSError:
-                continue
-
-        if selected_port is None:
-            print("[ERROR] No available TCP port in range.")
-            return  # 回上層，讓主程式再走一輪
-        tcp.listen()
-        print(f"TCP listen on {host}:{selected_port}")
+                break       # listener 已關閉
+            threading.Thread(target=self._handshake, args=(conn, addr), daemon=True).start()
 
-        tcp_info = {"type":"TCP_INFO", "port":selected_port}
-        udp.sendto(json.dumps(tcp_info).encode(), (op_ip, op_port))
-
-        tcp.settimeout(10.0)
-        print(f"Waiting for {name} to connect...")
+    def _handshake(self, conn, addr):
+        try:
+            conn.settimeout(HELLO_TIMEOUT)
+            msg, buf = recv_json_line(conn)
+            conn.settimeout(None)
+        except Exception:
+            conn.close()
+            return
+        # 第一行不是 {"type": "HELLO", "token": "..."}（例如 JSON list）就直接關掉
+        token = msg.get("token") if isinstance(msg, dict) and msg.get("type") == "HELLO" else None
+        ok = False
+        if isinstance(token, str):
+            with self.lock:
+                slot = self.pending.get((addr[0], token))
+                ok = slot is not None and slot.empty()
+                if ok:
+                    slot.put_nowait((conn, buf, msg))
+        if not ok:
+            print(f"Rejected connection from {addr}")
+            conn.close()
 
-        while True:
-            try:
-                conn, addr = tcp.accept()
-                if addr[0] == op_ip:
-                    print(f"Connected by {name} from {addr}")
-                    game = HostGame(conn, name, lobby_sock=lobbySock, username=username, op_name=name)
-                    try:
-                        game.start_game()
-                    except ConnectionError:
-                        print("[A] Peer disconnected during game.")
-                    finally:
-                        conn.close()
-                    # 無論如何都 return，讓主流程回到再搜尋
-                    return
-                else:
-                    print(f"Rejected connection from {addr}")
-                    conn.close()
-            except socket.timeout:
-                print("Connection timeout")
-                return
+def tcp_gameplay(udp, op, lobbySock, username, listener, ui=None, journal=None, trace_id=None, turn_secs=None):
+    op_ip, op_port, name = op[0]
+    token = listener.expect(op_ip)
+    try:
+        with tracing.span("tcp_setup", trace_id, role="A") as sp:
+            tcp_info = {"type":"TCP_INFO", "port":listener.port, "token":token, "trace": trace_id}
+            udp.sendto(json.dumps(tcp_info).encode(), (op_ip, op_port))
+            print(f"Waiting for {name} to connect...")
+
+            got = listener.wait(op_ip, token, TCP_ACCEPT_WINDOW)
+            sp.set(ok=got is not None)
+        if got is None:
+            print("Connection timeout")
+            return
+        conn, buf, hello = got
+        # 一回合裡會連著送好幾行小訊息（ROUND_RESULT 後馬上是下一回合的 MOVE），關掉 Nagle 免得等 delayed ACK
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print(f"Connected by {name} from {conn.getpeername()}")
+        game = HostGame(conn, name, lobby_sock=lobbySock, username=username, op_name=name, buf=buf, ui=ui,
+                        journal=journal, trace_id=trace_id, peer_ping=bool(hello.get("ping")), turn_secs=turn_secs)
+        try:
+            game.start_game()
+        except ConnectionError:
+            print("[A] Peer disconnected during game.")
+        finally:
+            game.chan.close()
+            conn.close()
+            print("TCP connection closed")
     except KeyboardInterrupt:
         safe_logout(lobbySock, username)
         print("\n[!] Ctrl+C: closed TCP and logged out.")
     except Exception as e:
         print(f"TCP server error: {e}")
     finally:
-        tcp.close()
-        print("TCP connection closed")
+        listener.cancel(op_ip, token)   # 還沒 wait 就出錯的話，別讓之後連進來的連線卡在 slot 裡
 
 def choose_opponent(opponents):
     if not opponents:
@@ -339,9 +486,17 @@ def choose_opponent(opponents):
                 return opponents[idx-1]
         print("Invalid choice. Try again.")
 
-def Selected_opponent(udp, username, opponent):
+def Selected_opponent(udp, username, opponent, trace_id=None):
+    with tracing.span("invite", trace_id, role="A", to=opponent[2]) as sp:
+        result, sends = _invite(udp, username, opponent, trace_id)
+        sp.set(result=result, sends=sends)
+    return result
+
+def _invite(udp, username, opponent, trace_id):
+    """回傳 (結果, 送了幾次 INVITE)。"""
     target_ip, target_port, name = opponent
-    invite = {"type": "INVITE", "from": username}
+    invite = {"type": "INVITE", "from": username, "trace": trace_id}
+    sends = 1
 
     prev_to = udp.gettimeout()          # ← 記住原本 timeout（通常是 1.0）
     try:
@@ -355,47 +510,62 @@ def Selected_opponent(udp, username, opponent):
             try:
                 data, addr = udp.recvfrom(1024)
                 reply = json.loads(data.decode('utf-8'))
-                if addr[0] == target_ip and reply.get("type") in ACK_TYPES:
+                if addr == (target_ip, target_port) and reply.get("type") in ACK_TYPES:
                     if reply["type"] == "ACCEPT":
                         print(f"{name} accepted! Starting TCP server...")
-                        return "ACCEPT"
+                        return "ACCEPT", sends
                     else:
                         print(f"{name} declined.")
-                        return "DECLINE"
+                        return "DECLINE", sends
             except socket.timeout:
                 if time.time() - last_send >= INVITE_RETRY_INTERVAL:
                     udp.sendto(json.dumps(invite).encode("utf-8"), (target_ip, target_port))
                     last_send = time.time()
+                    sends += 1
     finally:
         udp.settimeout(prev_to)         # ← 一定要復原！
 
     print("Invitation timed out (no response).")
-    return "TIMEOUT"
+    return "TIMEOUT", sends
   
-def search_game(broadcast):
+def search_game(broadcast, targets=None, enough=None, window=1.0):
+    """targets: [(ip, port), ...]；沒給就掃 SERVER_IP x UDP_PORT_RANGE。
+    enough：收到這麼多個不同玩家的 REPLY 就提早回傳，不等滿整個掃描時間；
+    有給 targets 時預設是 len(targets)（全部都回了就不用再等），全域掃描則一律等滿。
+    window：最多等幾秒（bot 掃本機的 guest 用短一點的）。"""
     found = []
-    timeout_total = 1.0  # 每個recv timeout秒數
+    timeout_total = window  # 每個recv timeout秒數
+    if targets is None:
+        targets = [(ip, port) for ip in SERVER_IP for port in UDP_PORT_RANGE]
+    elif enough is None:
+        enough = len(targets)
 
     print("\n[Scanning] Searching all known servers and ports...")
-    for ip in SERVER_IP:
-        for port in UDP_PORT_RANGE:
-            try:
-                broadcast.sendto(json.dumps({"type": "SEARCH"}).encode(), (ip, port))
-            except OSError:
-                continue
-    
-    start_time = time.time()
-    while time.time() - start_time < timeout_total:
+    for ip, port in targets:
         try:
-            data, addr = broadcast.recvfrom(1024)
-            reply = json.loads(data.decode("utf-8"))
-            if reply.get("type") == "REPLY":
-                found.append((addr[0], addr[1], reply.get("name", "?")))
-        except socket.timeout:
-            print(f"Timeout: no player available at {ip}:{port}")
-            break
-        except Exception:
+            broadcast.sendto(json.dumps({"type": "SEARCH"}).encode(), (ip, port))
+        except OSError:
             continue
+    
+    prev_to = broadcast.gettimeout()    # 跟 Selected_opponent 一樣，暫時改 timeout，最後復原
+    broadcast.settimeout(min(timeout_total, prev_to or timeout_total))
+    start_time = time.time()
+    try:
+        while time.time() - start_time < timeout_total:
+            try:
+                data, addr = broadcast.recvfrom(1024)
+                reply = json.loads(data.decode("utf-8"))
+                if reply.get("type") == "REPLY":
+                    found.append((addr[0], addr[1], reply.get("name", "?")))
+                    if enough and len(set(found)) >= enough:
+                        break
+            except socket.timeout:
+                print(f"Timeout: no player available at {ip}:{port}")
+                break
+            except Exception:
+                continue
+    finally:
+        broadcast.settimeout(prev_to)
 
     unique_found = []
     seen = set()
@@ -436,14 +606,17 @@ def sign_in(client):
                 if resp.get("type") == "LOGIN_SUCCESS":
                     print("You are now logged in.")
                     print(f"Your status: {resp.get('status')}")
-                    return True, username, resp.get("status", {})
+                    # resume：lobby 重啟後重連用的 token
+                    return True, username, resp.get("status", {}), resp.get("resume")
             except json.JSONDecodeError:
                 # 舊版文字回覆或錯誤碼
                 print(f"Server response: {resp_raw}")
                 if resp_raw in ["LOGIN_SUCCESS"]:
-                    return True, username, {}
+                    return True, username, {}, None
                 elif resp_raw == "LOGIN_FAILED_DUPLICATE":
                     print("Duplicate login detected. Please logout previous session.")
+                elif resp_raw in ("SERVER_BUSY", "LOGIN_FAILED_RATE_LIMITED"):
+                    print("Lobby is busy. Please wait a moment and try again.")
                 else:
                     print("Login failed. Try again.\n")
 
@@ -469,18 +642,23 @@ def sign_in(client):
             
 
 def main():
+    ap = argparse.ArgumentParser(description="Lobby client (player A)")
+    ap.add_argument("--journal", nargs="?", const=str(JOURNAL_DIR), default=None, metavar="DIR",
+                    help="record the matches this client hosts (default dir: storage/journal)")
+    args = ap.parse_args()
     print("=== Welcome to lobby ===")
     username = None
 
     client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     broadcast = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    listener = None
     try:
         client.connect((HOST, PORT))
         broadcast.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         broadcast.settimeout(1.0)
         print(f"Connected to lobby with {HOST}:{PORT}")
 
-        ok, username, status0 = sign_in(client)
+        ok, username, status0, resume_token = sign_in(client)
         if not ok:
             print("Login failed.")
             return
@@ -491,18 +669,27 @@ def main():
                 "losses_delta":0,
                 "in_game":False,
             }
-        _ = start_status_reporter(client, username, stats_provider=stats_provider)
+        _ = start_status_reporter(client, username, stats_provider=stats_provider,
+                                  resume_token=resume_token)
+        listener = GameListener()
+        match_journal = MatchJournal(args.journal) if args.journal else None
 
         while True:
             _ = input("Press any key to search opponent")
             while True:
-                players = search_game(broadcast)
-                target = choose_opponent(players)
+                # 一次找對手到打完算一個 trace（沒開 TT_TRACE 時 span 什麼都不做）
+                trace_id = tracing.new_id()
+                with tracing.span("search", trace_id, role="A", user=username) as sp:
+                    players = search_game(broadcast)
+                    sp.set(found=len(players))
+                with tracing.span("choose", trace_id, role="A"):
+                    target = choose_opponent(players)
                 if target is None:
                     continue
-                result = Selected_opponent(broadcast, username, target)
+                result = Selected_opponent(broadcast, username, target, trace_id)
                 if result == "ACCEPT":
-                    tcp_gameplay(broadcast, [target], lobbySock=client, username=username)
+                    tcp_gameplay(broadcast, [target], lobbySock=client, username=username, listener=listener,
+                                 journal=match_journal, trace_id=trace_id)
                     break
                 else:
                     print("Invite not accepted. Choose another or rescan.")
@@ -510,6 +697,8 @@ def main():
     except KeyboardInterrupt:
         print("\n[!] Ctrl+C detected. Closing sockets and exiting...")
     finally:
+        if listener:
+            listener.close()
         broadcast.close()
         client.close()
         print("[!] Clean exit complete.")
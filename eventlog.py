@@ -0,0 +1,166 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+
+"""
+結構化 log：呼叫端只把一筆 (時間, 等級, 事件名, 欄位) 丟進有上限的 queue 就回去，
+背景執行緒整批拿出來格式化、寫到檔案或 stdout。終端機或 pipe 很慢時卡住的只有寫 log 的執行緒，
+處理連線的執行緒不會在 stdout 的鎖上排隊。
+
+  - 等級：debug / info / warn / error，低於設定等級的在呼叫端就直接丟掉
+  - 取樣：sample={"connect": 10} 表示 connect 事件每 10 筆只留 1 筆（留下的那筆帶 sample=10）
+  - queue 滿了就丟掉新的一筆、dropped 加一；writer 發現 dropped 有變會補寫一筆 log_dropped
+  - 寫到檔案是 JSON lines（一行一筆），寫到 stdout 預設是給人看的一行文字
+
+用法：
+    eventlog.setup(path="storage/lobby.log", level="info", sample={"connect": 10})
+    eventlog.info("connect", addr=addr, players=n)
+
+沒呼叫 setup 的 process（例如 client）第一次用到時依環境變數 TT_LOG（檔案路徑，預設 stdout）
+與 TT_LOG_LEVEL（預設 warn）自動設定。fork 出來的子 process 會自己重開一個 writer。
+"""
+
+LEVELS = {"debug": 10, "info": 20, "warn": 30, "error": 40}
+QUEUE_SIZE = 10000
+BATCH = 512
+
+class EventLog:
+    def __init__(self, path=None, level="info", fmt=None, queue_size=QUEUE_SIZE, sample=None):
+        self.path = path
+        self.level_name = level
+        self.level = LEVELS[level]
+        self.fmt = fmt or ("json" if path else "text")
+        self.queue_size = queue_size
+        self.q = queue.Queue(maxsize=queue_size)
+        self.sample = dict(sample or {})    # 事件名 -> 每 N 筆留 1 筆
+        self.seen = {}                      # 事件名 -> 看過幾筆（取樣用，不上鎖，大概就好）
+        self.dropped = 0
+        self.sampled_out = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    # ===== 呼叫端（不會 block）=====
+    def log(self, level, event, **fields):
+        lv = LEVELS[level]
+        if lv < self.level:
+            return
+        n = self.sample.get(event)
+        if n and n > 1:
+            c = self.seen.get(event, 0)
+            self.seen[event] = c + 1
+            if c % n:
+                self.sampled_out += 1
+                return
+            fields["sample"] = n
+        try:
+            self.q.put_nowait((time.time(), level, event, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {"queued": self.q.qsize(), "dropped": self.dropped, "sampled_out": self.sampled_out}
+
+    def close(self, timeout=2.0):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self.q.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    # ===== writer 執行緒 =====
+    def _format(self, ts, level, event, fields):
+        if self.fmt == "json":
+            rec = {"ts": round(ts, 6), "lvl": level, "ev": event, "pid": os.getpid()}
+            rec.update(fields)
+            return json.dumps(rec, default=str) + "\n"
+        kv = " ".join(f"{k}={v}" for k, v in fields.items())
+        return f"{time.strftime('%H:%M:%S', time.localtime(ts))} {level.upper():5s} {event} {kv}\n"
+
+    def _writer(self):
+        if self.path:
+            out = open(self.path, "a", encoding="utf-8")
+        else:
+            out = sys.stdout
+        reported = 0
+        stop = False
+        while not stop:
+            batch = [self.q.get()]
+            try:
+                while len(batch) < BATCH:
+                    batch.append(self.q.get_nowait())
+            except queue.Empty:
+                pass
+            lines = []
+            for item in batch:
+                if item is None:
+                    stop = True
+                    continue
+                lines.append(self._format(*item))
+            if self.dropped != reported:
+                lines.append(self._format(time.time(), "warn", "log_dropped", {"dropped": self.dropped}))
+                reported = self.dropped
+            try:
+                out.write("".join(lines))
+                out.flush()
+            except Exception:
+                pass
+        if out is not sys.stdout:
+            out.close()
+
+_LOG = None
+_setup_lock = threading.Lock()
+
+def setup(path=None, level="info", fmt=None, queue_size=QUEUE_SIZE, sample=None) -> EventLog:
+    global _LOG
+    with _setup_lock:
+        if _LOG is not None:
+            _LOG.close()
+        _LOG = EventLog(path, level, fmt, queue_size, sample)
+        return _LOG
+
+def get() -> EventLog:
+    global _LOG
+    if _LOG is None:
+        with _setup_lock:
+            if _LOG is None:
+                _LOG = EventLog(os.environ.get("TT_LOG") or None, os.environ.get("TT_LOG_LEVEL", "warn"))
+    return _LOG
+
+def debug(event, **fields):
+    get().log("debug", event, **fields)
+
+def info(event, **fields):
+    get().log("info", event, **fields)
+
+def warn(event, **fields):
+    get().log("warn", event, **fields)
+
+def error(event, **fields):
+    get().log("error", event, **fields)
+
+def parse_sample(specs):
+    """["connect=10", "disconnect=10"] -> {"connect": 10, "disconnect": 10}"""
+    out = {}
+    for spec in specs or ():
+        name, _, n = spec.partition("=")
+        out[name] = int(n or 1)
+    return out
+
+def _after_fork():
+    # writer 執行緒不會跟著 fork 過來；子 process 用同樣的設定重開一個（父 process 還沒寫的不管）
+    global _LOG, _setup_lock
+    _setup_lock = threading.Lock()
+    if _LOG is not None:
+        old = _LOG
+        _LOG = EventLog(old.path, old.level_name, old.fmt, old.queue_size, old.sample)
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(lambda: _LOG is not None and _LOG.close())
@@ -0,0 +1,310 @@
+import os
+import json
+import mmap
+import time
+import struct
+import secrets
+import atexit
+import argparse
+import threading
+from pathlib import Path
+from collections import namedtuple
+
+import rules
+import eventlog
+
+"""
+對戰紀錄：只會 append 的固定寬度二進位檔（每筆 32 bytes），依大小切 segment。
+寫入端只把 bytes 丟進記憶體 buffer，背景執行緒每隔 fsync_interval 批次 write + fsync，
+遊戲迴圈幾乎不受影響。讀取端 mmap segment 直接解，不用 parse JSON。
+
+紀錄種類（kind）：
+  START : 一場開始  (match_id, ts, player_a/player_b 名字 id, target_wins)
+  ROUND : 一個回合  (match_id, ts, round, play_a/play_b bitmask, sum_a/sum_b, flags, wins_a/wins_b)
+  END   : 一場結束  (match_id, ts, flags 的 B_WON / REMATCH, wins_a/wins_b)
+flags: bit0 平手、bit1 B 贏、bit2 雙方同意 rematch
+每個 segment 開頭是一筆 32 bytes 的檔頭（MAGIC + 版本）。
+segment 檔名是 journal-<序號>-<pid>-<亂數>.bin：同一個目錄可以有好幾個寫入端（兩個 client、bots + client），
+各寫各的檔，不會把檔頭或名字表寫進別人的 segment。讀取端每個 segment 各自解，不在乎是誰寫的。
+
+名字表（id -> 完整名字）放在同名的 .names 旁檔，一行一筆 JSON，START 只存 id；
+同一批 flush 裡名字一定比用到它的紀錄先寫，讀取端看到的 id 都查得到。
+（版本 1 的 segment 是把名字截成 16 bytes 放在 NAME 紀錄裡，讀取端仍然看得懂。）
+寫檔出錯（磁碟滿、目錄被刪）時記一筆 log 就停止記錄，不會讓 buffer 無限長大，也不影響遊戲。
+"""
+
+JOURNAL_DIR = Path(__file__).resolve().parent / "storage" / "journal"
+MAGIC = b"TTJ1"
+REC_SIZE = 32
+SEGMENT_BYTES = 64 * 1024 * 1024
+FSYNC_INTERVAL = 1.0
+
+VERSION = 2
+KIND_START, KIND_ROUND, KIND_END, KIND_NAME = 1, 2, 3, 4     # KIND_NAME 只有版本 1 的 segment 有
+FLAG_TIE, FLAG_B_WON, FLAG_REMATCH = 1, 2, 4
+
+HEADER_REC = struct.Struct("<4sH26x")
+# kind round play_a play_b sum_a sum_b flags wins_a wins_b target | pad | aux | ts | match_id
+REC = struct.Struct("<BBBBBBBBBBxxIdQ")
+# START 把 player_b id 放在 sum_a..wins_a 的位置
+START_REC = struct.Struct("<BBBBIBBxxIdQ")
+NAME_REC = struct.Struct("<B11xI16s")
+assert HEADER_REC.size == REC.size == START_REC.size == NAME_REC.size == REC_SIZE
+
+Record = namedtuple("Record", "kind match_id ts round play_a play_b sum_a sum_b flags wins_a wins_b "
+                              "target name_a name_b")
+
+class MatchJournal:
+    def __init__(self, directory=JOURNAL_DIR, segment_bytes=SEGMENT_BYTES, fsync_interval=FSYNC_INTERVAL):
+        self.dir = Path(directory)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.pending = []           # [(segment_no, bytes), ...] 等背景執行緒寫出
+        self.pending_names = []     # [(segment_no, id, 名字), ...]，寫在 records 之前
+        self.failed = None          # 寫檔出錯後就不再收紀錄
+        self.writer = f"{os.getpid()}-{secrets.token_hex(4)}"
+        self.seg_no = 0
+        self.seg_size = 0           # 目前 segment 已分配的大小（含還在 buffer 裡的）
+        self.names = {}             # 目前 segment 的 名字 -> id
+        self._file = None
+        self._file_no = None
+        self._stop = threading.Event()
+        self._new_segment()
+        self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ===== 寫入（在遊戲迴圈裡呼叫，只做 pack + append）=====
+    def start_match(self, name_a: str, name_b: str, target_wins: int) -> int:
+        match_id = secrets.randbits(63)
+        with self.lock:
+            # 只在一場開始時換 segment，名字表才不會跟 START 分開
+            if self.seg_size >= self.segment_bytes:
+                self.seg_no += 1
+                self._new_segment()
+            id_a = self._name_id(name_a)
+            id_b = self._name_id(name_b)
+            self._put(START_REC.pack(KIND_START, 0, 0, 0, id_b, 0, target_wins, id_a, time.time(), match_id))
+        return match_id
+
+    def record_round(self, match_id, round_no, cards_a, cards_b, sum_a, sum_b, tied, winner_side, wins_a, wins_b):
+        flags = (FLAG_TIE if tied else 0) | (FLAG_B_WON if winner_side == "B" else 0)
+        rec = REC.pack(KIND_ROUND, round_no, rules.cards_to_mask(cards_a), rules.cards_to_mask(cards_b),
+                       sum_a, sum_b, flags, wins_a, wins_b, 0, 0, time.time(), match_id)
+        with self.lock:
+            self._put(rec)
+
+    def end_match(self, match_id, winner_side, wins_a, wins_b, rematch: bool):
+        flags = (FLAG_B_WON if winner_side == "B" else 0) | (FLAG_REMATCH if rematch else 0)
+        rec = REC.pack(KIND_END, 0, 0, 0, 0, 0, flags, wins_a, wins_b, 0, 0, time.time(), match_id)
+        with self.lock:
+            self._put(rec)
+
+    def close(self):
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout=5.0)
+        if self.failed is None:
+            self._flush_safe()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    # ===== 內部 =====
+    def _new_segment(self):
+        self.names = {}
+        self.seg_size = 0
+        self._put(HEADER_REC.pack(MAGIC, VERSION))
+
+    def _name_id(self, name: str) -> int:
+        nid = self.names.get(name)
+        if nid is None:
+            nid = self.names[name] = len(self.names) + 1
+            if self.failed is None:
+                self.pending_names.append((self.seg_no, nid, name))
+        return nid
+
+    def _put(self, rec: bytes):
+        if self.failed is None:
+            self.pending.append((self.seg_no, rec))
+        self.seg_size += REC_SIZE
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.fsync_interval):
+            if not self._flush_safe():
+                return
+
+    def _flush_safe(self) -> bool:
+        try:
+            self._flush()
+            return True
+        except Exception as e:
+            # 寫一半的 segment 不能接著寫（"xb" 重開會失敗），乾脆停掉，之後的紀錄直接丟
+            with self.lock:
+                self.failed = repr(e)
+                self.pending, self.pending_names = [], []
+            eventlog.error("journal_write", dir=str(self.dir), err=self.failed)
+            return False
+
+    def _flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+            names, self.pending_names = self.pending_names, []
+        for seg in sorted({n[0] for n in names}):
+            self._write_names(seg, [(nid, name) for s, nid, name in names if s == seg])
+        if not batch:
+            return
+        i = 0
+        while i < len(batch):
+            seg = batch[i][0]
+            j = i
+            while j < len(batch) and batch[j][0] == seg:
+                j += 1
+            self._write(seg, b"".join(rec for _, rec in batch[i:j]))
+            i = j
+
+    def _path(self, seg):
+        return self.dir / f"journal-{seg:06d}-{self.writer}.bin"
+
+    def _write_names(self, seg, entries):
+        with open(names_path(self._path(seg)), "a", encoding="utf-8") as f:
+            for nid, name in entries:
+                f.write(json.dumps({"id": nid, "name": name}, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write(self, seg, data):
+        if self._file_no != seg:
+            if self._file:
+                self._file.close()
+            # "x"：檔案已經存在就失敗，保證不會接在別人的 segment 後面
+            self._file = open(self._path(seg), "xb")
+            self._file_no = seg
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+# ===== 讀取 =====
+def segments(directory=JOURNAL_DIR):
+    return sorted(Path(directory).glob("journal-*.bin"))
+
+def names_path(path):
+    return Path(path).with_suffix(".names")
+
+def read_names(path) -> dict:
+    """segment 旁檔的名字表 {id: 名字}；最後一行寫一半就忽略。"""
+    out = {}
+    try:
+        with open(names_path(path), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                    out[int(row["id"])] = str(row["name"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except FileNotFoundError:
+        pass
+    return out
+
+def iter_records(directory=JOURNAL_DIR):
+    """逐筆讀出所有 segment 的紀錄（START 會帶名字）。"""
+    for path in segments(directory):
+        size = path.stat().st_size
+        if size < REC_SIZE:
+            continue
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if HEADER_REC.unpack_from(mm, 0)[0] != MAGIC:
+                raise ValueError(f"{path}: bad journal header")
+            names = read_names(path)
+            end = size - size % REC_SIZE    # 最後一筆寫一半就忽略
+            for off in range(REC_SIZE, end, REC_SIZE):
+                kind = mm[off]
+                if kind == KIND_NAME:
+                    _, nid, raw = NAME_REC.unpack_from(mm, off)
+                    names[nid] = raw.rstrip(b"\0").decode("utf-8", "replace")
+                elif kind == KIND_START:
+                    _, _, _, _, id_b, _, target, id_a, ts, mid = START_REC.unpack_from(mm, off)
+                    yield Record(kind, mid, ts, 0, 0, 0, 0, 0, 0, 0, 0, target,
+                                 names.get(id_a, "?"), names.get(id_b, "?"))
+                else:
+                    k, rnd, pa, pb, sa, sb, fl, wa, wb, _, _, ts, mid = REC.unpack_from(mm, off)
+                    yield Record(k, mid, ts, rnd, pa, pb, sa, sb, fl, wa, wb, 0, None, None)
+
+def numpy_dtype():
+    """欄位可以重疊（START/NAME 借用其他欄位的位置），numpy 直接 memmap 成結構化陣列。"""
+    import numpy as np
+    return np.dtype({
+        "names":   ["kind", "round", "play_a", "play_b", "sum_a", "sum_b", "flags", "wins_a", "wins_b",
+                    "target", "player_b", "aux", "ts", "match_id", "name"],
+        "formats": ["u1", "u1", "u1", "u1", "u1", "u1", "u1", "u1", "u1",
+                    "u1", "<u4", "<u4", "<f8", "<u8", "S16"],
+        "offsets": [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 4, 12, 16, 24, 16],
+        "itemsize": REC_SIZE,
+    })
+
+def load_segment(path):
+    """回傳整個 segment 的 numpy memmap（不含檔頭）。"""
+    import numpy as np
+    size = Path(path).stat().st_size
+    n = size // REC_SIZE - 1
+    if n <= 0:
+        return np.zeros(0, dtype=numpy_dtype())
+    return np.memmap(path, dtype=numpy_dtype(), mode="r", offset=REC_SIZE, shape=(n,))
+
+def segment_names(path, arr=None):
+    """segment 的名字表 {名字 id: 名字}：.names 旁檔，加上版本 1 segment 裡的 NAME 紀錄（arr 是 load_segment 的結果）。"""
+    names = read_names(path)
+    if arr is not None:
+        rows = arr[arr["kind"] == KIND_NAME]
+        for i, n in zip(rows["aux"].tolist(), rows["name"].tolist()):
+            names.setdefault(int(i), n.rstrip(b"\0").decode("utf-8", "replace"))
+    return names
+
+def main():
+    ap = argparse.ArgumentParser(description="Match journal tools")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("dump", help="print records")
+    p.add_argument("--dir", default=str(JOURNAL_DIR))
+    p = sub.add_parser("scan", help="count rounds/matches with numpy memmap")
+    p.add_argument("--dir", default=str(JOURNAL_DIR))
+    p = sub.add_parser("bench", help="write N synthetic rounds, then scan them")
+    p.add_argument("--dir", required=True)
+    p.add_argument("--rounds", type=int, default=1000000)
+    args = ap.parse_args()
+
+    if args.cmd == "dump":
+        for r in iter_records(args.dir):
+            if r.kind == KIND_START:
+                print(f"START {r.match_id:016x} {r.name_a} vs {r.name_b} target={r.target}")
+            elif r.kind == KIND_ROUND:
+                print(f"ROUND {r.match_id:016x} #{r.round} {rules.mask_to_cards(r.play_a)}={r.sum_a} "
+                      f"vs {rules.mask_to_cards(r.play_b)}={r.sum_b} flags={r.flags} {r.wins_a}:{r.wins_b}")
+            elif r.kind == KIND_END:
+                print(f"END   {r.match_id:016x} {r.wins_a}:{r.wins_b} flags={r.flags}")
+    elif args.cmd == "scan":
+        t0 = time.perf_counter()
+        rounds = matches = ties = 0
+        for path in segments(args.dir):
+            arr = load_segment(path)
+            kind = arr["kind"]
+            rounds += int((kind == KIND_ROUND).sum())
+            matches += int((kind == KIND_START).sum())
+            ties += int(((kind == KIND_ROUND) & (arr["flags"] & FLAG_TIE != 0)).sum())
+        print(f"{matches} matches, {rounds} rounds ({ties} ties) scanned in {time.perf_counter() - t0:.2f}s")
+    elif args.cmd == "bench":
+        j = MatchJournal(args.dir)
+        t0 = time.perf_counter()
+        mid = None
+        for i in range(args.rounds):
+            if i % 5 == 0:
+                mid = j.start_match("alice", "bob", 3)
+            j.record_round(mid, i % 5 + 1, [1, 2], [3], 3, 3, True, "A", 1, 0)
+        dt = time.perf_counter() - t0
+        j.close()
+        print(f"append: {dt / args.rounds * 1e6:.2f} us/round")
+
+if __name__ == "__main__":
+    main()
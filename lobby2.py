@@ -1,13 +1,26 @@
 import sqlite3
 import bcrypt
 import json
+import os
+import secrets
+import signal
 import socket
+import argparse
+import selectors
 import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 from datetime import datetime, timedelta, timezone
 
+import rules
+import ratings
+import presence
+import sampler
+import eventlog
+
 
 # ===== 時區與時間工具 =====
 TZ_TAIPEI = timezone(timedelta(hours=8))
@@ -19,19 +32,29 @@ def now_tz():
 DB_DIR = Path(__file__).resolve().parent / "storage"
 DB_DIR.mkdir(parents=True, exist_ok=True)
 DB_PATH = DB_DIR / "users.db"
+SNAPSHOT_PATH = DB_DIR / "sessions.snap"
 HOST = '140.113.17.11'
 def with_db():
     """
     每次呼叫回傳一個新的連線（thread-safe）。
     row_factory 設成 Row，方便以字典方式取欄位。
     """
-    conn = sqlite3.connect(DB_PATH)
+    # 多 worker 時會有別的 process 同時寫，等鎖而不是直接丟 database is locked
+    conn = sqlite3.connect(DB_PATH, timeout=10.0)
     conn.row_factory = sqlite3.Row
     return conn, conn.cursor()
 
+# PRAGMA user_version 記錄 schema 版本；跟 SCHEMA_VERSION 一樣就什麼都不用檢查
+SCHEMA_VERSION = 5
+
 def ensure_schema():
     conn, cur = with_db()
     try:
+        cur.execute("PRAGMA user_version")
+        if cur.fetchone()[0] == SCHEMA_VERSION:
+            return
+        # WAL：讀寫不互擋，多個 worker process 共用同一個 DB 檔時差很多（設定會存在 DB 檔裡）
+        cur.execute("PRAGMA journal_mode=WAL")
         # 使用者表
         cur.execute(
             """
@@ -52,10 +75,81 @@ def ensure_schema():
                 losses       INTEGER NOT NULL DEFAULT 0,
                 last_seen    TEXT NOT NULL,
                 online       INTEGER NOT NULL DEFAULT 0,
+                online_epoch INTEGER NOT NULL DEFAULT 0,
                 FOREIGN KEY(username) REFERENCES users(username) ON DELETE CASCADE
             )
             """
         )
+        # v1 -> v2：舊的 users_status 沒有 online_epoch
+        cur.execute("PRAGMA table_info(users_status)")
+        if "online_epoch" not in [r["name"] for r in cur.fetchall()]:
+            cur.execute("ALTER TABLE users_status ADD COLUMN online_epoch INTEGER NOT NULL DEFAULT 0")
+        # 只有一列的 server 世代表
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS server_state (
+                id    INTEGER PRIMARY KEY CHECK (id = 1),
+                epoch INTEGER NOT NULL
+            )
+            """
+        )
+        cur.execute("INSERT OR IGNORE INTO server_state (id, epoch) VALUES (1, 0)")
+        # v3：還沒等到對方確認的勝負回報（積分要雙方說法一致才算）
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS match_reports (
+                winner   TEXT NOT NULL,
+                loser    TEXT NOT NULL,
+                reporter TEXT NOT NULL,
+                ts       REAL NOT NULL,
+                link     TEXT,
+                summary  TEXT
+            )
+            """
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS match_reports_pair ON match_reports (winner, loser)")
+        # v3 -> v4：回報順便帶的連線品質（JSON），等對方確認了才寫進 link_stats
+        cur.execute("PRAGMA table_info(match_reports)")
+        cols = [r["name"] for r in cur.fetchall()]
+        if "link" not in cols:
+            cur.execute("ALTER TABLE match_reports ADD COLUMN link TEXT")
+        # v4 -> v5：回報順便帶的這場出牌摘要（tt.match_summary，JSON）
+        if "summary" not in cols:
+            cur.execute("ALTER TABLE match_reports ADD COLUMN summary TEXT")
+        # v4：連線品質 EWMA，每人一列（b = ''）、每一對一列（a < b）
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS link_stats (
+                a          TEXT NOT NULL,
+                b          TEXT NOT NULL,
+                rtt_ms     REAL NOT NULL,
+                rtt_min_ms REAL NOT NULL,
+                matches    INTEGER NOT NULL DEFAULT 0,
+                stalls     INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (a, b)
+            )
+            """
+        )
+        # v5：雙方都確認過的對戰，一場一列（analytics 的 player_stats 從這裡算）；
+        # w_* / l_* 是贏家 / 輸家自己回報的摘要，沒帶就是 NULL
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS match_history (
+                id       INTEGER PRIMARY KEY AUTOINCREMENT,
+                ts       REAL NOT NULL,
+                winner   TEXT NOT NULL,
+                loser    TEXT NOT NULL,
+                w_first  INTEGER,
+                w_rounds INTEGER,
+                w_sum    INTEGER,
+                l_first  INTEGER,
+                l_rounds INTEGER,
+                l_sum    INTEGER,
+                rematch  INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
         conn.commit()
     finally:
         cur.close()
@@ -65,34 +159,275 @@ def ensure_schema():
 PLAYER_NUM = 0
 player_lock = threading.Lock()
 
-active_sessions = {}   # username -> {"conn": socket, "last_seen": ts}
-sessions_lock = threading.Lock()
+# username -> Session(conn, last_seen)，依名字分 shard 上鎖，心跳不會全部擠在同一把鎖
+SESSIONS = presence.SessionRegistry()
+
+# 多 worker 模式（start_cluster）：上線表改放在 fork 前建好的共享記憶體，
+# 所有 worker 看同一份，重複登入才擋得住。單一 process 時維持 None，用上面的 SESSIONS。
+PRESENCE = None
 
 HEARTBEAT_TTL = 15  # 秒
 
+# ===== 心跳間隔（跟 client 協商）=====
+# client 平常只送 ping（只更新記憶體裡的 last_seen），ping/status_report 帶著它目前用的間隔 hb，
+# 跟 HB["interval"] 不一樣才回 {"type": "HEARTBEAT", "interval": ...}。
+# 每 10 秒看一次這個 process 的請求量，超過 HB_TARGET_RPS 就把間隔拉長（最多 HB_MAX），
+# 負載降下來、而且拉長後撐過 HB_MAX 秒才縮回去。
+# 存活判斷的 ttl 跟著間隔走（至少 3 個間隔）；縮短間隔時 ttl 晚一點才縮，讓還在用舊間隔的 client 不被誤判離線。
+HB_BASE = 5.0
+HB_MAX = 30.0
+HB_TARGET_RPS = 5000
+HB = {"interval": HB_BASE, "ttl": float(HEARTBEAT_TTL), "requests": 0, "changed_at": 0.0, "ttl_until": 0.0}
+
+def adapt_heartbeat(elapsed: float):
+    now = time.time()
+    rps = HB["requests"] / elapsed if elapsed > 0 else 0.0
+    HB["requests"] = 0
+    want = min(HB_MAX, max(HB_BASE, round(HB_BASE * rps / HB_TARGET_RPS)))
+    old = HB["interval"]
+    if want > old or (want < old and now - HB["changed_at"] >= HB_MAX):
+        HB["interval"] = float(want)
+        HB["changed_at"] = now
+        if want > old:
+            HB["ttl"] = max(float(HEARTBEAT_TTL), 3.0 * want)
+        else:
+            HB["ttl_until"] = now + old     # 舊間隔的 client 最晚 old 秒後會收到新間隔
+        eventlog.info("heartbeat_interval", rps=round(rps), old=old, new=want)
+    if HB["ttl_until"] and now >= HB["ttl_until"]:
+        HB["ttl"] = max(float(HEARTBEAT_TTL), 3.0 * HB["interval"])
+        HB["ttl_until"] = 0.0
+
+# ===== 省記憶體模式（--low-mem）=====
+# 目標是大量閒置連線。預設模式一條連線一個執行緒，閒置時每條大約 17 KB RSS
+# （執行緒 stack 碰到的頁面 + 直譯器的 thread state / frame stack），5 萬條就接近 1 GB。
+# --low-mem 改成：
+#   - 不開 per-connection 執行緒：一個 selector 執行緒等所有連線可讀，
+#     收到的請求交給固定 pool_size 個執行緒處理（serve_reactor），閒置連線只剩 socket + ConnState
+#   - pool 執行緒的 stack 設成 stack_kb（handle_message 呼叫深度很淺）
+#   - 連線的 kernel 收送 buffer 縮成 sockbuf bytes（lobby 訊息都是一兩百 bytes）
+#   - 開檔上限拉到 hard limit
+# 其他本來就省的：session 是 __slots__ 的 Session、每次 recv 只拿 1024 bytes、
+# DB 連線在請求需要時才開、用完就關（閒置連線不會握著 sqlite handle）。
+# send_timeout：reactor 的連線 sendall 最多等這麼久，不讀回覆的 client 不會把 pool 執行緒卡死
+LOW_MEM = {"on": False, "stack_kb": 256, "sockbuf": 8192, "pool": 32, "send_timeout": 5.0}
+
+def configure_low_memory(stack_kb=256, sockbuf=8192, pool=32):
+    """要在開任何連線處理執行緒之前呼叫。"""
+    import resource
+    LOW_MEM.update(on=True, stack_kb=stack_kb, sockbuf=sockbuf, pool=pool)
+    threading.stack_size(stack_kb * 1024)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    # 連線上限跟著 fd 上限走，留一些給 DB、log 之類的
+    ADMIT["max_conns"] = max(hard - 64, 64)
+    eventlog.info("low_memory", stack_kb=stack_kb, sockbuf=sockbuf, pool=pool, nofile=hard)
+
+# 積分表：記憶體裡增量更新，背景批次寫回 users_rating
+RATINGS = ratings.RatingTable(with_db)
+
+# ===== 勝負確認 =====
+# status_report 是 client 自己說的；積分只在兩邊說法一致時才動：
+# 贏家回報「我贏了 X」，而 X 在 RESULT_WINDOW 秒內也回報「我輸給了他」（先到的那份存在 match_reports 等另一份）。
+# 回報者必須是這條連線登入的帳號，對手必須是註冊過、目前在線的玩家。存在 DB，cluster 模式下不同 worker 也對得起來。
+RESULT_WINDOW = 120.0
+
+def user_exists(username: str) -> bool:
+    conn, cur = with_db()
+    try:
+        cur.execute("SELECT 1 FROM users WHERE username=?", (username,))
+        return cur.fetchone() is not None
+    finally:
+        cur.close()
+        conn.close()
+
+def confirm_result(reporter: str, opponent: str, won: bool, link=None, summary=None) -> bool:
+    """記下 reporter 這一方的說法；對方已經回報過一致的結果就回 True（這場可以算積分），
+    兩邊帶的 link / match 摘要也在這時才寫進 link_stats / match_history。"""
+    winner, loser = (reporter, opponent) if won else (opponent, reporter)
+    mine = link_sample(link)
+    my_match = match_sample(summary)
+    now = time.time()
+    conn, cur = with_db()
+    try:
+        cur.execute("BEGIN IMMEDIATE")
+        cur.execute("DELETE FROM match_reports WHERE ts < ?", (now - RESULT_WINDOW,))
+        cur.execute("SELECT rowid, link, summary FROM match_reports "
+                    "WHERE winner=? AND loser=? AND reporter=? ORDER BY ts LIMIT 1",
+                    (winner, loser, opponent))
+        row = cur.fetchone()
+        if row:
+            cur.execute("DELETE FROM match_reports WHERE rowid=?", (row[0],))
+            # 存之前就過過 link_sample / match_sample 了
+            theirs = json.loads(row["link"]) if row["link"] else None
+            record_match_link(cur, reporter, mine, opponent, theirs)
+            their_match = json.loads(row["summary"]) if row["summary"] else None
+            if won:
+                record_match(cur, now, winner, loser, my_match, their_match)
+            else:
+                record_match(cur, now, winner, loser, their_match, my_match)
+        else:
+            cur.execute("INSERT INTO match_reports (winner, loser, reporter, ts, link, summary) VALUES (?, ?, ?, ?, ?, ?)",
+                        (winner, loser, reporter, now, json.dumps(mine) if mine else None,
+                         json.dumps(my_match) if my_match else None))
+        conn.commit()
+        return row is not None
+    finally:
+        cur.close()
+        conn.close()
+
+# ===== 對戰紀錄（player_stats）=====
+# 對戰的細節（出牌、回合）只有兩邊的 client 知道，journal 也是寫在主機端玩家自己的機器上；
+# 所以兩邊 GAME_OVER 的 status_report 各帶一份自己的摘要（tt.match_summary），
+# 跟積分一樣等雙方確認了才寫一列 match_history，analytics 從這張表增量算 player_stats。
+
+def match_sample(summary):
+    """status_report 的 match -> {"first", "rounds", "card_sum", "rematch"}；格式不對回 None。"""
+    if not isinstance(summary, dict):
+        return None
+    try:
+        first, rounds, card_sum = (int(summary.get(k, 0)) for k in ("first", "rounds", "card_sum"))
+    except (TypeError, ValueError):
+        return None
+    if not ((first == 0 or first in rules.ALL_PLAYS) and 0 <= rounds <= rules.NUM_CARDS
+            and 0 <= card_sum <= rules.MASK_SUM[rules.FULL_HAND]):
+        return None
+    return {"first": first, "rounds": rounds, "card_sum": card_sum, "rematch": bool(summary.get("rematch"))}
+
+def record_match(cur, ts, winner: str, loser: str, w, l):
+    """寫一列 match_history；w / l 是贏家 / 輸家的 match_sample（可能是 None）。呼叫端負責交易。"""
+    said = [x["rematch"] for x in (w, l) if x]
+    rematch = int(bool(said) and all(said))     # 兩邊都有帶就要兩邊都說是 rematch
+    w, l = w or {}, l or {}
+    cur.execute(
+        "INSERT INTO match_history (ts, winner, loser, w_first, w_rounds, w_sum, l_first, l_rounds, l_sum, rematch) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (ts, winner, loser, w.get("first"), w.get("rounds"), w.get("card_sum"),
+         l.get("first"), l.get("rounds"), l.get("card_sum"), rematch))
+
+# ===== 對戰連線品質 =====
+# 兩邊 GAME_OVER 的 status_report 會帶 "link"（tt.LinkStats.summary()：PING/PONG 量到的 RTT），
+# 每人、每一對各留一個 EWMA，配對時可以先挑 RTT 低的。
+# 跟積分一樣只收雙方都確認過的那場（confirm_result 裡寫），對手是亂填的名字就不會留下任何資料；
+# 存在 DB 的 link_stats，cluster 模式下所有 worker 看同一份，重開也還在。
+LINK_ALPHA = 0.3
+LINK_MAX_MS = 60000.0   # 超過一分鐘的 RTT 不可能是真的量到的
+
+def link_sample(link):
+    """status_report 的 link -> 要存的 {"rtt_ms", "rtt_min_ms", "stalls"}；沒量到或數字不合理回 None。"""
+    if not isinstance(link, dict) or not link.get("samples"):
+        return None     # 舊版對手不回 PING，或一場太短沒量到
+    try:
+        rtt = float(link["rtt_ms"])
+        rtt_min = float(link.get("rtt_min_ms", rtt))
+        stalls = int(link.get("stalls", 0))
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (0.0 <= rtt <= LINK_MAX_MS and 0.0 <= rtt_min <= LINK_MAX_MS and 0 <= stalls <= 1000):
+        return None     # NaN 也會在這裡被擋掉
+    return {"rtt_ms": rtt, "rtt_min_ms": rtt_min, "stalls": stalls}
+
+def record_link(cur, a: str, b: str, sample):
+    """把一筆 sample 併進 link_stats 的 (a, b) 那列；呼叫端負責交易。"""
+    cur.execute("SELECT rtt_ms, rtt_min_ms FROM link_stats WHERE a=? AND b=?", (a, b))
+    row = cur.fetchone()
+    if row is None:
+        cur.execute("INSERT INTO link_stats (a, b, rtt_ms, rtt_min_ms, matches, stalls) VALUES (?, ?, ?, ?, 1, ?)",
+                    (a, b, sample["rtt_ms"], sample["rtt_min_ms"], sample["stalls"]))
+    else:
+        cur.execute("UPDATE link_stats SET rtt_ms=?, rtt_min_ms=?, matches=matches+1, stalls=stalls+? WHERE a=? AND b=?",
+                    (row["rtt_ms"] + LINK_ALPHA * (sample["rtt_ms"] - row["rtt_ms"]),
+                     min(row["rtt_min_ms"], sample["rtt_min_ms"]), sample["stalls"], a, b))
+
+def record_match_link(cur, user: str, mine, peer: str, theirs):
+    # 每個人記自己量到的；這一對兩邊量的是同一條線，合成一筆（平均 RTT、最小的 min、多的那邊的 stall 數）
+    for who, sample in ((user, mine), (peer, theirs)):
+        if sample:
+            record_link(cur, who, "", sample)
+    both = [x for x in (mine, theirs) if x]
+    if both:
+        a, b = sorted((user, peer))
+        record_link(cur, a, b, {
+            "rtt_ms": sum(x["rtt_ms"] for x in both) / len(both),
+            "rtt_min_ms": min(x["rtt_min_ms"] for x in both),
+            "stalls": max(x["stalls"] for x in both),
+        })
+
+LINK_PEERS_MAX = 50     # link_stats 一次最多查幾個對手
+
+def link_quality(user: str, peers=()):
+    """-> (user 自己的平均, {peer: 這一對的平均})，沒資料的是 None / 不列出。"""
+    cols = "rtt_ms, rtt_min_ms, matches, stalls"
+    conn, cur = with_db()
+    try:
+        cur.execute(f"SELECT {cols} FROM link_stats WHERE a=? AND b=''", (user,))
+        row = cur.fetchone()
+        mine = dict(row) if row else None
+        pairs = {}
+        for p in list(peers)[:LINK_PEERS_MAX]:
+            if not p or p == user:
+                continue
+            a, b = sorted((user, p))
+            cur.execute(f"SELECT {cols} FROM link_stats WHERE a=? AND b=?", (a, b))
+            row = cur.fetchone()
+            if row:
+                pairs[p] = dict(row)
+        return mine, pairs
+    finally:
+        cur.close()
+        conn.close()
+
 # ===== Session/狀態維護 =====
 def cleanup_inactive_sessions():
+    last_contended = 0
+    last_admit = dict(ADMIT_STATS)
     while True:
         time.sleep(10)
-        now = time.time()
-        with sessions_lock:
-            inactive = [
-                user for user, sess in active_sessions.items()
-                if now - sess["last_seen"] > HEARTBEAT_TTL
-            ]
+        adapt_heartbeat(10)
+        prune_auth_buckets()
+        if any(ADMIT_STATS[k] != last_admit[k] for k in ("rejected_conns", "busy", "rate_limited")):
+            eventlog.warn("admission", inflight_cap=ADMIT["max_inflight"], conn_cap=ADMIT["max_conns"], **ADMIT_STATS)
+        last_admit = dict(ADMIT_STATS)
+        if PRESENCE is not None:
+            # 每個 worker 只清自己登記的，避免同一個人被清好幾次
+            inactive = PRESENCE.expired(HB["ttl"], os.getpid())
+        else:
+            inactive = SESSIONS.expired(HB["ttl"])
+            st = SESSIONS.stats()
+            if st["contended"] > last_contended:
+                eventlog.info("session_locks", **st)
+                last_contended = st["contended"]
         for user in inactive:
-            print(f"[CLEANUP] {user} inactive, marking offline.")
+            eventlog.info("inactive", user=user)
             mark_offline(user)
             clear_active(user)
 
-def reset_all_online_flags():
+# ===== 上線旗標的世代（epoch）=====
+# 每次開 server 把 server_state.epoch 加一；users_status.online 只有在 online_epoch 等於目前 epoch 時才算數，
+# 上一次執行留下來的 online=1 自動失效，開機不用再把整張表 UPDATE 成 0。
+EPOCH = 0
+
+def read_epoch() -> int:
     conn, cur = with_db()
     try:
-        cur.execute("UPDATE users_status SET online = 0")
+        cur.execute("SELECT epoch FROM server_state WHERE id = 1")
+        return int(cur.fetchone()[0])
+    finally:
+        cur.close()
+        conn.close()
+
+def bump_epoch() -> int:
+    global EPOCH
+    conn, cur = with_db()
+    try:
+        cur.execute("UPDATE server_state SET epoch = epoch + 1 WHERE id = 1")
+        cur.execute("SELECT epoch FROM server_state WHERE id = 1")
+        EPOCH = int(cur.fetchone()[0])
         conn.commit()
     finally:
         cur.close()
         conn.close()
+    return EPOCH
 
 def mark_offline(username: str):
     conn, cur = with_db()
@@ -111,6 +446,9 @@ def normalize_status(row: Optional[sqlite3.Row]):
         return None
     out = dict(row)
     # last_seen 已經是 ISO8601 字串，直接回傳即可
+    # 舊世代留下的 online=1 不算
+    epoch = out.pop("online_epoch", None)
+    out["online"] = 1 if out.get("online") and epoch == EPOCH else 0
     return out
 
 def get_status(username: str):
@@ -153,10 +491,11 @@ def update_status(username: str, delta=None, online=None):
         wins   = int(row["wins"])   + int(delta.get("wins", 0))
         losses = int(row["losses"]) + int(delta.get("losses", 0))
         on     = int(row["online"]) if online is None else (1 if online else 0)
+        epoch  = int(row["online_epoch"]) if online is None else EPOCH
 
         cur.execute(
-            "UPDATE users_status SET wins=?, losses=?, last_seen=?, online=? WHERE username=?",
-            (wins, losses, now_tz(), on, username),
+            "UPDATE users_status SET wins=?, losses=?, last_seen=?, online=?, online_epoch=? WHERE username=?",
+            (wins, losses, now_tz(), on, epoch, username),
         )
         conn.commit()
     finally:
@@ -170,16 +509,16 @@ def inc_login_count_and_online(username: str):
         row = cur.fetchone()
         if not row:
             cur.execute(
-                "INSERT INTO users_status (username, login_count, wins, losses, last_seen, online) "
-                "VALUES (?, 1, 0, 0, ?, 1)",
-                (username, now_tz()),
+                "INSERT INTO users_status (username, login_count, wins, losses, last_seen, online, online_epoch) "
+                "VALUES (?, 1, 0, 0, ?, 1, ?)",
+                (username, now_tz(), EPOCH),
             )
         else:
             cur.execute(
                 "UPDATE users_status "
-                "SET login_count=login_count+1, online=1, last_seen=? "
+                "SET login_count=login_count+1, online=1, online_epoch=?, last_seen=? "
                 "WHERE username=?",
-                (now_tz(), username),
+                (EPOCH, now_tz(), username),
             )
         conn.commit()
     finally:
@@ -187,171 +526,846 @@ def inc_login_count_and_online(username: str):
         conn.close()
 
 def is_active(username: str) -> bool:
-    with sessions_lock:
-        sess = active_sessions.get(username)
-        if not sess:
-            return False
-        return (time.time() - sess["last_seen"]) <= HEARTBEAT_TTL
+    if PRESENCE is not None:
+        return PRESENCE.is_active(username, HB["ttl"])
+    return SESSIONS.is_active(username, HB["ttl"])
 
 def set_active(username: str, conn_sock: socket.socket):
-    with sessions_lock:
-        active_sessions[username] = {"conn": conn_sock, "last_seen": time.time()}
+    if PRESENCE is not None:
+        PRESENCE.set(username, os.getpid())
+        return
+    SESSIONS.set(username, conn_sock)
+
+def claim_active(username: str, conn_sock: socket.socket, token=None) -> bool:
+    """is_active + set_active 在同一把鎖裡做完；已經有人在線就回 False。"""
+    if PRESENCE is not None:
+        return PRESENCE.claim(username, os.getpid(), HB["ttl"])
+    return SESSIONS.claim(username, conn_sock, HB["ttl"], token)
+
+def resume_active(username: str, token, conn_sock: socket.socket) -> bool:
+    """重連用 resume token 接回 session（只有單一 process 模式有）。"""
+    if PRESENCE is not None or not username:
+        return False
+    return SESSIONS.resume(username, token, conn_sock)
 
 def refresh_active(username: str):
-    with sessions_lock:
-        sess = active_sessions.get(username)
-        if sess:
-            sess["last_seen"] = time.time()
+    if PRESENCE is not None:
+        PRESENCE.refresh(username)
+        return
+    SESSIONS.refresh(username)
 
-def clear_active(username: str):
-    with sessions_lock:
-        if username in active_sessions:
-            del active_sessions[username]
+def clear_active(username: str, conn_sock=None) -> bool:
+    if PRESENCE is not None:
+        return PRESENCE.release(username)
+    return SESSIONS.release(username, conn_sock)
+
+# ===== 熱重啟：session snapshot =====
+# 正常關機（SIGTERM / Ctrl+C）時把有 resume token 的 session 存到 SNAPSHOT_PATH，不標離線；
+# 下次開機如果 DB 的 epoch 沒被別人動過，就沿用同一個 epoch（DB 裡的上線旗標繼續有效）並還原 session，
+# client 用 {"action": "resume", "token": ...} 重連，不跑 bcrypt、不寫 DB。
+# 在 ttl 內沒接回來的 session 由 cleanup 照常標離線。
+SHUTTING = {"on": False}
+
+def load_warm_snapshot() -> bool:
+    global EPOCH
+    snap = presence.load_snapshot(SNAPSHOT_PATH)
+    try:
+        SNAPSHOT_PATH.unlink()
+    except FileNotFoundError:
+        pass
+    if not snap:
+        return False
+    epoch, saved_at, items = snap
+    if epoch != read_epoch():
+        eventlog.warn("stale_snapshot", epoch=epoch)
+        return False
+    EPOCH = epoch
+    SESSIONS.restore(items)
+    eventlog.info("warm_start", epoch=epoch, sessions=len(items), down_s=round(time.time() - saved_at, 1))
+    return True
+
+def shutdown(signum=None, frame=None):
+    SHUTTING["on"] = True
+    items = SESSIONS.snapshot()
+    presence.save_snapshot(SNAPSHOT_PATH, EPOCH, items)
+    try:
+        RATINGS.close()
+    except Exception as e:
+        eventlog.error("rating_flush", err=repr(e))
+    eventlog.info("shutdown", sessions=len(items), snapshot=SNAPSHOT_PATH)
+    raise SystemExit(0)
+
+# ===== 過載保護（admission control）=====
+# - 同時連線數上限 max_conns：超過的新連線回一句 SERVER_BUSY 就關掉，不開執行緒、不進 reactor
+# - 處理中的請求上限 max_inflight：bcrypt、DB 這些慢的工作同時最多這麼多個，擠不進去的請求馬上回 SERVER_BUSY
+# - login / register 每個 IP 一個 token bucket（每秒補 auth_rate 個，最多存 auth_burst 個），
+#   用完回 LOGIN_FAILED_RATE_LIMITED / REGISTER_FAILED_RATE_LIMITED
+# 計數器在 cleanup 執行緒裡有變動才印（跟 SESSIONS 的統計一樣）。
+ADMIT = {"max_conns": 4096, "max_inflight": 64, "auth_rate": 1.0, "auth_burst": 5}
+ADMIT_STATS = {"accepted": 0, "rejected_conns": 0, "busy": 0, "rate_limited": 0}   # 估計值，不上鎖
+INFLIGHT = {"sem": threading.BoundedSemaphore(ADMIT["max_inflight"])}
+LOSSLESS_ACTIONS = ("status_report", "logout")
+AUTH_BUCKETS = {}       # ip -> [tokens, 上次補充的時間]
+auth_lock = threading.Lock()
+
+def configure_admission(max_conns=None, max_inflight=None, auth_rate=None, auth_burst=None):
+    if max_conns is not None:
+        ADMIT["max_conns"] = max_conns
+    if max_inflight is not None:
+        ADMIT["max_inflight"] = max_inflight
+        INFLIGHT["sem"] = threading.BoundedSemaphore(max_inflight)
+    if auth_rate is not None:
+        ADMIT["auth_rate"] = auth_rate
+    if auth_burst is not None:
+        ADMIT["auth_burst"] = auth_burst
+
+def admit_conn(conn: socket.socket) -> bool:
+    """
+    accept 之後馬上呼叫；滿了就回 SERVER_BUSY 並關掉連線。
+    名額在這裡就先佔掉（PLAYER_NUM 加一），之後 open_client(admitted=True) 不再重加；
+    不然一波 accept 在新執行緒開始跑之前全部都會通過檢查。
+    """
+    global PLAYER_NUM
+    with player_lock:
+        full = PLAYER_NUM >= ADMIT["max_conns"]
+        if not full:
+            PLAYER_NUM += 1
+    if not full:
+        ADMIT_STATS["accepted"] += 1
+        return True
+    ADMIT_STATS["rejected_conns"] += 1
+    try:
+        conn.setblocking(False)
+        conn.send(b"SERVER_BUSY")
+    except OSError:
+        pass
+    conn.close()
+    return False
+
+def take_auth_token(ip) -> bool:
+    now = time.monotonic()
+    with auth_lock:
+        b = AUTH_BUCKETS.get(ip)
+        if b is None:
+            b = AUTH_BUCKETS[ip] = [float(ADMIT["auth_burst"]), now]
+        b[0] = min(float(ADMIT["auth_burst"]), b[0] + (now - b[1]) * ADMIT["auth_rate"])
+        b[1] = now
+        if b[0] < 1.0:
+            ADMIT_STATS["rate_limited"] += 1
+            return False
+        b[0] -= 1.0
+        return True
+
+def prune_auth_buckets():
+    """已經補滿的 bucket 跟新建的一樣，刪掉免得 dict 一直長。"""
+    now = time.monotonic()
+    full_after = ADMIT["auth_burst"] / ADMIT["auth_rate"] if ADMIT["auth_rate"] > 0 else float("inf")
+    with auth_lock:
+        for ip in [ip for ip, b in AUTH_BUCKETS.items() if now - b[1] >= full_after]:
+            del AUTH_BUCKETS[ip]
+
+# ===== Profiler（平常不開）=====
+# TT_PROFILE=49 開機就開始取樣（數字是 Hz，0 = 預設）；或
+#   kill -USR1 <pid>：沒在取樣就取樣 PROFILE_WINDOW 秒後自動寫檔，正在取樣就立刻把目前累計的寫出來
+#   本機連線送 {"action": "profile", "cmd": "start" | "stop" | "dump" | "stats", "hz": 49}
+# 檔案寫到 storage/profiles/*.folded（flamegraph.pl / speedscope 直接吃），python sampler.py top 看摘要。
+PROFILER = sampler.StackSampler()
+PROFILE_WINDOW = 30.0
+
+def dump_profile():
+    path = PROFILER.dump()
+    eventlog.info("profile_dump", path=path, **PROFILER.stats())
+    return path
+
+def _profile_window(secs):
+    PROFILER.reset()
+    PROFILER.start()
+    time.sleep(secs)
+    PROFILER.stop()
+    dump_profile()
+
+def _on_sigusr1(signum, frame):
+    # signal handler 只開執行緒，寫檔不在這裡做
+    if PROFILER.running:
+        threading.Thread(target=dump_profile, daemon=True).start()
+    else:
+        threading.Thread(target=_profile_window, args=(PROFILE_WINDOW,), daemon=True).start()
+
+def start_profiler():
+    signal.signal(signal.SIGUSR1, _on_sigusr1)
+    hz = os.environ.get("TT_PROFILE")
+    if hz:
+        PROFILER.start(int(hz) or sampler.DEFAULT_HZ)
+        eventlog.info("profiler_start", hz=PROFILER.hz)
 
 # ===== 連線處理 =====
-def handle_client(conn: socket.socket, addr):
+class ConnState:
+    """一條 lobby 連線的狀態；執行緒模式與 reactor 模式共用。"""
+    __slots__ = ("conn", "addr", "username_bound")
+
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.username_bound = None
+
+CLIENTS = set()     # 目前所有連線的 ConnState（熱升級時要整批交出去），用 player_lock 保護
+
+def release_slot():
+    """admit_conn 佔了名額、卻沒走到 open_client 就關掉的連線用。"""
     global PLAYER_NUM
     with player_lock:
-        PLAYER_NUM += 1
+        PLAYER_NUM -= 1
+
+def open_client(conn: socket.socket, addr, admitted=False) -> ConnState:
+    global PLAYER_NUM
+    st = ConnState(conn, addr)
+    with player_lock:
+        if not admitted:
+            PLAYER_NUM += 1
         current_players = PLAYER_NUM
-    print(f"[+] Player connected from {addr}")
-    print(f"[LOBBY SERVER] Current players: {current_players}")
+        CLIENTS.add(st)
+    eventlog.info("connect", addr=addr, players=current_players)
+    return st
+
+def close_client(st: ConnState):
+    global PLAYER_NUM
+    # 連線關閉，若還綁定使用者，清 session 與標記離線（避免殭屍 session）
+    # 關機中不動（session 會存進 snapshot）；session 已經被 resume 到別條連線也不動
+    if st.username_bound and not SHUTTING["on"]:
+        if clear_active(st.username_bound, st.conn):
+            mark_offline(st.username_bound)
+
+    try:
+        st.conn.close()
+    finally:
+        with player_lock:
+            PLAYER_NUM -= 1
+            current_players = PLAYER_NUM
+            CLIENTS.discard(st)
+        eventlog.info("disconnect", addr=st.addr, user=st.username_bound, players=current_players)
+
+def handle_message(st: ConnState, data: str):
+    # client 用的是「每次 send 一個 JSON」，這裡沿用一次解析一個
+    conn = st.conn
+    try:
+        msg = json.loads(data)
+    except Exception as e:
+        eventlog.warn("bad_json", addr=st.addr, err=str(e), raw=data[:200])
+        return
+
+    action   = msg.get("action")
+    username = msg.get("username")
+    password = msg.get("password")
+    HB["requests"] += 1     # 估計值，多執行緒下少算幾次沒關係
+
+    if username:
+        refresh_active(username)
+
+    # client 目前的心跳間隔跟 lobby 要的不一樣就告訴它
+    hb = msg.get("hb")
+    if hb is not None and hb != HB["interval"]:
+        conn.sendall(json.dumps({"type": "HEARTBEAT", "interval": HB["interval"]}).encode("utf-8"))
+
+    if action == "ping":
+        # 心跳快速路徑：上面的 refresh_active 就是全部，不碰 DB
+        return
+
+    if action in ("register", "login") and not take_auth_token(st.addr[0]):
+        conn.sendall(f"{action.upper()}_FAILED_RATE_LIMITED".encode("utf-8"))
+        return
+    # 長度上限只是 SharedPresence 每格的大小：註冊一律擋（新帳號兩種模式都能用），
+    # 登入只有 cluster 模式才擋，單一 process 時舊的長名字帳號照樣能登入
+    if action in ("register", "login") and not valid_username(username, action == "register" or PRESENCE is not None):
+        conn.sendall(f"{action.upper()}_FAILED_BAD_NAME".encode("utf-8"))
+        return
+
+    # 處理中的請求有上限：一般請求拿不到名額就馬上回 SERVER_BUSY；
+    # 丟了會掉資料的（戰績回報、登出）則排隊等名額
+    if action in LOSSLESS_ACTIONS:
+        INFLIGHT["sem"].acquire()
+    elif not INFLIGHT["sem"].acquire(blocking=False):
+        ADMIT_STATS["busy"] += 1
+        conn.sendall(b"SERVER_BUSY")
+        return
+    try:
+        dispatch(st, msg, action, username, password)
+    finally:
+        INFLIGHT["sem"].release()
+
+def valid_username(username, limit_len=True) -> bool:
+    # 共享上線表每格只放得下 MAX_NAME_BYTES；截斷的話兩個共用前綴的長名字會互相擋登入
+    return (isinstance(username, str) and username != ""
+            and (not limit_len or len(username.encode("utf-8")) <= presence.MAX_NAME_BYTES))
+
+def dispatch(st: ConnState, msg, action, username, password):
+    conn = st.conn
+    if action == "register":
+        try:
+            conn_db, cursor = with_db()
+            cursor.execute("SELECT 1 FROM users WHERE username=?", (username,))
+            if cursor.fetchone():
+                conn.sendall(b"REGISTER_FAILED_USER_EXISTS")
+            else:
+                hashed_pw = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
+                cursor.execute(
+                    "INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
+                    (username, hashed_pw.decode(), now_tz())
+                )
+                conn_db.commit()
+                _ = get_status(username)  # 確保 users_status 也建好
+                conn.sendall(b"REGISTER_SUCCESS")
+        except Exception as e:
+            eventlog.error("register", user=username, err=repr(e))
+            conn.sendall(b"REGISTER_FAILED")
+        finally:
+            try:
+                cursor.close(); conn_db.close()
+            except:
+                pass
+
+    elif action == "login":
+        try:
+            conn_db, cursor = with_db()
+            cursor.execute("SELECT username, password_hash FROM users WHERE username=?", (username,))
+            user = cursor.fetchone()
+            if not user:
+                conn.sendall(b"LOGIN_FAILED_NO_USER")
+            elif not bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode()):
+                conn.sendall(b"LOGIN_FAILED_WRONG_PASSWORD")
+            else:
+                # 重複登入策略：拒絕新連線
+                token = secrets.token_hex(16) if PRESENCE is None else None
+                if not claim_active(username, conn, token):
+                    conn.sendall(b"LOGIN_FAILED_DUPLICATE")
+                else:
+                    st.username_bound = username
+                    inc_login_count_and_online(username)
+                    status = normalize_status(get_status(username))
+                    resp = {"type": "LOGIN_SUCCESS", "status": status, "heartbeat": HB["interval"]}
+                    if token:
+                        resp["resume"] = token
+                    conn.sendall(json.dumps(resp).encode("utf-8"))
+        except Exception as e:
+            eventlog.error("login", user=username, err=repr(e))
+            conn.sendall(b"LOGIN_FAILED")
+        finally:
+            try:
+                cursor.close(); conn_db.close()
+            except:
+                pass
+
+    elif action == "status_report":
+        try:
+            status = msg.get("status", {})  # wins_delta / losses_delta / in_game...
+            delta = {
+                "wins":   int(status.get("wins_delta", 0)),
+                "losses": int(status.get("losses_delta", 0)),
+            }
+            update_status(username, delta=delta, online=True)
+            refresh_active(username)
+            # 雙方都會回報；積分要等兩邊說法一致（見 confirm_result），一場只算一次
+            opponent = status.get("opponent")
+            decided = delta["wins"] + delta["losses"] == 1
+            if (decided and isinstance(opponent, str) and opponent != username
+                    and st.username_bound == username and is_active(opponent) and user_exists(opponent)):
+                won = delta["wins"] == 1
+                if confirm_result(username, opponent, won, msg.get("link"), msg.get("match")):
+                    if won:
+                        RATINGS.record(username, opponent)
+                    else:
+                        RATINGS.record(opponent, username)
+        except Exception as e:
+            eventlog.error("status_report", user=username, err=repr(e))
+
+    elif action == "rating":
+        target = msg.get("target") or username
+        rating, games = RATINGS.get(target)
+        resp = {"type": "RATING", "username": target, "rating": round(rating, 1), "games": games}
+        conn.sendall(json.dumps(resp).encode("utf-8"))
+
+    elif action == "link_stats":
+        target = msg.get("target") or username
+        peers = [p for p in msg.get("peers") or () if isinstance(p, str)]
+        mine, pairs = link_quality(target, peers)
+        resp = {"type": "LINK_STATS", "username": target, "link": mine, "pairs": pairs}
+        conn.sendall(json.dumps(resp).encode("utf-8"))
+
+    elif action == "player_stats":
+        try:
+            # numpy 只有查統計才需要，放在這裡才 import；資料是 match_history（雙方確認過的對戰）
+            import analytics
+            stats = analytics.get_player_stats(msg.get("target") or username, DB_PATH)
+            conn.sendall(json.dumps({"type": "PLAYER_STATS", "stats": stats}).encode("utf-8"))
+        except Exception as e:
+            eventlog.error("player_stats", user=username, err=repr(e))
+            conn.sendall(b"PLAYER_STATS_FAILED")
+
+    elif action == "resume":
+        # lobby 重啟後重連：token 對得上就接回原本的 session
+        if resume_active(username, msg.get("token"), conn):
+            st.username_bound = username
+            conn.sendall(json.dumps({"type": "RESUME_OK", "heartbeat": HB["interval"]}).encode("utf-8"))
+        else:
+            conn.sendall(b"RESUME_FAILED")
+
+    elif action == "logout":
+        try:
+            if username:
+                mark_offline(username)
+                clear_active(username)
+                if st.username_bound == username:
+                    st.username_bound = None
+            conn.sendall(b"LOGOUT_OK")
+        except Exception as e:
+            eventlog.error("logout", user=username, err=repr(e))
+
+    elif action == "profile":
+        # 管理用，只接受本機連線
+        if st.addr[0] not in ("127.0.0.1", "::1"):
+            conn.sendall(b"ERROR_FORBIDDEN")
+            return
+        cmd = msg.get("cmd", "stats")
+        path = None
+        if cmd == "start":
+            PROFILER.reset()
+            PROFILER.start(msg.get("hz"))
+        elif cmd == "stop":
+            PROFILER.stop()
+        elif cmd == "dump":
+            path = dump_profile()
+        resp = {"type": "PROFILE", "path": path}
+        resp.update(PROFILER.stats())
+        conn.sendall(json.dumps(resp).encode("utf-8"))
 
-    username_bound = None
+    else:
+        conn.sendall(b"ERROR_UNKNOWN_ACTION")
 
+def handle_client(conn: socket.socket, addr, st=None):
+    st = st or open_client(conn, addr, admitted=True)
+    handed = False
+    if HANDOVER["enabled"]:
+        # 可以熱升級時 recv 要定期醒來看 drain，才能在交出 fd 之前停止讀這條連線
+        conn.settimeout(HANDOVER_POLL)
+    with HANDOVER["cond"]:
+        HANDOVER["loops"] += 1
     try:
         while True:
-            data = conn.recv(1024).decode('utf-8')
-            if not data:
-                break
-            # client 用的是「每次 send 一個 JSON」，這裡沿用一次解析一個
             try:
-                msg = json.loads(data)
-            except Exception as e:
-                print(f"[!] JSON parse error from {addr}: {e} | raw={data!r}")
+                data = conn.recv(1024).decode('utf-8')
+            except socket.timeout:
+                if HANDOVER["drain"]:
+                    handed = True
+                    break
                 continue
+            if not data:
+                break
+            handle_message(st, data)
+            if HANDOVER["drain"]:
+                handed = True
+                break
 
-            action   = msg.get("action")
-            username = msg.get("username")
-            password = msg.get("password")
+    except Exception as e:
+        eventlog.warn("conn_error", addr=addr, err=repr(e))
 
-            if username:
-                refresh_active(username)
+    finally:
+        with HANDOVER["cond"]:
+            HANDOVER["loops"] -= 1
+            HANDOVER["cond"].notify_all()
+        # 交給新 process 的連線不關、不標離線
+        if not handed:
+            close_client(st)
 
-            if action == "register":
-                try:
-                    conn_db, cursor = with_db()
-                    cursor.execute("SELECT 1 FROM users WHERE username=?", (username,))
-                    if cursor.fetchone():
-                        conn.sendall(b"REGISTER_FAILED_USER_EXISTS")
-                    else:
-                        hashed_pw = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-                        cursor.execute(
-                            "INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)",
-                            (username, hashed_pw.decode(), now_tz())
-                        )
-                        conn_db.commit()
-                        _ = get_status(username)  # 確保 users_status 也建好
-                        conn.sendall(b"REGISTER_SUCCESS")
-                except Exception as e:
-                    print(f"[!] register error: {e}")
-                    conn.sendall(b"REGISTER_FAILED")
-                finally:
-                    try:
-                        cursor.close(); conn_db.close()
-                    except:
-                        pass
+# ===== 入口點 =====
+def serve(server: socket.socket):
+    if HANDOVER["enabled"]:
+        server.settimeout(HANDOVER_POLL)
+    while True:
+        try:
+            conn, addr = server.accept()
+        except socket.timeout:
+            if HANDOVER["drain"]:
+                return
+            continue
+        except OSError as e:
+            # 多半是 EMFILE（開檔數用完），等一下再收，不要讓整個 server 停掉
+            eventlog.error("accept", err=repr(e))
+            time.sleep(0.1)
+            continue
+        if not admit_conn(conn):
+            continue
+        if HANDOVER["drain"]:
+            # drain 中才進來的連線直接跟著交出去
+            open_client(conn, addr, admitted=True)
+            continue
+        start_client_thread(conn, addr)
 
-            elif action == "login":
-                try:
-                    conn_db, cursor = with_db()
-                    cursor.execute("SELECT username, password_hash FROM users WHERE username=?", (username,))
-                    user = cursor.fetchone()
-                    if not user:
-                        conn.sendall(b"LOGIN_FAILED_NO_USER")
-                    elif not bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode()):
-                        conn.sendall(b"LOGIN_FAILED_WRONG_PASSWORD")
-                    else:
-                        # 重複登入策略：拒絕新連線
-                        if is_active(username):
-                            conn.sendall(b"LOGIN_FAILED_DUPLICATE")
-                        else:
-                            set_active(username, conn)
-                            username_bound = username
-                            inc_login_count_and_online(username)
-                            status = normalize_status(get_status(username))
-                            resp = {"type": "LOGIN_SUCCESS", "status": status}
-                            conn.sendall(json.dumps(resp).encode("utf-8"))
-                except Exception as e:
-                    print(f"[!] login error: {e}")
-                    conn.sendall(b"LOGIN_FAILED")
-                finally:
-                    try:
-                        cursor.close(); conn_db.close()
-                    except:
-                        pass
+def start_client_thread(conn, addr, st=None):
+    thread = threading.Thread(target=handle_client, args=(conn, addr, st), daemon=True)
+    try:
+        thread.start()
+    except RuntimeError as e:
+        eventlog.error("thread_start", addr=addr, err=repr(e))
+        if st is not None:
+            close_client(st)
+        else:
+            conn.close()
+            release_slot()
 
-            elif action == "status_report":
+def serve_reactor(server: socket.socket, pool_size=None, initial=()):
+    """
+    --low-mem 用：一個 selector 執行緒顧所有連線，請求交給 pool 處理（DB、bcrypt 會 block）。
+    處理中的連線先從 selector 拿掉、處理完再放回去，所以同一條連線的請求還是照順序一個一個來。
+    """
+    sel = selectors.DefaultSelector()
+    pool = ThreadPoolExecutor(max_workers=pool_size or LOW_MEM["pool"])
+    wake_r, wake_w = socket.socketpair()
+    wake_r.setblocking(False)
+    back = deque()      # pool 處理完、要放回 selector 的連線
+
+    def _run(st, raw):
+        try:
+            handle_message(st, raw.decode('utf-8'))
+        except Exception as e:
+            eventlog.warn("conn_error", addr=st.addr, err=repr(e))
+            close_client(st)
+            return
+        back.append(st)
+        wake_w.send(b"\0")
+
+    server.setblocking(False)
+    sel.register(server, selectors.EVENT_READ)
+    sel.register(wake_r, selectors.EVENT_READ)
+    for st in initial:
+        st.conn.settimeout(LOW_MEM["send_timeout"])
+        sel.register(st.conn, selectors.EVENT_READ, st)
+    while True:
+        events = sel.select(timeout=HANDOVER_POLL)
+        if HANDOVER["drain"]:
+            # 熱升級：不再讀任何連線，等 pool 把手上的請求做完；連線都留在 CLIENTS 裡交出去
+            sel.close()
+            pool.shutdown(wait=True)
+            return
+        for key, _ in events:
+            if key.fileobj is server:
+                while True:
+                    try:
+                        conn, addr = server.accept()
+                    except BlockingIOError:
+                        break
+                    except OSError as e:
+                        eventlog.error("accept", err=repr(e))
+                        break
+                    if not admit_conn(conn):
+                        continue
+                    # 讀之前 selector 已經確認有資料，timeout 實際上只限制 pool 執行緒裡的 sendall
+                    conn.settimeout(LOW_MEM["send_timeout"])
+                    conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, LOW_MEM["sockbuf"])
+                    conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, LOW_MEM["sockbuf"])
+                    st = open_client(conn, addr, admitted=True)
+                    sel.register(conn, selectors.EVENT_READ, st)
+            elif key.fileobj is wake_r:
                 try:
-                    st = msg.get("status", {})  # wins_delta / losses_delta / in_game...
-                    delta = {
-                        "wins":   int(st.get("wins_delta", 0)),
-                        "losses": int(st.get("losses_delta", 0)),
-                    }
-                    update_status(username, delta=delta, online=True)
-                    refresh_active(username)
-                except Exception as e:
-                    print(f"[!] status_report error: {e}")
-
-            elif action == "logout":
+                    while wake_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                while back:
+                    st = back.popleft()
+                    sel.register(st.conn, selectors.EVENT_READ, st)
+            else:
+                st = key.data
+                sel.unregister(st.conn)
                 try:
-                    if username:
-                        mark_offline(username)
-                        clear_active(username)
-                        if username_bound == username:
-                            username_bound = None
-                    conn.sendall(b"LOGOUT_OK")
-                except Exception as e:
-                    print(f"[!] logout error: {e}")
+                    raw = st.conn.recv(1024)
+                except OSError:
+                    raw = b""
+                if raw:
+                    pool.submit(_run, st, raw)
+                else:
+                    pool.submit(close_client, st)
 
-            else:
-                conn.sendall(b"ERROR_UNKNOWN_ACTION")
+def _serve_any(server: socket.socket, initial=()):
+    if LOW_MEM["on"]:
+        serve_reactor(server, initial=initial)
+    else:
+        for st in initial:
+            start_client_thread(st.conn, st.addr, st)
+        serve(server)
 
-    except Exception as e:
-        print(f"[!] Connection error with {addr}: {e}")
+# ===== 熱升級：把 listen socket 與連線交給新的 process =====
+# 舊 process 用 --handover 開（會在 HANDOVER_PATH 開一個 Unix socket 等接手），
+# 新 process 用 --takeover 開：連上 HANDOVER_PATH，舊 process 就
+#   1. drain：停止 accept、每條連線做完手上的請求後不再讀
+#   2. 積分寫回 DB
+#   3. 用 SCM_RIGHTS 依序送出 state（epoch、心跳間隔、session）、listen socket、所有連線的 fd
+#   4. 結束（不關連線、不標離線）
+# 新 process 收到 listen socket 就開始 accept，連線直接接著讀，client 不用重連，心跳也不會斷。
+# SOCK_SEQPACKET 保留訊息邊界；一則訊息最多帶 HANDOVER_FDS 個 fd（SCM_MAX_FD 是 253）。
+HANDOVER_PATH = DB_DIR / "lobby.handover"
+HANDOVER_POLL = 1.0
+HANDOVER_FDS = 200
+HANDOVER_SESSIONS = 1000
+HANDOVER = {"enabled": False, "drain": False, "loops": 0, "serving": False,
+            "cond": threading.Condition(), "done": threading.Event()}
 
-    finally:
-        # 連線關閉，若還綁定使用者，清 session 與標記離線（避免殭屍 session）
-        if username_bound:
-            mark_offline(username_bound)
-            clear_active(username_bound)
+def _send_msg(ctl, obj, fds=()):
+    socket.send_fds(ctl, [json.dumps(obj).encode("utf-8")], list(fds))
+
+def start_handover_listener(path=HANDOVER_PATH):
+    HANDOVER["enabled"] = True
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    lst = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    lst.bind(str(path))
+    lst.listen(1)
 
+    def _loop():
+        ctl, _ = lst.accept()
+        lst.close()
         try:
-            conn.close()
-        finally:
-            with player_lock:
-                PLAYER_NUM -= 1
-                current_players = PLAYER_NUM
-            print(f"[-] Disconnected: {addr}, Current players: {current_players}")
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        if ctl.recv(64) != b"TAKEOVER":
+            ctl.close()
+            return
+        _hand_over(ctl)
 
-# ===== 入口點 =====
-def start_server(host=HOST, port=16000):
+    threading.Thread(target=_loop, daemon=True).start()
+    eventlog.info("handover_ready", path=path)
+
+def _hand_over(ctl):
+    t0 = time.time()
+    eventlog.info("handover_drain")
+    HANDOVER["drain"] = True
+    SHUTTING["on"] = True
+    # 等 accept 迴圈停下來、每條連線的執行緒把手上的請求做完
+    with HANDOVER["cond"]:
+        HANDOVER["cond"].wait_for(lambda: HANDOVER["loops"] == 0 and not HANDOVER["serving"],
+                                  timeout=10 * HANDOVER_POLL)
+    try:
+        RATINGS.close()
+    except Exception as e:
+        eventlog.error("rating_flush", err=repr(e))
+
+    items = SESSIONS.snapshot(all_sessions=True)
+    _send_msg(ctl, {"type": "state", "epoch": EPOCH, "hb": HB["interval"]})
+    for k in range(0, len(items), HANDOVER_SESSIONS):
+        _send_msg(ctl, {"type": "sessions", "items": items[k:k + HANDOVER_SESSIONS]})
+    _send_msg(ctl, {"type": "listen"}, [HANDOVER["listen"].fileno()])
+    with player_lock:
+        clients = list(CLIENTS)
+    for k in range(0, len(clients), HANDOVER_FDS):
+        batch = clients[k:k + HANDOVER_FDS]
+        _send_msg(ctl, {"type": "clients",
+                        "conns": [{"addr": list(st.addr), "user": st.username_bound} for st in batch]},
+                  [st.conn.fileno() for st in batch])
+    _send_msg(ctl, {"type": "done"})
+    ctl.recv(16)    # 等新 process 說收完了
+    eventlog.info("handover_done", conns=len(clients), sessions=len(items), secs=round(time.time() - t0, 3))
+    HANDOVER["done"].set()
+
+def take_over(path=HANDOVER_PATH):
+    """新 process：跟舊 process 要 listen socket、連線與 session，回傳 (server, [ConnState...])。"""
+    global EPOCH
+    ctl = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    ctl.connect(str(path))
+    ctl.sendall(b"TAKEOVER")
+    server, clients = None, []
+    while True:
+        data, fds, _, _ = socket.recv_fds(ctl, 1 << 20, HANDOVER_FDS + 8)
+        if not data:
+            raise ConnectionError("handover: old lobby went away")
+        m = json.loads(data)
+        t = m["type"]
+        if t == "state":
+            EPOCH = m["epoch"]
+            HB["interval"] = m["hb"]
+        elif t == "sessions":
+            SESSIONS.restore([tuple(x) for x in m["items"]])
+        elif t == "listen":
+            server = socket.socket(fileno=fds[0])
+        elif t == "clients":
+            for info, fd in zip(m["conns"], fds):
+                conn = socket.socket(fileno=fd)
+                st = open_client(conn, tuple(info["addr"]))
+                st.username_bound = info["user"]
+                if st.username_bound:
+                    SESSIONS.bind(st.username_bound, conn)
+                clients.append(st)
+        elif t == "done":
+            break
+    ctl.sendall(b"OK")
+    ctl.close()
+    # 舊 process 設過 timeout / non-blocking（跟這邊共用同一個 open file），這裡依自己的模式重設
+    server.setblocking(True)
+    for st in clients:
+        st.conn.setblocking(True)
+    eventlog.info("takeover", conns=len(clients), epoch=EPOCH)
+    return server, clients
+
+def start_server(host=HOST, port=16000, handover=False, takeover=False):
     ensure_schema()
-    reset_all_online_flags()
+    clients = ()
+    if takeover:
+        # 先接手（舊 process 會先把積分寫回 DB），再載入積分
+        server, clients = take_over()
+    elif not load_warm_snapshot():
+        bump_epoch()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    start_profiler()
+    RATINGS.ensure_schema()
+    RATINGS.load()
+    RATINGS.start_flusher()
     threading.Thread(target=cleanup_inactive_sessions, daemon=True).start()
 
+    if not takeover:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # 允許快速重綁
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        if LOW_MEM["on"]:
+            server.listen(1024)
+        else:
+            server.listen()
+    if handover or takeover:
+        HANDOVER["listen"] = server
+        start_handover_listener()
+    eventlog.info("listening", addr=server.getsockname(), db=DB_PATH)
+    HANDOVER["serving"] = True
+    _serve_any(server, clients)
+    if HANDOVER["drain"]:
+        # 交接中：accept 迴圈停了，等交接執行緒把 fd 都送出去再走
+        with HANDOVER["cond"]:
+            HANDOVER["serving"] = False
+            HANDOVER["cond"].notify_all()
+        HANDOVER["done"].wait(30)
+        eventlog.get().close()
+        os._exit(0)
+
+# ===== 多 process：supervisor + SO_REUSEPORT workers =====
+def _worker_main(host, port):
+    """子行程：自己開一個 SO_REUSEPORT 的 listen socket，kernel 會把新連線分散到各 worker。"""
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    start_profiler()
+    threading.Thread(target=cleanup_inactive_sessions, daemon=True).start()
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # 允許快速重綁
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server.bind((host, port))
-    server.listen()
-    print(f"[Lobby] DB @ {DB_PATH}")
-    print(f"[LOBBY SERVER] Listening on {host}:{port} (TCP, NDJSON)")
+    server.listen(1024)
+    eventlog.info("worker_listening", host=host, port=port)
+    _serve_any(server)
 
-    while True:
-        conn, addr = server.accept()
-        thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
-        thread.start()
+def _spawn_worker(host, port):
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            _worker_main(host, port)
+        except BaseException as e:
+            eventlog.error("worker_exit", err=repr(e))
+            code = 1
+        finally:
+            eventlog.get().close()
+            os._exit(code)
+    return pid
+
+def start_cluster(host=HOST, port=16000, workers=None):
+    """
+    fork N 個 worker 共用同一個 port（SO_REUSEPORT，Linux），繞過單一 process 的 GIL。
+    上線表放在共享記憶體（presence.SharedPresence）；積分改成 write-through 直接寫 DB，
+    因為每個 worker 的記憶體是分開的。worker 掛掉會被清掉它的上線紀錄再補一個新的。
+    """
+    global PRESENCE, RATINGS
+    workers = workers or os.cpu_count() or 1
+    ensure_schema()
+    bump_epoch()
+    RATINGS = ratings.RatingTable(with_db, write_through=True)
+    RATINGS.ensure_schema()
+    PRESENCE = presence.SharedPresence()
+    eventlog.info("supervisor", workers=workers, host=host, port=port, db=DB_PATH)
+
+    children = {_spawn_worker(host, port) for _ in range(workers)}
+    stopping = {"stop": False}
+
+    def _stop(signum, frame):
+        stopping["stop"] = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    def _forward(signum, frame):
+        # profiler 在各個 worker 裡
+        for pid in list(children):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGUSR1, _forward)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if stopping["stop"]:
+            continue
+        for user in PRESENCE.release_pid(pid):
+            mark_offline(user)
+        eventlog.warn("worker_died", worker=pid, status=status)
+        time.sleep(0.5)
+        children.add(_spawn_worker(host, port))
+
+def main():
+    ap = argparse.ArgumentParser(description="Lobby server")
+    ap.add_argument("--host", default=HOST)
+    ap.add_argument("--port", type=int, default=16000)
+    ap.add_argument("--workers", type=int, default=None,
+                    help="fork this many SO_REUSEPORT worker processes (0 = one per CPU); "
+                         "default is the single-process server")
+    ap.add_argument("--handover", action="store_true",
+                    help="allow a new lobby process to take over this one (hot upgrade)")
+    ap.add_argument("--takeover", action="store_true",
+                    help="take the listening socket and connections over from a running --handover lobby")
+    ap.add_argument("--low-mem", action="store_true",
+                    help="many idle connections: selector + handler pool instead of a thread per "
+                         "connection, small stacks and socket buffers, raised fd limit")
+    ap.add_argument("--stack-kb", type=int, default=LOW_MEM["stack_kb"], help="thread stack size in --low-mem")
+    ap.add_argument("--sockbuf", type=int, default=LOW_MEM["sockbuf"], help="SO_RCVBUF/SO_SNDBUF in --low-mem")
+    ap.add_argument("--pool", type=int, default=LOW_MEM["pool"], help="request handler threads in --low-mem")
+    ap.add_argument("--max-conns", type=int, default=None,
+                    help=f"concurrent connections before new ones get SERVER_BUSY "
+                         f"(default {ADMIT['max_conns']}, or the fd limit in --low-mem)")
+    ap.add_argument("--max-inflight", type=int, default=ADMIT["max_inflight"],
+                    help="requests handled at once before others get SERVER_BUSY")
+    ap.add_argument("--auth-rate", type=float, default=ADMIT["auth_rate"],
+                    help="login/register attempts per second per IP")
+    ap.add_argument("--auth-burst", type=int, default=ADMIT["auth_burst"],
+                    help="login/register attempts an IP may make back to back")
+    ap.add_argument("--log", default=None, help="write JSON-lines log here instead of text to stdout")
+    ap.add_argument("--log-level", default="info", choices=list(eventlog.LEVELS))
+    ap.add_argument("--log-sample", action="append", default=[], metavar="EVENT=N",
+                    help="keep one in N of a high-rate event, e.g. connect=100 (repeatable)")
+    args = ap.parse_args()
+    eventlog.setup(args.log, args.log_level, sample=eventlog.parse_sample(args.log_sample))
+    if args.low_mem:
+        configure_low_memory(args.stack_kb, args.sockbuf, args.pool)
+    configure_admission(args.max_conns, args.max_inflight, args.auth_rate, args.auth_burst)
+    if args.workers is None:
+        start_server(args.host, args.port, handover=args.handover, takeover=args.takeover)
+    else:
+        start_cluster(args.host, args.port, args.workers or None)
 
 if __name__ == '__main__':
-    start_server()
+    main()
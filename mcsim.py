@@ -0,0 +1,198 @@
+import math
+import time
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+import rules
+
+"""
+NumPy 向量化的 Monte Carlo 模擬：一次推進一大批遊戲（手牌 bitmask、比分都是陣列），
+用來看策略與 target_wins 對公平性的影響（例如平手 ±0.1 是否偏向某一邊）。
+
+向量化策略介面：policy(my_hand, op_hand, my_wins, op_wins, rng) -> play bitmask 陣列
+（參數都是同長度的 numpy 陣列，rng 是 np.random.Generator）。
+"""
+
+HANDS = rules.FULL_HAND + 1
+MAX_PLAYS = max(len(p) for p in rules.LEGAL_PLAYS)
+
+# LEGAL[hand, k] = 第 k 個合法出法（不足的補 0），LEGAL_N[hand] = 合法出法數
+LEGAL = np.zeros((HANDS, MAX_PLAYS), dtype=np.uint8)
+for _h, _plays in enumerate(rules.LEGAL_PLAYS):
+    LEGAL[_h, :len(_plays)] = _plays
+LEGAL_N = np.array([len(p) for p in rules.LEGAL_PLAYS], dtype=np.int64)
+SUM = np.array(rules.MASK_SUM, dtype=np.int16)
+
+# ===== 向量化策略 =====
+def random_policy(my_hand, op_hand, my_wins, op_wins, rng):
+    n = LEGAL_N[my_hand]
+    idx = (rng.random(my_hand.shape[0]) * n).astype(np.int64)
+    return LEGAL[my_hand, idx]
+
+def tabulate(strategy, rng_seed=0):
+    """
+    把只看 (my_hand, op_hand) 的確定性 rules 策略做成 128x128 查表，
+    回傳對應的向量化策略。
+    """
+    import random
+    rng = random.Random(rng_seed)
+    table = np.zeros((HANDS, HANDS), dtype=np.uint8)
+    for my in range(1, HANDS):
+        for op in range(HANDS):
+            table[my, op] = strategy(my, op, 0, 0, rng)
+
+    def _policy(my_hand, op_hand, my_wins, op_wins, rng):
+        return table[my_hand, op_hand]
+    return _policy
+
+def solver_policy(side, target_wins):
+    """solver.py 的均衡混合策略，整張表攤成累積機率陣列後向量化抽樣。"""
+    import solver
+    tbl = solver.get_table(target_wins)
+    T = target_wins
+    cum = np.ones((HANDS, HANDS, T, T, MAX_PLAYS), dtype=np.float32)
+    plays = np.zeros((HANDS, HANDS, T, T, MAX_PLAYS), dtype=np.uint8)
+    for ha in range(1, HANDS):
+        for hb in range(1, HANDS):
+            for wa in range(T):
+                for wb in range(T):
+                    if tbl._slot(ha, hb, wa, wb)[3] == 0:
+                        continue    # 走不到的狀態
+                    strat = tbl.strategy(side, ha, hb, wa, wb)
+                    acc = 0.0
+                    for k, (p, q) in enumerate(strat):
+                        acc += q
+                        plays[ha, hb, wa, wb, k] = p
+                        cum[ha, hb, wa, wb, k] = acc
+                    cum[ha, hb, wa, wb, len(strat) - 1] = 1.0
+
+    def _policy(my_hand, op_hand, my_wins, op_wins, rng):
+        if side == "A":
+            idx = (my_hand, op_hand, my_wins, op_wins)
+        else:
+            idx = (op_hand, my_hand, op_wins, my_wins)
+        r = rng.random(my_hand.shape[0], dtype=np.float32)[:, None]
+        k = (cum[idx] < r).sum(axis=1)
+        return plays[idx][np.arange(my_hand.shape[0]), k]
+    return _policy
+
+def make_policy(name, side, target_wins):
+    if name == "random":
+        return random_policy
+    if name == "solver":
+        return solver_policy(side, target_wins)
+    return tabulate(rules.STRATEGIES[name])
+
+POLICIES = sorted(set(rules.STRATEGIES) | {"random", "solver"})
+
+# ===== 批次模擬 =====
+def simulate_batch(n, policy_a, policy_b, target_wins, rng):
+    """
+    同時跑 n 局。回傳 dict：a_wins、ties（平手回合數）、tie_a（平手被判給 A 的次數）。
+    規則與 rules.play_game 相同：每回合先看 A 沒牌、再看 B 沒牌。
+    """
+    hand_a = np.full(n, rules.FULL_HAND, dtype=np.uint8)
+    hand_b = np.full(n, rules.FULL_HAND, dtype=np.uint8)
+    wins_a = np.zeros(n, dtype=np.int64)
+    wins_b = np.zeros(n, dtype=np.int64)
+    winner_a = np.zeros(n, dtype=bool)
+    live = np.arange(n)
+    ties = tie_a = 0
+
+    while live.size:
+        ha, hb = hand_a[live], hand_b[live]
+        # 沒牌的直接判定
+        a_empty = ha == 0
+        b_empty = (hb == 0) & ~a_empty
+        winner_a[live[b_empty]] = True
+        keep = ~(a_empty | b_empty)
+        live, ha, hb = live[keep], ha[keep], hb[keep]
+        if not live.size:
+            break
+        wa, wb = wins_a[live], wins_b[live]
+
+        pa = policy_a(ha, hb, wa, wb, rng)
+        pb = policy_b(hb, ha, wb, wa, rng)
+        hand_a[live] = ha & ~pa
+        hand_b[live] = hb & ~pb
+        sa, sb = SUM[pa], SUM[pb]
+        tie = sa == sb
+        a_round = (sa > sb) | (tie & (rng.random(live.size) < 0.5))
+        ties += int(tie.sum())
+        tie_a += int((tie & a_round).sum())
+
+        wa = wa + a_round
+        wb = wb + ~a_round
+        wins_a[live], wins_b[live] = wa, wb
+        done_a = wa >= target_wins
+        done_b = wb >= target_wins
+        winner_a[live[done_a]] = True
+        live = live[~(done_a | done_b)]
+
+    return {"a_wins": int(winner_a.sum()), "ties": ties, "tie_a": tie_a}
+
+def _worker(job):
+    n, name_a, name_b, target_wins, seed, batch = job
+    rng = np.random.default_rng(seed)
+    pa = make_policy(name_a, "A", target_wins)
+    pb = make_policy(name_b, "B", target_wins)
+    out = {"games": 0, "a_wins": 0, "ties": 0, "tie_a": 0}
+    while n > 0:
+        k = min(n, batch)
+        res = simulate_batch(k, pa, pb, target_wins, rng)
+        out["games"] += k
+        for key in ("a_wins", "ties", "tie_a"):
+            out[key] += res[key]
+        n -= k
+    return out
+
+def run(n_games, name_a, name_b, target_wins=3, workers=1, seed=None, batch=200000):
+    """把 n_games 切給多個 process 跑，各自用獨立的 SeedSequence 子種子。"""
+    seeds = np.random.SeedSequence(seed).spawn(workers)
+    share = [n_games // workers + (1 if i < n_games % workers else 0) for i in range(workers)]
+    jobs = [(share[i], name_a, name_b, target_wins, seeds[i], batch) for i in range(workers) if share[i]]
+    if workers == 1:
+        parts = [_worker(j) for j in jobs]
+    else:
+        with Pool(workers) as pool:
+            parts = pool.map(_worker, jobs)
+    total = {"games": 0, "a_wins": 0, "ties": 0, "tie_a": 0}
+    for p in parts:
+        for key in total:
+            total[key] += p[key]
+    return total
+
+def wilson(k, n, z=1.96):
+    """二項比例的 Wilson 信賴區間。"""
+    if n == 0:
+        return 0.0, 1.0
+    p = k / n
+    d = 1 + z * z / n
+    c = (p + z * z / (2 * n)) / d
+    h = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / d
+    return c - h, c + h
+
+def main():
+    ap = argparse.ArgumentParser(description="Vectorized Monte Carlo balance analysis")
+    ap.add_argument("-n", "--games", type=int, default=1000000)
+    ap.add_argument("-a", default="random", choices=POLICIES)
+    ap.add_argument("-b", default="random", choices=POLICIES)
+    ap.add_argument("--target-wins", type=int, nargs="+", default=[3])
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args()
+
+    print(f"{'target':>6} {'games':>10} {'P(A wins)':>10} {'95% CI':>19} {'tie->A':>8} {'games/s':>10}")
+    for T in args.target_wins:
+        t0 = time.perf_counter()
+        res = run(args.games, args.a, args.b, T, args.workers, args.seed)
+        dt = time.perf_counter() - t0
+        lo, hi = wilson(res["a_wins"], res["games"])
+        tie_share = res["tie_a"] / res["ties"] if res["ties"] else float("nan")
+        print(f"{T:>6} {res['games']:>10} {res['a_wins'] / res['games']:>10.4f} "
+              f"[{lo:.4f}, {hi:.4f}] {tie_share:>8.4f} {res['games'] / dt:>10.0f}")
+
+if __name__ == "__main__":
+    main()
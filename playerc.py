@@ -2,6 +2,7 @@ import socket
 import json
 import time
 
+import tracing
 from tt import pls, GameUI, send_json_line, recv_json_line, start_status_reporter, safe_logout
 
 HOST = '140.113.17.11'
@@ -143,6 +144,7 @@ def waiting_op(udp, lobby_sock, username):
     state = "LISTEN"
     invite_from = None
     deadline = 0.0
+    trace_id = None
 
     while True:
         try:
@@ -157,7 +159,9 @@ def waiting_op(udp, lobby_sock, username):
 
                 elif msg["type"] == "INVITE":
                     print(f"Got invitation from {msg['from']}")
-                    choice = input("Accept? (y/n): ").strip().lower()
+                    trace_id = msg.get("trace")
+                    with tracing.span("invite_decision", trace_id, role="B", user=username):
+                        choice = input("Accept? (y/n): ").strip().lower()
                     resp = {"type":"ACCEPT"} if choice=="y" else {"type":"DECLINE"}
                     udp.sendto(json.dumps(resp).encode(), addr)
 
@@ -187,7 +191,9 @@ def waiting_op(udp, lobby_sock, username):
                     tcp_port = int(info["port"])
                     print(f"[B] Connecting to A via TCP {addr[0]}:{tcp_port} ...")
                     tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    tcp.connect((addr[0], tcp_port))
+                    tcp.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    with tracing.span("tcp_connect", info.get("trace") or trace_id, role="B"):
+                        tcp.connect((addr[0], tcp_port))
                     try:
                         client_game(tcp, lobby_sock=lobby_sock, username=username)
                     except ConnectionError:
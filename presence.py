@@ -0,0 +1,417 @@
+import os
+import hmac
+import mmap
+import time
+import zlib
+import fcntl
+import struct
+import tempfile
+import threading
+
+"""
+lobby 的上線表，兩種實作、介面相同（claim / set / refresh / is_active / release / expired）：
+
+SessionRegistry：單一 process 用。依名字 hash 分成 n_shards 個 dict，各有一把 threading.Lock，
+心跳（refresh）只鎖自己那一格；每一格記 acquire 次數與搶鎖次數，可以看出還有沒有熱點。
+登入時可以帶一個 resume token；關機前 snapshot() 存檔（save_snapshot），開機 restore() 回來，
+client 重連用 resume(name, token) 接回原本的 session，不用再跑一次 bcrypt。
+
+SharedPresence：多 worker lobby 用。fork 之前建一塊匿名 mmap（MAP_SHARED），子行程都看得到同一份。
+表切成 n_stripes 段，每段一把鎖；名字用 crc32 決定段，在段內線性探測，
+所以不同段的操作完全不互搶，同一段的 check + set 在鎖內完成（重複登入判斷是原子的）。
+段鎖 = process 內的 threading.Lock + 一個暫存檔上第 n 個 byte 的 fcntl 鎖（process 之間）：
+worker 拿著鎖被 SIGKILL / OOM 砍掉時 kernel 會自動放掉，其他 worker 和 supervisor 的 release_pid 不會卡死。
+
+每格 64 bytes：state(1) pad(3) pid(4) last_seen(8) name(48, utf-8)
+名字超過 MAX_NAME_BYTES 直接拒絕（lobby 註冊時就擋，cluster 模式登入也擋），不截斷，免得兩個長名字共用前綴被當成重複登入。
+state：0 空、1 使用中、2 已刪除（墓碑，插入時可重用）
+刪除時後面一格是空的，墓碑就直接收回成空格；一段裡完全沒有空格時查詢會順便重排那一段，
+所以一直有人上下線，查不在的名字也不會每次都掃完整段（而且是拿著跨 process 的段鎖在掃）。
+"""
+
+class Session:
+    # conn 是 None 表示從 snapshot 還原、還沒有人接回來
+    __slots__ = ("conn", "last_seen", "token")
+
+    def __init__(self, conn, last_seen, token=None):
+        self.conn = conn
+        self.last_seen = last_seen
+        self.token = token
+
+class SessionRegistry:
+    def __init__(self, n_shards=64):
+        assert n_shards & (n_shards - 1) == 0, "n_shards must be a power of two"
+        self.n_shards = n_shards
+        self.mask = n_shards - 1
+        self.shards = [{} for _ in range(n_shards)]     # username -> Session
+        self.locks = [threading.Lock() for _ in range(n_shards)]
+        self.acquired = [0] * n_shards
+        self.contended = [0] * n_shards
+
+    def _lock(self, name):
+        """鎖住名字所在的那一格並回傳 (index, dict)；先試 non-blocking，拿不到才算一次搶鎖。"""
+        i = hash(name) & self.mask
+        lock = self.locks[i]
+        if not lock.acquire(blocking=False):
+            lock.acquire()
+            self.contended[i] += 1
+        self.acquired[i] += 1
+        return i, self.shards[i]
+
+    def claim(self, name, owner, ttl, token=None) -> bool:
+        i, shard = self._lock(name)
+        try:
+            sess = shard.get(name)
+            now = time.time()
+            # 還原回來但沒人接的 session 可以直接被新的登入拿走（舊版 client 不會 resume）
+            if sess is not None and sess.conn is not None and now - sess.last_seen <= ttl:
+                return False
+            shard[name] = Session(owner, now, token)
+            return True
+        finally:
+            self.locks[i].release()
+
+    def resume(self, name, token, owner) -> bool:
+        """token 對得上就把 session 接到新的連線上。"""
+        if not token:
+            return False
+        i, shard = self._lock(name)
+        try:
+            sess = shard.get(name)
+            if sess is None or not sess.token or not hmac.compare_digest(sess.token, token):
+                return False
+            sess.conn = owner
+            sess.last_seen = time.time()
+            return True
+        finally:
+            self.locks[i].release()
+
+    def set(self, name, owner):
+        i, shard = self._lock(name)
+        try:
+            shard[name] = Session(owner, time.time())
+        finally:
+            self.locks[i].release()
+
+    def refresh(self, name):
+        # 最常被呼叫（每個帶 username 的請求一次），_lock 直接展開
+        i = hash(name) & self.mask
+        lock = self.locks[i]
+        if not lock.acquire(False):
+            lock.acquire()
+            self.contended[i] += 1
+        self.acquired[i] += 1
+        sess = self.shards[i].get(name)
+        if sess is not None:
+            sess.last_seen = time.time()
+        lock.release()
+
+    def is_active(self, name, ttl) -> bool:
+        i, shard = self._lock(name)
+        try:
+            sess = shard.get(name)
+            return sess is not None and time.time() - sess.last_seen <= ttl
+        finally:
+            self.locks[i].release()
+
+    def release(self, name, owner=None) -> bool:
+        """給 owner 的話只有 session 還掛在這條連線上才移除（已經被 resume 到別條連線就不動）。"""
+        i, shard = self._lock(name)
+        try:
+            sess = shard.get(name)
+            if sess is None or (owner is not None and sess.conn is not owner):
+                return False
+            del shard[name]
+            return True
+        finally:
+            self.locks[i].release()
+
+    def expired(self, ttl):
+        """一次只鎖一格掃，不會整張表卡住心跳。"""
+        now = time.time()
+        out = []
+        for i in range(self.n_shards):
+            with self.locks[i]:
+                out.extend(n for n, sess in self.shards[i].items() if now - sess.last_seen > ttl)
+        return out
+
+    def __len__(self):
+        return sum(len(d) for d in self.shards)
+
+    def snapshot(self, all_sessions=False):
+        """[(name, last_seen, token), ...]；預設只存有 token 的（沒有 token 不能 resume）。"""
+        out = []
+        for i in range(self.n_shards):
+            with self.locks[i]:
+                out.extend((n, sess.last_seen, sess.token) for n, sess in self.shards[i].items()
+                           if sess.token or all_sessions)
+        return out
+
+    def bind(self, name, owner):
+        """把還原回來的 session 直接接到一條連線上（熱升級時連線跟著 fd 一起過來）。"""
+        i, shard = self._lock(name)
+        try:
+            sess = shard.get(name)
+            if sess is not None:
+                sess.conn = owner
+        finally:
+            self.locks[i].release()
+
+    def restore(self, items, now=None):
+        """
+        snapshot 的內容放回來，conn 先是 None。last_seen 一律設成現在：
+        停機的時間不算，client 有一個 ttl 的時間可以重連。
+        """
+        now = now or time.time()
+        for name, _, token in items:
+            i, shard = self._lock(name)
+            try:
+                shard.setdefault(name, Session(None, now, token))
+            finally:
+                self.locks[i].release()
+
+    def stats(self):
+        """各格的 acquire / 搶鎖次數（讀的時候不上鎖，只是估計值）。"""
+        acq, con = sum(self.acquired), sum(self.contended)
+        hot = max(range(self.n_shards), key=lambda i: self.contended[i])
+        return {"sessions": len(self), "acquired": acq, "contended": con,
+                "contention_rate": round(con / acq, 6) if acq else 0.0,
+                "hottest_shard": hot, "hottest_contended": self.contended[hot]}
+
+# ===== session snapshot 檔 =====
+# 檔頭：magic, 版本, epoch, 存檔時間, 筆數；每筆：名字長度(H) + 名字 + last_seen(d) + token(16 bytes)
+SNAP_MAGIC = b"TTSS"
+SNAP_HEADER = struct.Struct("<4sHqdI")
+SNAP_REC = struct.Struct("<d16s")
+
+def save_snapshot(path, epoch, items):
+    parts = [SNAP_HEADER.pack(SNAP_MAGIC, 1, epoch, time.time(), len(items))]
+    for name, last_seen, token in items:
+        raw = name.encode("utf-8")
+        parts.append(struct.pack("<H", len(raw)) + raw + SNAP_REC.pack(last_seen, bytes.fromhex(token)))
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(b"".join(parts))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def load_snapshot(path):
+    """回傳 (epoch, 存檔時間, items)；檔案不存在或壞掉回傳 None。"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, ver, epoch, saved_at, n = SNAP_HEADER.unpack_from(data, 0)
+        if magic != SNAP_MAGIC or ver != 1:
+            return None
+        off = SNAP_HEADER.size
+        items = []
+        for _ in range(n):
+            (k,) = struct.unpack_from("<H", data, off)
+            name = data[off + 2:off + 2 + k].decode("utf-8")
+            off += 2 + k
+            last_seen, token = SNAP_REC.unpack_from(data, off)
+            off += SNAP_REC.size
+            items.append((name, last_seen, token.hex()))
+        return epoch, saved_at, items
+    except (OSError, struct.error, UnicodeDecodeError):
+        return None
+
+MAX_NAME_BYTES = 48
+SLOT = struct.Struct("<B3xid48s")
+SLOT_SIZE = SLOT.size
+EMPTY, USED, DELETED = 0, 1, 2
+assert SLOT_SIZE == 64
+
+class _StripeLock:
+    """fcntl 鎖是整個 process 共用的，同一個 worker 的執行緒之間還要再一把 threading.Lock。"""
+    __slots__ = ("fd", "n", "tlock")
+
+    def __init__(self, fd, n):
+        self.fd = fd
+        self.n = n
+        self.tlock = threading.Lock()
+
+    def __enter__(self):
+        self.tlock.acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, self.n)
+        except BaseException:
+            self.tlock.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, self.n)
+        self.tlock.release()
+        return False
+
+class SharedPresence:
+    def __init__(self, capacity=65536, n_stripes=64):
+        self.n_stripes = n_stripes
+        self.per_stripe = max(1, capacity // n_stripes)
+        self.capacity = self.per_stripe * n_stripes
+        self.buf = mmap.mmap(-1, self.capacity * SLOT_SIZE)
+        # 已經 unlink 的暫存檔，fd 跟著 fork 傳給 worker；整個生命週期都不能關（關掉會放掉這個 process 的所有 fcntl 鎖）
+        self._lockfile = tempfile.TemporaryFile()
+        self.locks = [_StripeLock(self._lockfile.fileno(), s) for s in range(n_stripes)]
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # fork 當下別的執行緒拿著的 threading.Lock 在子行程裡永遠不會被放掉，重建一份
+        for lk in self.locks:
+            lk.tlock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str):
+        """太長的名字回傳 None（表裡不會有它）。"""
+        raw = name.encode("utf-8")
+        return raw if len(raw) <= MAX_NAME_BYTES else None
+
+    def _stripe(self, key: bytes) -> int:
+        return zlib.crc32(key) % self.n_stripes
+
+    def _find(self, stripe, key, rehash=True):
+        """回傳 (找到的格子 or None, 第一個可插入的格子 or None)，呼叫端要持有該段的鎖。"""
+        base = stripe * self.per_stripe
+        start = zlib.crc32(key, 0x9E3779B9) % self.per_stripe
+        free = None
+        for i in range(self.per_stripe):
+            idx = base + (start + i) % self.per_stripe
+            state, pid, ts, name = SLOT.unpack_from(self.buf, idx * SLOT_SIZE)
+            if state == EMPTY:
+                return None, (free if free is not None else idx)
+            if state == DELETED:
+                if free is None:
+                    free = idx
+            elif name.rstrip(b"\0") == key:
+                return idx, free
+        if free is not None and rehash:
+            # 整段都沒有空格：每次查不在的名字都要掃完整段，重排一次把墓碑清掉
+            self._rehash(stripe)
+            return self._find(stripe, key, rehash=False)
+        return None, free
+
+    def _write(self, idx, state, pid, ts, key):
+        SLOT.pack_into(self.buf, idx * SLOT_SIZE, state, pid, ts, key)
+
+    def _clear(self, stripe, idx):
+        """刪掉 idx。下一格是空的話，探測到這裡本來就會停，
+        所以這格連同前面連著的墓碑都可以直接改回空格，探測鏈不會越拉越長。"""
+        base, n = stripe * self.per_stripe, self.per_stripe
+        if SLOT.unpack_from(self.buf, (base + (idx - base + 1) % n) * SLOT_SIZE)[0] != EMPTY:
+            self._write(idx, DELETED, 0, 0.0, b"")
+            return
+        for _ in range(n):
+            self._write(idx, EMPTY, 0, 0.0, b"")
+            idx = base + (idx - base - 1) % n
+            if SLOT.unpack_from(self.buf, idx * SLOT_SIZE)[0] != DELETED:
+                break
+
+    def _rehash(self, stripe):
+        """清空整段，使用中的格子照探測順序重新放（last_seen / pid 不變）。"""
+        base = stripe * self.per_stripe
+        live = []
+        for idx in range(base, base + self.per_stripe):
+            state, pid, ts, name = SLOT.unpack_from(self.buf, idx * SLOT_SIZE)
+            if state == USED:
+                live.append((pid, ts, name.rstrip(b"\0")))
+            self._write(idx, EMPTY, 0, 0.0, b"")
+        for pid, ts, key in live:
+            _, free = self._find(stripe, key, rehash=False)
+            self._write(free, USED, pid, ts, key)
+
+    # ===== 對外介面（跟 lobby2 的 *_active 對應）=====
+    def claim(self, name: str, pid: int, ttl: float) -> bool:
+        """沒人在線（或上一筆已超過 ttl）才登記，回傳是否成功。"""
+        key = self._key(name)
+        if key is None:
+            raise ValueError(f"name longer than {MAX_NAME_BYTES} bytes")
+        s = self._stripe(key)
+        now = time.time()
+        with self.locks[s]:
+            idx, free = self._find(s, key)
+            if idx is not None:
+                _, _, ts, _ = SLOT.unpack_from(self.buf, idx * SLOT_SIZE)
+                if now - ts <= ttl:
+                    return False
+                self._write(idx, USED, pid, now, key)
+                return True
+            if free is None:
+                raise RuntimeError("presence table full")
+            self._write(free, USED, pid, now, key)
+            return True
+
+    def set(self, name: str, pid: int):
+        key = self._key(name)
+        if key is None:
+            raise ValueError(f"name longer than {MAX_NAME_BYTES} bytes")
+        s = self._stripe(key)
+        with self.locks[s]:
+            idx, free = self._find(s, key)
+            if idx is None:
+                idx = free
+            if idx is None:
+                raise RuntimeError("presence table full")
+            self._write(idx, USED, pid, time.time(), key)
+
+    def refresh(self, name: str):
+        key = self._key(name)
+        if key is None:
+            return
+        s = self._stripe(key)
+        with self.locks[s]:
+            idx, _ = self._find(s, key)
+            if idx is not None:
+                # 只改 last_seen 那 8 bytes
+                struct.pack_into("<d", self.buf, idx * SLOT_SIZE + 8, time.time())
+
+    def is_active(self, name: str, ttl: float) -> bool:
+        key = self._key(name)
+        if key is None:
+            return False
+        s = self._stripe(key)
+        with self.locks[s]:
+            idx, _ = self._find(s, key)
+            if idx is None:
+                return False
+            _, _, ts, _ = SLOT.unpack_from(self.buf, idx * SLOT_SIZE)
+            return time.time() - ts <= ttl
+
+    def release(self, name: str, owner=None) -> bool:
+        key = self._key(name)
+        if key is None:
+            return False
+        s = self._stripe(key)
+        with self.locks[s]:
+            idx, _ = self._find(s, key)
+            if idx is not None:
+                self._clear(s, idx)
+                return True
+            return False
+
+    def expired(self, ttl: float, pid=None):
+        """超過 ttl 沒更新的名字；給 pid 的話只看該 worker 登記的。"""
+        now = time.time()
+        out = []
+        for s in range(self.n_stripes):
+            base = s * self.per_stripe
+            with self.locks[s]:
+                for idx in range(base, base + self.per_stripe):
+                    state, owner, ts, name = SLOT.unpack_from(self.buf, idx * SLOT_SIZE)
+                    if state == USED and now - ts > ttl and (pid is None or owner == pid):
+                        out.append(name.rstrip(b"\0").decode("utf-8", "replace"))
+        return out
+
+    def release_pid(self, pid: int):
+        """worker 掛掉時由 supervisor 呼叫，回傳被清掉的名字。"""
+        out = []
+        for s in range(self.n_stripes):
+            base = s * self.per_stripe
+            with self.locks[s]:
+                for idx in range(base, base + self.per_stripe):
+                    state, owner, _, name = SLOT.unpack_from(self.buf, idx * SLOT_SIZE)
+                    if state == USED and owner == pid:
+                        self._clear(s, idx)
+                        out.append(name.rstrip(b"\0").decode("utf-8", "replace"))
+        return out
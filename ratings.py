@@ -0,0 +1,268 @@
+import time
+import sqlite3
+import argparse
+import threading
+
+import journal
+
+"""
+玩家積分（Elo）：lobby 在記憶體裡維護一張表，每收到一場勝負就增量更新，
+有變動的玩家標成 dirty，背景執行緒每隔 flush_interval 批次寫回 SQLite 的 users_rating。
+
+  - 一場只更新一次：lobby 等贏家（wins_delta=1）與輸家（losses_delta=1）兩份 status_report
+    說法一致才呼叫 record（lobby2.confirm_result），單方面的回報只更新 wins/losses。
+  - K 值：前 PROVISIONAL_GAMES 場用 K_NEW（新玩家收斂快），之後用 K。
+  - 多 worker 的 lobby（每個 process 各有一份記憶體）改用 write_through：
+    每場直接在一個 IMMEDIATE transaction 裡讀兩人、算完寫回，查詢也直接讀 DB。
+  - recompute：從 match journal 逐筆重算（iter_records 是 generator，
+    只會留著還沒結束的對戰與積分表，不會把整個歷史讀進記憶體）。
+"""
+
+DEFAULT_RATING = 1500.0
+K_NEW = 40.0
+K = 20.0
+PROVISIONAL_GAMES = 30
+FLUSH_INTERVAL = 5.0
+
+def expected(ra: float, rb: float) -> float:
+    """ra 對 rb 的期望得分。"""
+    return 1.0 / (1.0 + 10 ** ((rb - ra) / 400.0))
+
+def k_factor(games: int) -> float:
+    return K_NEW if games < PROVISIONAL_GAMES else K
+
+class RatingTable:
+    def __init__(self, connect, flush_interval=FLUSH_INTERVAL, write_through=False):
+        """connect() 回傳 (conn, cursor)，跟 lobby2.with_db 一樣。"""
+        self.connect = connect
+        self.flush_interval = flush_interval
+        self.write_through = write_through
+        self.lock = threading.Lock()
+        self.table = {}         # username -> [rating, games]
+        self.dirty = set()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def ensure_schema(self):
+        conn, cur = self.connect()
+        try:
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS users_rating (
+                    username   TEXT PRIMARY KEY,
+                    rating     REAL NOT NULL,
+                    games      INTEGER NOT NULL DEFAULT 0,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+    def load(self):
+        """開機時把整張表讀進記憶體（每人一列，量不大）。"""
+        conn, cur = self.connect()
+        try:
+            cur.execute("SELECT username, rating, games FROM users_rating")
+            rows = cur.fetchall()
+        finally:
+            cur.close()
+            conn.close()
+        with self.lock:
+            for name, rating, games in rows:
+                self.table[name] = [float(rating), int(games)]
+
+    # ===== 查詢 / 更新 =====
+    def get(self, username: str):
+        if self.write_through:
+            return self._db_get(username)
+        with self.lock:
+            r = self.table.get(username)
+            return (r[0], r[1]) if r else (DEFAULT_RATING, 0)
+
+    def record(self, winner: str, loser: str):
+        """記一場 winner 勝 loser，回傳雙方新的積分。"""
+        if not winner or not loser or winner == loser:
+            return None
+        if self.write_through:
+            return self._db_record(winner, loser)
+        with self.lock:
+            rw = self.table.setdefault(winner, [DEFAULT_RATING, 0])
+            rl = self.table.setdefault(loser, [DEFAULT_RATING, 0])
+            self._update(rw, rl)
+            self.dirty.add(winner)
+            self.dirty.add(loser)
+            return rw[0], rl[0]
+
+    @staticmethod
+    def _update(rw, rl):
+        e = expected(rw[0], rl[0])
+        rw[0] += k_factor(rw[1]) * (1.0 - e)
+        rl[0] -= k_factor(rl[1]) * (1.0 - e)
+        rw[1] += 1
+        rl[1] += 1
+
+    def _db_get(self, username):
+        conn, cur = self.connect()
+        try:
+            cur.execute("SELECT rating, games FROM users_rating WHERE username=?", (username,))
+            row = cur.fetchone()
+            return (float(row[0]), int(row[1])) if row else (DEFAULT_RATING, 0)
+        finally:
+            cur.close()
+            conn.close()
+
+    def _db_record(self, winner, loser):
+        conn, cur = self.connect()
+        try:
+            conn.isolation_level = None
+            cur.execute("BEGIN IMMEDIATE")
+            cur.execute("SELECT username, rating, games FROM users_rating WHERE username IN (?, ?)", (winner, loser))
+            rows = {r[0]: [float(r[1]), int(r[2])] for r in cur.fetchall()}
+            rw = rows.get(winner, [DEFAULT_RATING, 0])
+            rl = rows.get(loser, [DEFAULT_RATING, 0])
+            self._update(rw, rl)
+            now = time.time()
+            cur.executemany(
+                "INSERT INTO users_rating (username, rating, games, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(username) DO UPDATE SET rating=excluded.rating, games=excluded.games, "
+                "updated_at=excluded.updated_at",
+                [(winner, rw[0], rw[1], now), (loser, rl[0], rl[1], now)],
+            )
+            cur.execute("COMMIT")
+            return rw[0], rl[0]
+        except Exception:
+            try:
+                cur.execute("ROLLBACK")
+            except Exception:
+                pass
+            raise
+        finally:
+            cur.close()
+            conn.close()
+
+    # ===== 批次寫回 =====
+    def flush(self) -> int:
+        with self.lock:
+            if not self.dirty:
+                return 0
+            now = time.time()
+            rows = [(u, self.table[u][0], self.table[u][1], now) for u in self.dirty]
+            self.dirty = set()
+        conn, cur = self.connect()
+        try:
+            cur.executemany(
+                "INSERT INTO users_rating (username, rating, games, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(username) DO UPDATE SET rating=excluded.rating, games=excluded.games, "
+                "updated_at=excluded.updated_at",
+                rows,
+            )
+            conn.commit()
+        except Exception:
+            # 寫失敗就放回 dirty，下一輪再試
+            with self.lock:
+                self.dirty.update(r[0] for r in rows)
+            raise
+        finally:
+            cur.close()
+            conn.close()
+        return len(rows)
+
+    def start_flusher(self):
+        def _loop():
+            while not self._stop.wait(self.flush_interval):
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"[!] rating flush error: {e}")
+        self._thread = threading.Thread(target=_loop, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+    # ===== 從歷史重算 =====
+    def recompute(self, records) -> int:
+        """
+        records：journal.iter_records() 之類的 generator。
+        清空積分後依時間順序重播每場 END，回傳重播的場數。
+        """
+        with self.lock:
+            self.table = {}
+            self.dirty = set()
+        open_matches = {}       # match_id -> (A 名字, B 名字)
+        n = 0
+        for r in records:
+            if r.kind == journal.KIND_START:
+                open_matches[r.match_id] = (r.name_a, r.name_b)
+            elif r.kind == journal.KIND_END:
+                players = open_matches.pop(r.match_id, None)
+                if not players:
+                    continue
+                a, b = players
+                if r.flags & journal.FLAG_B_WON:
+                    self.record(b, a)
+                else:
+                    self.record(a, b)
+                n += 1
+        return n
+
+    def replace_all(self):
+        """recompute 之後用：整張 users_rating 換成記憶體裡的內容。"""
+        with self.lock:
+            now = time.time()
+            rows = [(u, r[0], r[1], now) for u, r in self.table.items()]
+            self.dirty = set()
+        conn, cur = self.connect()
+        try:
+            cur.execute("DELETE FROM users_rating")
+            cur.executemany("INSERT INTO users_rating (username, rating, games, updated_at) VALUES (?, ?, ?, ?)",
+                            rows)
+            conn.commit()
+        finally:
+            cur.close()
+            conn.close()
+
+def main():
+    ap = argparse.ArgumentParser(description="Player ratings")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("recompute", help="rebuild users_rating from the match journal")
+    p.add_argument("--journal", default=str(journal.JOURNAL_DIR))
+    p.add_argument("--db", default=None, help="sqlite path (default: the lobby DB)")
+    p.add_argument("--dry-run", action="store_true", help="print the table, don't write it")
+    p = sub.add_parser("top", help="print the highest rated players")
+    p.add_argument("--db", default=None)
+    p.add_argument("-n", type=int, default=20)
+    args = ap.parse_args()
+
+    db_path = args.db
+    if db_path is None:
+        from lobby2 import DB_PATH
+        db_path = DB_PATH
+
+    def connect():
+        conn = sqlite3.connect(db_path)
+        return conn, conn.cursor()
+
+    table = RatingTable(connect)
+    table.ensure_schema()
+    if args.cmd == "recompute":
+        t0 = time.perf_counter()
+        n = table.recompute(journal.iter_records(args.journal))
+        print(f"replayed {n} matches, {len(table.table)} players in {time.perf_counter() - t0:.2f}s")
+        if args.dry_run:
+            for name, (rating, games) in sorted(table.table.items(), key=lambda kv: -kv[1][0]):
+                print(f"{name:16s} {rating:8.1f} {games:6d}")
+        else:
+            table.replace_all()
+    else:
+        table.load()
+        rows = sorted(table.table.items(), key=lambda kv: -kv[1][0])[:args.n]
+        for name, (rating, games) in rows:
+            print(f"{name:16s} {rating:8.1f} {games:6d}")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
 import socket
 import json
 import time
+import queue
+import threading
 
-from tt import pls, GameUI, send_json_line, recv_json_line, start_status_reporter, safe_logout
+import rules
+import tracing
+from tt import (pls, GameUI, PeerChannel, TurnTimeout, send_json_line, start_status_reporter, safe_logout,
+                match_summary, TURN_GRACE, REMATCH_SECS)
 
 HOST = '140.113.17.11'
 PORT = 16000
@@ -10,39 +15,81 @@ UDP_PORT = 10002
 RECV_STEP = 2.0
 WAIT_WINDOW = 15.0
 
-def client_game(conn, lobby_sock, username):
-    ui = GameUI()
+def client_game(conn, lobby_sock, username, ui=None, trace_id=None):
+    ui = ui or GameUI()
     B = pls()
     my_role = username
     op_name = None
-    buf = b""
     target_wins = 3
     rnd = 1
+    match_start = sent_at = None    # tracing：一局開始、送出自己的牌的時間
+    idle = None     # A 有回合時限的話，超過這麼久沒任何訊息就當 A 不見了
+    plays, starts = [], 0   # 這場自己出過的牌、這條連線上開了幾場（第二場起是 rematch）
+    chan = PeerChannel(conn)
+    chan.start()
 
     try:
         while True:
-            msg, buf = recv_json_line(conn, buf)
+            try:
+                msg = chan.recv(timeout=idle)
+            except socket.timeout:
+                print("[!] 主機太久沒有回應，結束這場。")
+                _report_status(lobby_sock, username, {"in_game": False})
+                break
             t = msg.get("type")
             
             if t == "START":
                 target_wins = int(msg.get("target_wins", 3))
                 op_name = msg.get("name")
+                if msg.get("ping"):
+                    chan.enable_ping()
+                if msg.get("turn"):
+                    idle = float(msg["turn"]) + 2 * TURN_GRACE + REMATCH_SECS
+                match_start = time.time()
+                plays, starts = [], starts + 1
                 ui.show_game_start(target_wins)
             elif t == "MOVE":  # 收到對手牌
                 ui.show_round(rnd)
+                ui.show_link(chan.link.summary())
                 ui.show_cards(B.cards)
                 ui.show_opponents_cards(op_name, msg.get("cards"))
+                t_in = time.time()
+                # 時鐘在 A 那邊；本機只用 "turn" 倒數當備援，A 的 TURN_WARNING / FORFEIT 在輸入到一半時就會顯示
+                deadline = t_in + float(msg["turn"]) + TURN_GRACE if msg.get("turn") else None
+                _drain_notices(chan)    # 上一回合來不及看的警告
                 while True:
                     try:
-                        my_cards = ui.get_player_move()
+                        my_cards = ui.get_player_move(deadline=deadline, poll=lambda: _poll_notices(chan, ui))
                         if _validate_move(my_cards, B.cards):
+                            sent_at = time.time()
+                            tracing.record("round.input", trace_id, t_in, sent_at, role="B", round=rnd)
                             # 發送自己的出牌
-                            send_json_line(conn, {"type": "MOVE", "cards": my_cards})
+                            chan.send({"type": "MOVE", "cards": my_cards})
                             # 移除使用的牌
                             B.use_cards(my_cards)
+                            plays.append(my_cards)
                             break
                     except ValueError:
                         print("請輸入數字")
+                    except TurnTimeout:
+                        # 不出牌了，等 A 的 FORFEIT（或連線逾時）
+                        tracing.record("round.input", trace_id, t_in, time.time(), role="B", round=rnd, timeout=True)
+                        break
+            elif t == "FORFEIT":
+                if match_start is not None:
+                    tracing.record("match", trace_id, match_start, time.time(), role="B", user=username,
+                                   forfeit=msg.get("loser"))
+                    match_start = None
+                # 我方是 B；超時判負的這場不問 rematch
+                lost = msg.get("loser") == "B"
+                ui.show_forfeit(lost, msg.get("reason", "timeout"))
+                _report_status(lobby_sock, username, {
+                    "wins_delta": 0 if lost else 1,
+                    "losses_delta": 1 if lost else 0,
+                    "opponent": op_name,
+                    "in_game": False
+                }, chan.link.summary(), match_summary(plays, starts > 1))
+                break
             elif t == "ROUND_RESULT":
                 a_play = msg["a_play"]
                 b_play = msg["b_play"]
@@ -50,55 +97,46 @@ def client_game(conn, lobby_sock, username):
                 a_wins = msg["a_wins"]
                 b_wins = msg["b_wins"]
 
+                if sent_at is not None:
+                    tracing.record("round.wait_result", trace_id, sent_at, time.time(), role="B", round=rnd)
+                    sent_at = None
                 ui.show_round_result(b_play, a_play, winner, b_wins, a_wins)
                 rnd += 1
             elif t == "GAME_OVER":
+                if match_start is not None:
+                    tracing.record("match", trace_id, match_start, time.time(), role="B", user=username)
+                    match_start = None
                 ui.show_game_over(msg.get('a_wins'), msg.get('b_wins'), 
                                 msg.get("winner"), my_role)
-                try:
-                    winner = msg.get("winner")
-                    wins_delta   = 1 if winner == username else 0
-                    losses_delta = 1 if winner == op_name else 0
-                    payload = {
-                        "action": "status_report",
-                        "username": username,
-                        "status": {
-                            "wins_delta": wins_delta,
-                            "losses_delta": losses_delta,
-                            "in_game": False
-                        }
-                    }
-                    lobby_sock.sendall(json.dumps(payload).encode("utf-8"))
-                except Exception:
-                    pass
+                winner = msg.get("winner")
+                # winner 可能是玩家名字，或 "A"/"B"（有人沒牌），我方是 B
+                wins_delta   = 1 if winner in (username, "B") else 0
+                _report_status(lobby_sock, username, {
+                    "wins_delta": wins_delta,
+                    "losses_delta": 1 - wins_delta,
+                    "opponent": op_name,
+                    "in_game": False
+                }, chan.link.summary(), match_summary(plays, starts > 1))
 
                     # === 雙向 REMATCH：我方表態 + 5 秒內等待對方 REMATCH（或直接等到新的 START） ===
-                ans = input("Rematch? (y/n): ").strip().lower()
-                if ans == "y":
-                    send_json_line(conn, {"type": "REMATCH"})
+                if ui.ask_rematch(deadline=time.time() + REMATCH_SECS):
+                    chan.send({"type": "REMATCH"})
                     # 在 5 秒內等待：最好情況是先收到 REMATCH，再收到新的 START（由 A 發）
                     # 為了更 robust，也接受直接收到 START（代表主機端已經確認雙方都同意）
-                    buf2 = b""
+                    deadline = time.time() + REMATCH_SECS
                     try:
-                        conn.settimeout(5.0)
                         while True:
-                            msg2, buf2 = recv_json_line(conn, buf2)
+                            msg2 = chan.recv(timeout=max(deadline - time.time(), 0.0))
                             if msg2.get("type") == "REMATCH":
                                 print("雙方都同意再來一局，重置牌庫與比分。")
                                 B = pls()
                                 rnd = 1
-                                conn.settimeout(None)
                                 break
                             # 其他忽略
                     except Exception:
                         # 超時仍未收到對方 REMATCH/START → 結束
                         print("對方未在 5 秒內同意或未開始新局，返回等待。")
                         break
-                    finally:
-                        try:
-                            conn.settimeout(None)
-                        except Exception:
-                            pass
                     # 若 5 秒內只收到對方的 REMATCH，但尚未收到 START，也讓出 loop 等下一個訊息（主迴圈繼續）
                     continue
                 else:
@@ -113,98 +151,178 @@ def client_game(conn, lobby_sock, username):
                 pass
     except KeyboardInterrupt:
         try:
-            send_json_line(conn, {"type": "DISCONNECT", "reason": "KeyboardInterrupt"})
+            chan.send({"type": "DISCONNECT", "reason": "KeyboardInterrupt"})
         except Exception:
             pass
         # 回報離線
         safe_logout(lobby_sock, username)
         print("\n[!] You pressed Ctrl+C. Disconnected from peer and logged out.")
+    finally:
+        chan.close()
+
+def _report_status(lobby_sock, username, status, link=None, match=None):
+    payload = {"action": "status_report", "username": username, "status": status}
+    if link is not None:
+        payload["link"] = link
+    if match is not None:
+        payload["match"] = match
+    try:
+        lobby_sock.sendall(json.dumps(payload).encode("utf-8"))
+    except Exception:
+        pass
+
+def _drain_notices(chan):
+    while True:
+        try:
+            chan.notices.get_nowait()
+        except queue.Empty:
+            return
+
+def _poll_notices(chan, ui):
+    # 出牌輸入時每 INPUT_POLL 秒看一次 A 送來的 TURN_WARNING / FORFEIT
+    while True:
+        try:
+            note = chan.notices.get_nowait()
+        except queue.Empty:
+            return
+        if note.get("type") == "TURN_WARNING":
+            ui.show_turn_warning(float(note.get("remaining", 0)), mine=True)
+        elif note.get("type") == "FORFEIT":
+            raise TurnTimeout()     # FORFEIT 本身還在 inbox，主迴圈會處理
 
 def _validate_move(cards, available_cards):
-    if len(cards) not in (1,2):
-        print("必須出 1 或 2 張牌")
-        return False
-    if any(c<1 or c>7 for c in cards):
-        print("牌的數字必須在 1-7 之間")
-        return False
-    if len(cards)==2 and cards[0]==cards[1]:
-        print("不能出相同的牌")
-        return False
-    if any(c not in available_cards for c in cards):
-        print("你沒有這張牌")
+    err = rules.check_move(cards, rules.cards_to_mask(available_cards))
+    if err:
+        print(err)
         return False
     return True
 
+def start_udp_responder(udp, username, available):
+    """
+    背景執行緒獨佔 UDP socket：SEARCH 直接在這裡回覆（不受 input() 阻塞影響），
+    其他 datagram（INVITE / TCP_INFO / CANCEL）丟進 queue 給 waiting_op 的狀態機處理。
+    available: {"on": bool}，對戰中設成 False，就不回覆 SEARCH。
+    """
+    inbox = queue.Queue()
+    stop_flag = {"stop": False}
+    reply = json.dumps({"type": "REPLY", "name": username}).encode()
+
+    def _loop():
+        udp.settimeout(0.5)     # 定期醒來檢查 stop_flag
+        while not stop_flag["stop"]:
+            try:
+                data, addr = udp.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break           # socket 已關閉
+            try:
+                msg = json.loads(data.decode())
+            except Exception:
+                continue
+            if msg.get("type") == "SEARCH":
+                if available["on"]:
+                    try:
+                        udp.sendto(reply, addr)
+                    except OSError:
+                        pass
+                continue
+            inbox.put((msg, addr))
+
+    t = threading.Thread(target=_loop, daemon=True)
+    t.start()
+    return inbox, stop_flag
+
+def _drop_queued_invites(inbox, addr):
+    keep = []
+    while True:
+        try:
+            msg, src = inbox.get_nowait()
+        except queue.Empty:
+            break
+        if not (src == addr and msg.get("type") == "INVITE"):
+            keep.append((msg, src))
+    for item in keep:
+        inbox.put(item)
+
 def waiting_op(udp, lobby_sock, username):
 
     state = "LISTEN"
     invite_from = None
     deadline = 0.0
+    trace_id = None
+    available = {"on": True}
+    inbox, responder = start_udp_responder(udp, username, available)
 
+    print(f"[WAITING] Listening UDP on port {UDP_PORT}")
     while True:
         try:
             if state == "LISTEN":
-                print(f"[WAITING] Listening UDP on port {UDP_PORT}")
-                data, addr = udp.recvfrom(1024)
-                msg = json.loads(data.decode())
-                
-                if msg["type"] == "SEARCH":
-                    reply = {"type": "REPLY", "name": username}
-                    udp.sendto(json.dumps(reply).encode(), addr)
+                msg, addr = inbox.get()
 
-                elif msg["type"] == "INVITE":
+                if msg.get("type") == "INVITE":
                     print(f"Got invitation from {msg['from']}")
-                    choice = input("Accept? (y/n): ").strip().lower()
+                    trace_id = msg.get("trace")
+                    with tracing.span("invite_decision", trace_id, role="B", user=username):
+                        choice = input("Accept? (y/n): ").strip().lower()
                     resp = {"type":"ACCEPT"} if choice=="y" else {"type":"DECLINE"}
                     udp.sendto(json.dumps(resp).encode(), addr)
+                    # 考慮期間 A 會一直重送 INVITE，丟掉同一來源排隊中的重複邀請
+                    _drop_queued_invites(inbox, addr)
 
                     if choice == "y":
                         state = "INVITE_PENDING"
                         invite_from = addr
                         deadline = time.time() + WAIT_WINDOW
-                        udp.settimeout(RECV_STEP)
                     else:
                         pass
 
             elif state == "INVITE_PENDING":
                 try:
-                    data, addr = udp.recvfrom(1024)
-                except socket.timeout:
+                    info, addr = inbox.get(timeout=RECV_STEP)
+                except queue.Empty:
                     if time.time() >= deadline:
                         print("[B] Invite window expired. Back to LISTEN.")
                         state = "LISTEN"
                         invite_from = None
-                        udp.settimeout(None)        # 回到阻塞等待
-                    continue    
-                        
-                info = json.loads(data.decode())
+                    continue
+
                 if addr != invite_from:
                     continue
                 if info.get("type") == "TCP_INFO":
                     tcp_port = int(info["port"])
                     print(f"[B] Connecting to A via TCP {addr[0]}:{tcp_port} ...")
+                    available["on"] = False     # 對戰中不出現在別人的掃描結果
                     tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    tcp.connect((addr[0], tcp_port))
+                    # 回合訊息都是很小的一行，不要讓 Nagle 攢著等 ACK
+                    tcp.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    trace_id = info.get("trace") or trace_id
                     try:
-                        client_game(tcp, lobby_sock=lobby_sock, username=username, )
+                        with tracing.span("tcp_connect", trace_id, role="B"):
+                            tcp.connect((addr[0], tcp_port))
+                            # 第一行告訴 A 這是哪一場邀請
+                            send_json_line(tcp, {"type": "HELLO", "token": info.get("token"), "trace": trace_id,
+                                                 "ping": True})
+                        client_game(tcp, lobby_sock=lobby_sock, username=username, trace_id=trace_id)
                     except ConnectionError:
                         print("主機斷線，遊戲結束。")
                     finally:
                         tcp.close()
+                        available["on"] = True
 
                     print("[B] Back to LISTEN and waiting new invitations.")
+                    print(f"[WAITING] Listening UDP on port {UDP_PORT}")
                     state = "LISTEN"
                     invite_from = None
-                    udp.settimeout(None)
                     continue  # 重新等待下一波 SEARCH/INVITE
 
                 elif info.get("type") == "CANCEL":
                     print("[B] A cancelled invite. Back to LISTEN.")
                     state = "LISTEN"
                     invite_from = None
-                    udp.settimeout(None)
         except KeyboardInterrupt:
             print("\nBYE!")
+            responder["stop"] = True
             safe_logout(lobby_sock, username)
             break
 
@@ -237,14 +355,17 @@ def sign_in(client):
                 if resp.get("type") == "LOGIN_SUCCESS":
                     print("You are now logged in.")
                     print(f"Your status: {resp.get('status')}")
-                    return True, username, resp.get("status", {})
+                    # resume：lobby 重啟後重連用的 token
+                    return True, username, resp.get("status", {}), resp.get("resume")
             except json.JSONDecodeError:
                 # 舊版文字回覆或錯誤碼
                 print(f"Server response: {resp_raw}")
                 if resp_raw in ["LOGIN_SUCCESS"]:
-                    return True, username, {}
+                    return True, username, {}, None
                 elif resp_raw == "LOGIN_FAILED_DUPLICATE":
                     print("Duplicate login detected. Please logout previous session.")
+                elif resp_raw in ("SERVER_BUSY", "LOGIN_FAILED_RATE_LIMITED"):
+                    print("Lobby is busy. Please wait a moment and try again.")
                 else:
                     print("Login failed. Try again.\n")
 
@@ -280,7 +401,7 @@ def main():
         udp.settimeout(None)
         print(f"Connected to lobby with {HOST}:{PORT}")
 
-        ok, username, status0 = sign_in(client)
+        ok, username, status0, resume_token = sign_in(client)
         if not ok:
             print("Login failed.")
             return
@@ -292,7 +413,8 @@ def main():
                 "in_game": False,
             }
 
-        _ = start_status_reporter(client, username, stats_provider=stats_provider)
+        _ = start_status_reporter(client, username, stats_provider=stats_provider,
+                                  resume_token=resume_token)
 
         _ = input("Press any key to search opponent")
         waiting_op(udp, lobby_sock=client, username=username)
@@ -0,0 +1,276 @@
+import asyncio
+import json
+import random
+import argparse
+
+import rules
+from journal import MatchJournal
+from tt import pls
+
+"""
+多房間對戰主機：一個 process 在 asyncio loop 上同時跑很多場 HostGame 式的對戰。
+兩位玩家都是遠端（用 recv.py 的 client_game 協定），回合完全由網路訊息推動，不用 input()。
+
+玩家連線後第一行送：{"type": "HELLO", "room": "<房間名>", "name": "<玩家名>"}
+同一個房間湊滿兩人就開局。兩邊都以「B 視角」收訊息（a_* 是對手、b_* 是自己），
+所以 recv.py 的 client_game 不用改就能連上來玩。
+"""
+
+HOST = '0.0.0.0'
+PORT = 17000
+HELLO_TIMEOUT = 5.0
+REMATCH_WINDOW = 5.0
+ROOM_WAIT_TIMEOUT = 300.0   # 房間一直湊不滿就收掉
+
+async def send_line(writer, obj: dict):
+    writer.write((json.dumps(obj) + "\n").encode("utf-8"))
+    await writer.drain()
+
+async def recv_line(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("Peer closed")
+    return json.loads(line.decode("utf-8"))
+
+class Seat:
+    def __init__(self, name, reader, writer):
+        self.name = name
+        self.reader = reader
+        self.writer = writer
+        self.hand = pls()
+
+class Room:
+    """一個房間的全部狀態；不同房間之間不共享任何東西。"""
+    def __init__(self, room_id: str, target_wins: int = 3, rng=None, journal=None):
+        self.room_id = room_id
+        self.journal = journal
+        self.match_id = None
+        self.winner_side = None
+        self.target_wins = target_wins
+        self.rng = rng or random.Random()
+        self.seats = []
+        self.ready = asyncio.Event()
+        self.first_released = asyncio.Event()   # 第一個人那邊的 readline 已經收掉，room.run() 才能開始讀
+        self.round = 1
+        self.rounds_played = 0
+
+    def join(self, seat: Seat):
+        self.seats.append(seat)
+        if len(self.seats) == 2:
+            self.ready.set()
+
+    async def run(self):
+        a, b = self.seats
+        try:
+            while True:
+                await self._play_match(a, b)
+                again = await self._rematch(a, b)
+                if self.journal:
+                    self.journal.end_match(self.match_id, self.winner_side, a.hand.winRound, b.hand.winRound, again)
+                if not again:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, json.JSONDecodeError):
+            for s in (a, b):
+                try:
+                    await send_line(s.writer, {"type": "DISCONNECT", "reason": "peer left"})
+                except Exception:
+                    pass
+        finally:
+            for s in (a, b):
+                s.writer.close()
+
+    async def _play_match(self, a, b):
+        a.hand, b.hand = pls(), pls()
+        self.round = 1
+        if self.journal:
+            self.match_id = self.journal.start_match(a.name, b.name, self.target_wins)
+        for me, op in ((a, b), (b, a)):
+            await send_line(me.writer, {"type": "START", "name": op.name, "target_wins": self.target_wins})
+
+        while True:
+            if not a.hand.has_cards():
+                await self._game_over(a, b, b)
+                return
+            if not b.hand.has_cards():
+                await self._game_over(a, b, a)
+                return
+
+            await asyncio.gather(
+                send_line(a.writer, {"type": "MOVE", "cards": b.hand.cards}),
+                send_line(b.writer, {"type": "MOVE", "cards": a.hand.cards}),
+            )
+            a_cards, b_cards = await asyncio.gather(self._read_move(a), self._read_move(b))
+            a_sum = a.hand.use_cards(a_cards)
+            b_sum = b.hand.use_cards(b_cards)
+
+            side, tied = rules.resolve_round(a_sum, b_sum, self.rng)
+            winner = a if side == "A" else b
+            winner.hand.winRound += 1
+            if self.journal:
+                self.journal.record_round(self.match_id, self.round, a_cards, b_cards, a_sum, b_sum, tied, side,
+                                          a.hand.winRound, b.hand.winRound)
+            self.round += 1
+            self.rounds_played += 1
+
+            for me, op, my_sum, op_sum in ((a, b, a_sum, b_sum), (b, a, b_sum, a_sum)):
+                await send_line(me.writer, {
+                    "type": "ROUND_RESULT",
+                    "a_play": op_sum,
+                    "b_play": my_sum,
+                    "winner": winner.name,
+                    "a_wins": op.hand.winRound,
+                    "b_wins": me.hand.winRound,
+                    "a_left": len(op.hand.cards),
+                    "b_left": len(me.hand.cards),
+                })
+            if winner.hand.winRound >= self.target_wins:
+                await self._game_over(a, b, winner)
+                return
+
+    async def _read_move(self, seat):
+        while True:
+            msg = await recv_line(seat.reader)
+            t = msg.get("type")
+            if t == "DISCONNECT":
+                raise ConnectionError(f"{seat.name} disconnected")
+            if t != "MOVE":
+                continue
+            cards = msg.get("cards", [])
+            if isinstance(cards, list) and rules.check_move(cards, rules.cards_to_mask(seat.hand.cards)) is None:
+                return cards
+            await send_line(seat.writer, {"type": "MOVE", "cards": seat.hand.cards, "error": "invalid move"})
+
+    async def _game_over(self, a, b, winner):
+        self.winner_side = "A" if winner is a else "B"
+        for me, op in ((a, b), (b, a)):
+            await send_line(me.writer, {
+                "type": "GAME_OVER",
+                "winner": winner.name,
+                "a_wins": op.hand.winRound,
+                "b_wins": me.hand.winRound,
+            })
+
+    async def _rematch(self, a, b) -> bool:
+        async def _wait(seat):
+            while True:
+                msg = await recv_line(seat.reader)
+                if msg.get("type") == "REMATCH":
+                    return True
+                if msg.get("type") == "DISCONNECT":
+                    return False
+        try:
+            ok_a, ok_b = await asyncio.wait_for(asyncio.gather(_wait(a), _wait(b)), REMATCH_WINDOW)
+        except (asyncio.TimeoutError, ConnectionError):
+            return False
+        if not (ok_a and ok_b):
+            return False
+        for s in (a, b):
+            await send_line(s.writer, {"type": "REMATCH"})
+        return True
+
+class RoomServer:
+    def __init__(self, host=HOST, port=PORT, target_wins=3, journal=None):
+        self.host = host
+        self.port = port
+        self.target_wins = target_wins
+        self.journal = journal
+        self.waiting = {}   # room_id -> 還沒湊滿的 Room
+        self.running = set()
+        self.matches_done = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._on_connect, self.host, self.port, backlog=1024)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def serve_forever(self):
+        await self.start()
+        print(f"[ROOM HOST] Listening on {self.host}:{self.port}")
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        if self.server:
+            self.server.close()
+
+    async def _on_connect(self, reader, writer):
+        try:
+            hello = await asyncio.wait_for(recv_line(reader), HELLO_TIMEOUT)
+        except Exception:
+            writer.close()
+            return
+        if hello.get("type") != "HELLO" or not hello.get("room"):
+            writer.close()
+            return
+
+        room_id = str(hello["room"])
+        room = self.waiting.get(room_id)
+        if room is None:
+            room = self.waiting[room_id] = Room(room_id, self.target_wins, journal=self.journal)
+        seat = Seat(hello.get("name", "?"), reader, writer)
+        room.join(seat)
+        if not room.ready.is_set():
+            await self._hold_seat(room, seat)
+            return
+        # 湊滿了：從等待表移走，房間自己跑
+        del self.waiting[room_id]
+        self.running.add(room)
+        try:
+            await room.first_released.wait()
+            await room.run()
+        finally:
+            self.running.discard(room)
+            self.matches_done += 1
+
+    async def _hold_seat(self, room, seat):
+        """
+        第一個人等對手的期間盯著他的連線：斷線、送 DISCONNECT 或等超過 ROOM_WAIT_TIMEOUT 就把房間從等待表拿掉，
+        下一個進這個房間名的人才不會配到死掉的連線。湊滿之後就交給第二個人那邊的 room.run()。
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + ROOM_WAIT_TIMEOUT
+        ready = asyncio.ensure_future(room.ready.wait())
+        try:
+            while not room.ready.is_set():
+                # 開局前照協定不會有訊息，讀到的行直接丟掉；取消還沒讀完的 readline 不會動到 buffer
+                line = asyncio.ensure_future(seat.reader.readline())
+                done, _ = await asyncio.wait({ready, line}, timeout=max(deadline - loop.time(), 0.0),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if line not in done:
+                    line.cancel()
+                    await asyncio.wait({line})  # 等它真的結束，不然 room.run() 的 readline 會撞上還在等資料的這個
+                    if ready in done:
+                        return
+                    break       # 逾時
+                try:
+                    data = line.result()
+                    gone = not data or json.loads(data.decode("utf-8")).get("type") == "DISCONNECT"
+                except Exception:
+                    gone = True
+                if gone:
+                    break
+            if room.ready.is_set():
+                return          # 剛好同時湊滿：交給 room.run()，它自己會處理斷線
+            if self.waiting.get(room.room_id) is room:
+                del self.waiting[room.room_id]
+            seat.writer.close()
+        finally:
+            ready.cancel()
+            room.first_released.set()
+
+def main():
+    ap = argparse.ArgumentParser(description="Multi-room game host")
+    ap.add_argument("--host", default=HOST)
+    ap.add_argument("--port", type=int, default=PORT)
+    ap.add_argument("--target-wins", type=int, default=3)
+    ap.add_argument("--journal", default=None, help="match journal directory")
+    args = ap.parse_args()
+    journal = MatchJournal(args.journal) if args.journal else None
+    try:
+        asyncio.run(RoomServer(args.host, args.port, args.target_wins, journal).serve_forever())
+    except KeyboardInterrupt:
+        print("\n[ROOM HOST] bye")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import random
+import time
+import argparse
+
+"""
+純規則引擎：不 print、不 input()，互動版（tt / client / recv）跟網路主機（roomhost）都呼叫這裡。
+手牌用 7 bit 的 bitmask 表示：第 c-1 個 bit 代表牌 c（1..7）。
+"""
+
+NUM_CARDS = 7
+FULL_HAND = (1 << NUM_CARDS) - 1
+
+# ===== 預先算好的查表（index = 手牌 bitmask）=====
+MASK_CARDS = tuple(tuple(c for c in range(1, NUM_CARDS + 1) if m >> (c - 1) & 1) for m in range(FULL_HAND + 1))
+MASK_SUM = tuple(sum(cs) for cs in MASK_CARDS)
+MASK_COUNT = tuple(len(cs) for cs in MASK_CARDS)
+ALL_PLAYS = tuple(m for m in range(1, FULL_HAND + 1) if MASK_COUNT[m] in (1, 2))
+# LEGAL_PLAYS[hand] = 這手牌所有合法的 1 張 / 2 張出法（bitmask）
+LEGAL_PLAYS = tuple(tuple(p for p in ALL_PLAYS if p & h == p) for h in range(FULL_HAND + 1))
+
+def cards_to_mask(cards) -> int:
+    m = 0
+    for c in cards:
+        m |= 1 << (c - 1)
+    return m
+
+def mask_to_cards(mask: int) -> list:
+    return list(MASK_CARDS[mask])
+
+def check_move(cards, hand: int):
+    """合法回傳 None，否則回傳錯誤訊息（給 UI 顯示）。"""
+    if len(cards) not in (1, 2):
+        return "必須出 1 或 2 張牌"
+    if any(not isinstance(c, int) or isinstance(c, bool) or c < 1 or c > NUM_CARDS for c in cards):
+        return "牌的數字必須在 1-7 之間"
+    if len(cards) == 2 and cards[0] == cards[1]:
+        return "不能出相同的牌"
+    if any(not hand >> (c - 1) & 1 for c in cards):
+        return "你沒有這張牌"
+    return None
+
+def resolve_round(a_sum, b_sum, rng=random):
+    """
+    比大小；平手時 A 隨機 ±0.1（與原本 HostGame 規則相同，各 50%）。
+    回傳 (winner, tied)，winner 為 "A" 或 "B"。
+    """
+    if a_sum == b_sum:
+        return ("A" if rng.random() < 0.5 else "B"), True
+    return ("A" if a_sum > b_sum else "B"), False
+
+class GameState:
+    __slots__ = ("hand_a", "hand_b", "wins_a", "wins_b", "target_wins", "round")
+
+    def __init__(self, target_wins: int = 3):
+        self.hand_a = FULL_HAND
+        self.hand_b = FULL_HAND
+        self.wins_a = 0
+        self.wins_b = 0
+        self.target_wins = target_wins
+        self.round = 1
+
+    def legal_moves(self, side: str):
+        return LEGAL_PLAYS[self.hand_a if side == "A" else self.hand_b]
+
+    def winner(self):
+        """遊戲結束回傳 "A"/"B"，否則 None。先檢查 A 沒牌（與 HostGame._check_cards 同順序）。"""
+        if self.wins_a >= self.target_wins:
+            return "A"
+        if self.wins_b >= self.target_wins:
+            return "B"
+        if not self.hand_a:
+            return "B"
+        if not self.hand_b:
+            return "A"
+        return None
+
+    def apply(self, play_a: int, play_b: int, rng=random):
+        """兩邊同時出牌（bitmask），回傳 (a_sum, b_sum, winner, tied)。呼叫前須確認合法。"""
+        self.hand_a &= ~play_a
+        self.hand_b &= ~play_b
+        a_sum = MASK_SUM[play_a]
+        b_sum = MASK_SUM[play_b]
+        winner, tied = resolve_round(a_sum, b_sum, rng)
+        if winner == "A":
+            self.wins_a += 1
+        else:
+            self.wins_b += 1
+        self.round += 1
+        return a_sum, b_sum, winner, tied
+
+# ===== 策略：strategy(my_hand, op_hand, my_wins, op_wins, rng) -> play bitmask =====
+def random_strategy(my_hand, op_hand, my_wins, op_wins, rng):
+    plays = LEGAL_PLAYS[my_hand]
+    return plays[int(rng.random() * len(plays))]
+
+def greedy_strategy(my_hand, op_hand, my_wins, op_wins, rng):
+    """出能贏過對手最大可能出牌的最小組合；贏不了就丟最小的一張。"""
+    op_best = max(MASK_SUM[p] for p in LEGAL_PLAYS[op_hand]) if op_hand else 0
+    best = None
+    for p in LEGAL_PLAYS[my_hand]:
+        s = MASK_SUM[p]
+        if s > op_best and (best is None or s < MASK_SUM[best]):
+            best = p
+    if best is None:
+        best = my_hand & -my_hand
+    return best
+
+STRATEGIES = {
+    "random": random_strategy,
+    "greedy": greedy_strategy,
+}
+
+def play_game(strat_a, strat_b, target_wins=3, rng=random):
+    """跑完一整局，回傳 "A" 或 "B"。"""
+    hand_a = hand_b = FULL_HAND
+    wins_a = wins_b = 0
+    rand = rng.random
+    while True:
+        if not hand_a:
+            return "B"
+        if not hand_b:
+            return "A"
+        pa = strat_a(hand_a, hand_b, wins_a, wins_b, rng)
+        pb = strat_b(hand_b, hand_a, wins_b, wins_a, rng)
+        hand_a &= ~pa
+        hand_b &= ~pb
+        a_sum = MASK_SUM[pa]
+        b_sum = MASK_SUM[pb]
+        if a_sum > b_sum or (a_sum == b_sum and rand() < 0.5):
+            wins_a += 1
+            if wins_a >= target_wins:
+                return "A"
+        else:
+            wins_b += 1
+            if wins_b >= target_wins:
+                return "B"
+
+def simulate(n_games, strat_a, strat_b, target_wins=3, seed=None):
+    rng = random.Random(seed)
+    a_wins = 0
+    for _ in range(n_games):
+        if play_game(strat_a, strat_b, target_wins, rng) == "A":
+            a_wins += 1
+    return {"games": n_games, "a_wins": a_wins, "b_wins": n_games - a_wins}
+
+def main():
+    ap = argparse.ArgumentParser(description="Headless batch simulator")
+    ap.add_argument("-n", "--games", type=int, default=100000)
+    ap.add_argument("-a", default="random", choices=sorted(STRATEGIES))
+    ap.add_argument("-b", default="random", choices=sorted(STRATEGIES))
+    ap.add_argument("--target-wins", type=int, default=3)
+    ap.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    res = simulate(args.games, STRATEGIES[args.a], STRATEGIES[args.b], args.target_wins, args.seed)
+    dt = time.perf_counter() - t0
+    print(f"A={args.a} B={args.b} target={args.target_wins}: "
+          f"A {res['a_wins']} / B {res['b_wins']} ({res['a_wins'] / res['games']:.4f})")
+    print(f"{res['games']} games in {dt:.2f}s = {res['games'] / dt * 60:,.0f} games/min")
+
+if __name__ == "__main__":
+    main()
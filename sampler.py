@@ -0,0 +1,181 @@
+import os
+import re
+import sys
+import time
+import argparse
+import linecache
+import threading
+from pathlib import Path
+
+"""
+取樣式 profiler：背景執行緒每 1/hz 秒用 sys._current_frames() 抓所有執行緒目前的 stack，
+累計成 folded stacks（一行 "thread;外層;...;內層 次數"），可以直接丟給 flamegraph.pl / speedscope。
+
+  - 不用 sys.setprofile，其他執行緒的程式碼路徑完全不變；成本是取樣執行緒自己搶 GIL 的時間，
+    跟 hz × 執行緒數成正比（單核、100 條連線：99 Hz 吞吐量少約 7%，預設的 49 Hz 約一半）
+  - 每個 frame 記成 "函式 (檔名:目前行號)"（跟 py-spy 一樣），最內層如果是在等 I/O / 等鎖 / sleep 的那一行
+    （從原始碼判斷 .recv( .accept( .select( .acquire( ...；queue.get、Event.wait 最內層就是 threading 裡的
+    .acquire(）就加上 [idle]，top 預設把它們濾掉
+  - 執行緒名稱去掉編號（Thread-12 (handle_client) -> Thread (handle_client)），
+    同一種執行緒的 stack 會疊在一起
+  - 取樣執行緒自己花的時間另外記（stats()["overhead"]），方便確認在正式環境開著的代價
+
+  python sampler.py top storage/profiles/lobby-1234-....folded   # 看最花時間的地方
+"""
+
+PROFILE_DIR = Path(__file__).resolve().parent / "storage" / "profiles"
+DEFAULT_HZ = 49         # 不用整數倍的 10ms，避免剛好跟其他週期同步
+MAX_DEPTH = 64
+
+_THREAD_NO = re.compile(r"-\d+")
+# 只認真的會 block 的 C 層呼叫。queue.get / Event.wait / Thread.join 是 Python 寫的，最內層會落在
+# threading.py 裡的 waiter.acquire(...)，不用另外列；也不能列 get / join，不然 dict.get、str.join 都會被當成 idle
+_IDLE_CALL = re.compile(r"\.(recv|recv_into|recvfrom|_?accept|select|poll|epoll|acquire|sleep|waitpid|readline)\("
+                        r"|\binput\(")
+
+class StackSampler:
+    def __init__(self, hz=DEFAULT_HZ, max_depth=MAX_DEPTH):
+        self.hz = hz
+        self.max_depth = max_depth
+        self.lock = threading.Lock()
+        self.counts = {}        # folded stack -> 次數
+        self.labels = {}        # (code object, 行號) -> "func (file:line)"
+        self.idle = {}          # (code object, 行號) -> 最內層是這行時的 label（加 [idle]）
+        self.samples = 0
+        self.busy = 0.0         # 取樣本身花的時間
+        self.started_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, hz=None):
+        if self.running:
+            return
+        if hz:
+            self.hz = hz
+        self._stop.clear()
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._loop, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(2.0)
+            self._thread = None
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.samples = 0
+            self.busy = 0.0
+            self.started_at = time.time() if self.running else None
+
+    # ===== 取樣 =====
+    def _label(self, code, line):
+        key = (code, line)
+        lb = self.labels.get(key)
+        if lb is None:
+            lb = self.labels[key] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{line})"
+        return lb
+
+    def _leaf(self, code, line):
+        key = (code, line)
+        lb = self.idle.get(key)
+        if lb is None:
+            lb = self._label(code, line)
+            if _IDLE_CALL.search(linecache.getline(code.co_filename, line)):
+                lb += " [idle]"
+            self.idle[key] = lb
+        return lb
+
+    def _loop(self):
+        me = threading.get_ident()
+        interval = 1.0 / self.hz
+        while not self._stop.wait(interval):
+            t0 = time.perf_counter()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            frames = sys._current_frames()
+            folded = []
+            for tid, frame in frames.items():
+                if tid == me:
+                    continue
+                stack = [self._leaf(frame.f_code, frame.f_lineno)]
+                frame = frame.f_back
+                while frame is not None and len(stack) < self.max_depth:
+                    stack.append(self._label(frame.f_code, frame.f_lineno))
+                    frame = frame.f_back
+                stack.append(_THREAD_NO.sub("", names.get(tid, "thread")))
+                stack.reverse()
+                folded.append(";".join(stack))
+            del frames
+            with self.lock:
+                for key in folded:
+                    self.counts[key] = self.counts.get(key, 0) + 1
+                self.samples += 1
+                self.busy += time.perf_counter() - t0
+
+    # ===== 輸出 =====
+    def stats(self):
+        with self.lock:
+            elapsed = time.time() - self.started_at if self.started_at else 0.0
+            return {"running": self.running, "hz": self.hz, "samples": self.samples, "stacks": len(self.counts),
+                    "elapsed": round(elapsed, 2), "overhead": round(self.busy / elapsed, 4) if elapsed else 0.0}
+
+    def folded(self):
+        with self.lock:
+            items = sorted(self.counts.items(), key=lambda kv: -kv[1])
+        return "".join(f"{k} {v}\n" for k, v in items)
+
+    def dump(self, path=None, tag="lobby"):
+        """寫成 folded 檔，回傳路徑。"""
+        if path is None:
+            PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+            path = PROFILE_DIR / f"{tag}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.folded"
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.folded())
+        os.replace(tmp, path)
+        return str(path)
+
+def top_functions(lines, n=20):
+    """folded 行 -> [(frame, self 次數, 含子呼叫的次數), ...]，依 self 排序。"""
+    self_cnt, total_cnt = {}, {}
+    for line in lines:
+        stack, _, cnt = line.rstrip("\n").rpartition(" ")
+        if not stack:
+            continue
+        cnt = int(cnt)
+        frames = stack.split(";")[1:]   # 第一個是執行緒名稱
+        if not frames:
+            continue
+        self_cnt[frames[-1]] = self_cnt.get(frames[-1], 0) + cnt
+        for fr in set(frames):
+            total_cnt[fr] = total_cnt.get(fr, 0) + cnt
+    rows = sorted(self_cnt.items(), key=lambda kv: -kv[1])[:n]
+    return [(fn, c, total_cnt[fn]) for fn, c in rows]
+
+def main():
+    ap = argparse.ArgumentParser(description="Folded-stack profile tools")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("top", help="functions with the most samples in a .folded dump")
+    p.add_argument("path")
+    p.add_argument("-n", type=int, default=20)
+    p.add_argument("--all", action="store_true", help="include stacks parked in recv/accept/select/wait/sleep")
+    args = ap.parse_args()
+
+    with open(args.path, encoding="utf-8") as f:
+        lines = f.readlines()
+    if not args.all:
+        # 大部分執行緒大部分時間都在等 I/O，預設只看真的在跑的
+        lines = [l for l in lines if not l.rpartition(" ")[0].endswith(" [idle]")]
+    total = sum(int(l.rpartition(" ")[2]) for l in lines) or 1
+    print(f"{'self':>7} {'self%':>6} {'total':>7}  frame")
+    for fn, c, t in top_functions(lines, args.n):
+        print(f"{c:>7} {c / total:>6.1%} {t:>7}  {fn}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import mmap
+import struct
+import random
+import time
+import argparse
+from pathlib import Path
+
+import rules
+
+"""
+精確解：兩邊同時出牌的零和賽局，對每個 (hand_a, hand_b, wins_a, wins_b) 狀態解矩陣賽局（LP），
+值 = A 在雙方都打均衡策略時的勝率。結果寫成固定格式的查表檔，執行時用 mmap 載入，bot 直接查表出牌。
+
+檔案格式（little-endian）：
+  header  : magic "TTSV" | version u16 | target_wins u16 | slots u32 | blob_off u32
+  slots   : 每個狀態 16 bytes = value f32 | a_off u32 | b_off u32 | a_n u8 | b_n u8 | pad 2
+  blob    : 策略條目 5 bytes = play(bitmask) u8 | prob f32
+  slot index = ((hand_a * 128 + hand_b) * T + wins_a) * T + wins_b
+"""
+
+MAGIC = b"TTSV"
+VERSION = 1
+HEADER = struct.Struct("<4sHHII")
+SLOT = struct.Struct("<fIIBBxx")
+ENTRY = struct.Struct("<Bf")
+EPS = 1e-12
+TABLE_DIR = Path(__file__).resolve().parent / "storage"
+
+def table_path(target_wins: int) -> Path:
+    return TABLE_DIR / f"solver_t{target_wins}.bin"
+
+def _slot_index(hand_a, hand_b, wins_a, wins_b, target_wins):
+    return ((hand_a * (rules.FULL_HAND + 1) + hand_b) * target_wins + wins_a) * target_wins + wins_b
+
+def terminal_value(hand_a, hand_b, wins_a, wins_b, target_wins):
+    """終局狀態 A 的勝率，不是終局回傳 None。順序有差（B 用最後的牌拿下決勝局時 hand_b 也是空的）。"""
+    if wins_a >= target_wins:
+        return 1.0
+    if wins_b >= target_wins:
+        return 0.0
+    if not hand_a:
+        return 0.0
+    if not hand_b:
+        return 1.0
+    return None
+
+# ===== 矩陣賽局 =====
+def solve_matrix(M):
+    """
+    M[i][j] = 列玩家（A，最大化）出 i、行玩家（B，最小化）出 j 時 A 的勝率。
+    回傳 (value, x, y)，x / y 分別是 A / B 的混合策略。
+    """
+    m, n = len(M), len(M[0])
+    # 先看有沒有純策略鞍點，大部分小狀態在這裡就結束
+    row_min = [min(r) for r in M]
+    col_max = [max(M[i][j] for i in range(m)) for j in range(n)]
+    lo, hi = max(row_min), min(col_max)
+    if hi - lo <= EPS:
+        i = row_min.index(lo)
+        j = col_max.index(hi)
+        x = [0.0] * m; x[i] = 1.0
+        y = [0.0] * n; y[j] = 1.0
+        return lo, x, y
+
+    # B 的 LP：max sum(w) s.t. (M+1) w <= 1, w >= 0 ；最佳值 = 1 / (value + 1)
+    # tableau 欄位：w_0..w_{n-1}, s_0..s_{m-1}, rhs
+    width = n + m + 1
+    T = []
+    for i in range(m):
+        row = [M[i][j] + 1.0 for j in range(n)] + [0.0] * m + [1.0]
+        row[n + i] = 1.0
+        T.append(row)
+    obj = [-1.0] * n + [0.0] * m + [0.0]
+    basis = [n + i for i in range(m)]
+
+    for it in range(10 * (m + n) + 50):
+        # Dantzig 選入基；迭代太多改用 Bland 避免循環
+        if it < 5 * (m + n):
+            col = min(range(width - 1), key=obj.__getitem__)
+            if obj[col] >= -EPS:
+                break
+        else:
+            col = next((c for c in range(width - 1) if obj[c] < -EPS), None)
+            if col is None:
+                break
+        row, best = None, None
+        for i in range(m):
+            a = T[i][col]
+            if a > EPS:
+                r = T[i][-1] / a
+                if best is None or r < best - EPS or (abs(r - best) <= EPS and basis[i] < basis[row]):
+                    row, best = i, r
+        pr = T[row]
+        piv = pr[col]
+        for k in range(width):
+            pr[k] /= piv
+        for i in range(m):
+            if i != row:
+                f = T[i][col]
+                if f:
+                    Ti = T[i]
+                    for k in range(width):
+                        Ti[k] -= f * pr[k]
+        f = obj[col]
+        for k in range(width):
+            obj[k] -= f * pr[k]
+        basis[row] = col
+
+    z = obj[-1]
+    w = [0.0] * n
+    for i, b in enumerate(basis):
+        if b < n:
+            w[b] = T[i][-1]
+    x = [obj[n + i] / z for i in range(m)]
+    y = [wj / z for wj in w]
+    return 1.0 / z - 1.0, x, y
+
+# ===== 整個賽局 =====
+def solve(target_wins=3, progress=False):
+    """回傳 dict: state -> (value, [(play, prob)...] for A, [(play, prob)...] for B)，只含非終局狀態。"""
+    memo = {}
+    S = rules.MASK_SUM
+    LP = rules.LEGAL_PLAYS
+    t0 = time.time()
+
+    def value(ha, hb, wa, wb):
+        end = terminal_value(ha, hb, wa, wb, target_wins)
+        if end is not None:
+            return end
+        key = (ha, hb, wa, wb)
+        got = memo.get(key)
+        if got is not None:
+            return got[0]
+
+        plays_a = LP[ha]
+        plays_b = LP[hb]
+        M = []
+        for pa in plays_a:
+            na, sa = ha & ~pa, S[pa]
+            row = []
+            for pb in plays_b:
+                nb, sb = hb & ~pb, S[pb]
+                if sa > sb:
+                    v = value(na, nb, wa + 1, wb)
+                elif sa < sb:
+                    v = value(na, nb, wa, wb + 1)
+                else:
+                    v = 0.5 * (value(na, nb, wa + 1, wb) + value(na, nb, wa, wb + 1))
+                row.append(v)
+            M.append(row)
+
+        v, x, y = solve_matrix(M)
+        strat_a = [(p, q) for p, q in zip(plays_a, x) if q > 1e-9]
+        strat_b = [(p, q) for p, q in zip(plays_b, y) if q > 1e-9]
+        memo[key] = (v, strat_a, strat_b)
+        if progress and len(memo) % 5000 == 0:
+            print(f"  {len(memo)} states ({time.time() - t0:.1f}s)")
+        return v
+
+    value(rules.FULL_HAND, rules.FULL_HAND, 0, 0)
+    return memo
+
+def write_table(memo, target_wins, path):
+    slots = (rules.FULL_HAND + 1) ** 2 * target_wins * target_wins
+    slot_buf = bytearray(SLOT.size * slots)
+    blob = bytearray()
+    for (ha, hb, wa, wb), (v, sa, sb) in memo.items():
+        a_off = len(blob) // ENTRY.size
+        for p, q in sa:
+            blob += ENTRY.pack(p, q)
+        b_off = len(blob) // ENTRY.size
+        for p, q in sb:
+            blob += ENTRY.pack(p, q)
+        SLOT.pack_into(slot_buf, _slot_index(ha, hb, wa, wb, target_wins) * SLOT.size,
+                       v, a_off, b_off, len(sa), len(sb))
+    blob_off = HEADER.size + len(slot_buf)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, target_wins, slots, blob_off))
+        f.write(slot_buf)
+        f.write(blob)
+    tmp.replace(path)
+
+class SolverTable:
+    """mmap 載入的查表；查詢都是 O(1)，不做任何搜尋。"""
+    def __init__(self, path):
+        self._f = open(path, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, ver, self.target_wins, self.slots, self.blob_off = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or ver != VERSION:
+            raise ValueError(f"{path}: not a solver table")
+
+    def close(self):
+        self._mm.close()
+        self._f.close()
+
+    def _slot(self, ha, hb, wa, wb):
+        # 終局狀態沒有 slot；wins 超出範圍的話 index 會算到別的狀態甚至 mmap 外面
+        if terminal_value(ha, hb, wa, wb, self.target_wins) is not None:
+            raise ValueError(f"terminal state {(ha, hb, wa, wb)} has no strategy")
+        if not (0 <= ha <= rules.FULL_HAND and 0 <= hb <= rules.FULL_HAND and wa >= 0 and wb >= 0):
+            raise ValueError(f"state {(ha, hb, wa, wb)} out of range")
+        slot = SLOT.unpack_from(self._mm, HEADER.size + _slot_index(ha, hb, wa, wb, self.target_wins) * SLOT.size)
+        # solve 只算從整副牌走得到的狀態；沒算過的 slot 全是 0（解過的雙方至少各有一個出法）
+        if not slot[3] or not slot[4]:
+            raise ValueError(f"state {(ha, hb, wa, wb)} is not reachable from a full deal and was not solved")
+        return slot
+
+    def value(self, hand_a, hand_b, wins_a=0, wins_b=0) -> float:
+        """A 在均衡下的勝率。"""
+        end = terminal_value(hand_a, hand_b, wins_a, wins_b, self.target_wins)
+        if end is not None:
+            return end
+        return self._slot(hand_a, hand_b, wins_a, wins_b)[0]
+
+    def strategy(self, side, hand_a, hand_b, wins_a=0, wins_b=0):
+        """side 的均衡混合策略：[(play bitmask, prob), ...]"""
+        _, a_off, b_off, a_n, b_n = self._slot(hand_a, hand_b, wins_a, wins_b)
+        off, cnt = (a_off, a_n) if side == "A" else (b_off, b_n)
+        base = self.blob_off + off * ENTRY.size
+        return [ENTRY.unpack_from(self._mm, base + k * ENTRY.size) for k in range(cnt)]
+
+    def policy(self, side):
+        """回傳 rules 的策略介面 strategy(my_hand, op_hand, my_wins, op_wins, rng)。"""
+        def _pick(my_hand, op_hand, my_wins, op_wins, rng):
+            if side == "A":
+                strat = self.strategy("A", my_hand, op_hand, my_wins, op_wins)
+            else:
+                strat = self.strategy("B", op_hand, my_hand, op_wins, my_wins)
+            r = rng.random()
+            for play, prob in strat:
+                r -= prob
+                if r <= 0:
+                    return play
+            return strat[-1][0]
+        return _pick
+
+_tables = {}
+
+def get_table(target_wins=3) -> SolverTable:
+    """程序啟動時呼叫；表不存在就先算一次存檔。"""
+    tbl = _tables.get(target_wins)
+    if tbl is None:
+        path = table_path(target_wins)
+        if not path.exists():
+            write_table(solve(target_wins), target_wins, path)
+        tbl = _tables[target_wins] = SolverTable(path)
+    return tbl
+
+def main():
+    ap = argparse.ArgumentParser(description="Exact solver for the card game")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("build", help="solve all states and write the lookup table")
+    p.add_argument("--target-wins", type=int, default=3)
+    p.add_argument("-o", "--out", default=None)
+    p = sub.add_parser("show", help="value and equilibrium opening")
+    p.add_argument("--target-wins", type=int, default=3)
+    p = sub.add_parser("vs", help="solver bot (as A) against a rules strategy")
+    p.add_argument("opponent", choices=sorted(rules.STRATEGIES))
+    p.add_argument("-n", "--games", type=int, default=100000)
+    p.add_argument("--target-wins", type=int, default=3)
+    p.add_argument("--seed", type=int, default=None)
+    args = ap.parse_args()
+
+    if args.cmd == "build":
+        out = Path(args.out) if args.out else table_path(args.target_wins)
+        t0 = time.time()
+        memo = solve(args.target_wins, progress=True)
+        write_table(memo, args.target_wins, out)
+        print(f"{len(memo)} states solved in {time.time() - t0:.1f}s -> {out} ({out.stat().st_size} bytes)")
+    elif args.cmd == "show":
+        tbl = get_table(args.target_wins)
+        F = rules.FULL_HAND
+        print(f"target_wins={tbl.target_wins}  P(A wins) = {tbl.value(F, F):.4f}")
+        for side in ("A", "B"):
+            opening = ", ".join(f"{rules.mask_to_cards(p)}:{q:.3f}" for p, q in tbl.strategy(side, F, F))
+            print(f"  {side} opening: {opening}")
+    elif args.cmd == "vs":
+        tbl = get_table(args.target_wins)
+        res = rules.simulate(args.games, tbl.policy("A"), rules.STRATEGIES[args.opponent],
+                             args.target_wins, args.seed)
+        print(f"solver(A) vs {args.opponent}(B): A wins {res['a_wins'] / res['games']:.4f} "
+              f"(equilibrium value {tbl.value(rules.FULL_HAND, rules.FULL_HAND):.4f})")
+
+if __name__ == "__main__":
+    main()
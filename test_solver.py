@@ -0,0 +1,65 @@
+import itertools
+
+import pytest
+
+import rules
+import solver
+
+TARGET = 2
+
+@pytest.fixture(scope="module")
+def solved(tmp_path_factory):
+    memo = solver.solve(TARGET)
+    path = tmp_path_factory.mktemp("solver") / "table.bin"
+    solver.write_table(memo, TARGET, path)
+    tbl = solver.SolverTable(path)
+    yield memo, tbl
+    tbl.close()
+
+def _solve_value(memo, ha, hb, wa, wb):
+    end = solver.terminal_value(ha, hb, wa, wb, TARGET)
+    return end if end is not None else memo[(ha, hb, wa, wb)][0]
+
+def test_terminal_states_match_solve(solved):
+    memo, tbl = solved
+    hands = (0, 0b1, 0b1000000, rules.FULL_HAND)
+    for ha, hb in itertools.product(hands, repeat=2):
+        for wa, wb in itertools.product(range(TARGET + 1), repeat=2):
+            end = solver.terminal_value(ha, hb, wa, wb, TARGET)
+            if end is None:
+                continue
+            assert tbl.value(ha, hb, wa, wb) == end
+    # B 用最後的牌拿下決勝局：A 還有牌、B 沒牌，但 B 已經贏了
+    assert tbl.value(0b1, 0, 0, TARGET) == 0.0
+
+def test_table_matches_solve(solved):
+    memo, tbl = solved
+    for (ha, hb, wa, wb), (v, _, _) in itertools.islice(memo.items(), 0, None, 97):
+        assert tbl.value(ha, hb, wa, wb) == pytest.approx(v, abs=1e-6)
+        # 往下一步（含終局）也要一致；沒解過的狀態（走不到）跳過
+        for na, nb, da, db in ((ha & ~1, hb, 1, 0), (ha, hb & ~1, 0, 1)):
+            state = (na, nb, wa + da, wb + db)
+            if solver.terminal_value(*state, TARGET) is None and state not in memo:
+                continue
+            assert tbl.value(*state) == pytest.approx(_solve_value(memo, *state), abs=1e-6)
+
+def test_strategy_rejects_terminal_states(solved):
+    _, tbl = solved
+    with pytest.raises(ValueError):
+        tbl.strategy("A", rules.FULL_HAND, rules.FULL_HAND, TARGET, 0)
+    with pytest.raises(ValueError):
+        tbl.strategy("B", rules.FULL_HAND, 0, 0, 0)
+    assert tbl.strategy("A", rules.FULL_HAND, rules.FULL_HAND, 0, 0)
+
+def test_unreachable_states_raise(solved):
+    memo, tbl = solved
+    # B 已經出掉六張、A 一張都沒出：不是終局，但從整副牌走不到
+    state = (rules.FULL_HAND, 0b1, 0, 0)
+    assert solver.terminal_value(*state, TARGET) is None and state not in memo
+    with pytest.raises(ValueError):
+        tbl.value(*state)
+    with pytest.raises(ValueError):
+        tbl.strategy("A", *state)
+    pick = tbl.policy("B")
+    with pytest.raises(ValueError):
+        pick(0b1, rules.FULL_HAND, 0, 0, None)
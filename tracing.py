@@ -0,0 +1,148 @@
+import os
+import sys
+import glob
+import atexit
+import time
+import json
+import secrets
+import argparse
+from pathlib import Path
+
+import eventlog
+
+"""
+對戰流程的 trace：一場對戰從 A 掃描對手開始就有一個 trace id，跟著 INVITE / TCP_INFO / HELLO 傳給 B，
+兩邊每個階段各記一個 span（名稱、開始時間、耗時、role、其他欄位），寫成 JSON lines。
+寫檔用 eventlog.EventLog（有上限的 queue + 背景執行緒），遊戲迴圈不會卡在 I/O 上。
+
+預設關閉；設環境變數 TT_TRACE 才會記：
+  TT_TRACE=1                    -> storage/traces/trace-<pid>.jsonl
+  TT_TRACE=path/to/file.jsonl   -> 指定的檔案（多個 process 可以寫同一個檔）
+
+span 名稱（A = client.py 主機端，B = recv.py / playerc.py）：
+  A: search / choose / invite / tcp_setup / match / round / round.input / round.wait_peer
+  B: invite_decision / tcp_connect / match / round.input / round.wait_result
+choose、invite_decision、round.input 是玩家自己想的時間，其他才是程式或網路的時間。
+
+  python tracing.py summary storage/traces/*.jsonl   # 每個階段的 p50/p90/p99
+  python tracing.py show <trace id> storage/traces/*.jsonl
+"""
+
+TRACE_DIR = Path(__file__).resolve().parent / "storage" / "traces"
+
+_SINK = {"log": None, "checked": False}
+
+def _sink():
+    if not _SINK["checked"]:
+        _SINK["checked"] = True
+        where = os.environ.get("TT_TRACE")
+        if where:
+            if where == "1":
+                TRACE_DIR.mkdir(parents=True, exist_ok=True)
+                where = str(TRACE_DIR / f"trace-{os.getpid()}.jsonl")
+            _SINK["log"] = eventlog.EventLog(where, "info", fmt="json")
+            atexit.register(_SINK["log"].close)
+    return _SINK["log"]
+
+def enabled() -> bool:
+    return _sink() is not None
+
+def new_id() -> str:
+    return secrets.token_hex(8)
+
+def record(name, trace_id, start, end, **attrs):
+    """已經量好的一段（start/end 是 time.time()）。"""
+    log = _sink()
+    if log is None or not trace_id:
+        return
+    log.log("info", "span", trace=trace_id, name=name, start=round(start, 6),
+            dur_ms=round((end - start) * 1e3, 3), **attrs)
+
+class span:
+    """
+    with tracing.span("invite", tid, role="A") as sp:
+        ...
+        sp.set(result="ACCEPT")
+    沒開 TT_TRACE 或沒有 trace id 時什麼都不記。
+    """
+    __slots__ = ("name", "trace_id", "attrs", "start")
+
+    def __init__(self, name, trace_id, **attrs):
+        self.name = name
+        self.trace_id = trace_id
+        self.attrs = attrs
+        self.start = 0.0
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        record(self.name, self.trace_id, self.start, time.time(), **self.attrs)
+        return False
+
+# ===== 分析 =====
+def load_spans(paths):
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue    # 寫到一半的最後一行
+                    if rec.get("ev") == "span":
+                        yield rec
+
+def percentile(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    return sorted_vals[min(int(len(sorted_vals) * q), len(sorted_vals) - 1)]
+
+def summarize(spans):
+    """-> {(role, name): 排好的 dur_ms list}"""
+    groups = {}
+    for s in spans:
+        groups.setdefault((s.get("role", "?"), s["name"]), []).append(s["dur_ms"])
+    for v in groups.values():
+        v.sort()
+    return groups
+
+def main():
+    ap = argparse.ArgumentParser(description="Match trace tools")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("summary", help="per-phase latency percentiles over all traced matches")
+    p.add_argument("paths", nargs="*", default=[str(TRACE_DIR / "*.jsonl")])
+    p = sub.add_parser("show", help="every span of one trace, in time order")
+    p.add_argument("trace")
+    p.add_argument("paths", nargs="*", default=[str(TRACE_DIR / "*.jsonl")])
+    args = ap.parse_args()
+
+    spans = list(load_spans(args.paths))
+    if args.cmd == "summary":
+        groups = summarize(spans)
+        traces = len({s["trace"] for s in spans})
+        print(f"{len(spans)} spans from {traces} traces")
+        print(f"{'role':<4} {'phase':<18} {'n':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for (role, name), v in sorted(groups.items()):
+            print(f"{role:<4} {name:<18} {len(v):>6} {percentile(v, 0.5):>9.1f} {percentile(v, 0.9):>9.1f} "
+                  f"{percentile(v, 0.99):>9.1f} {v[-1]:>9.1f}")
+    else:
+        mine = sorted((s for s in spans if s["trace"] == args.trace), key=lambda s: s["start"])
+        if not mine:
+            print(f"no spans for trace {args.trace}")
+            sys.exit(1)
+        t0 = mine[0]["start"]
+        skip = ("ts", "lvl", "ev", "trace", "name", "start", "dur_ms", "role")
+        for s in mine:
+            extra = " ".join(f"{k}={v}" for k, v in s.items() if k not in skip)
+            print(f"+{(s['start'] - t0) * 1e3:>9.1f}ms {s.get('role', '?'):<2} {s['name']:<18} "
+                  f"{s['dur_ms']:>9.1f}ms {extra}")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,16 @@
-import random
+import os
+import sys
 import json
+import queue
+import select
+import socket
 import atexit
 import threading
 import time
+from collections import deque
+
+import rules
+import eventlog
 """
 There are some utils and original game design
 """
@@ -20,6 +28,202 @@ def recv_json_line(conn, buf=b""):
             raise ConnectionError("Peer closed")
         buf += chunk
 
+# ===== 對戰連線：PING/PONG 量 RTT 與時鐘差 =====
+# 兩邊各有一條讀 socket 的執行緒：PING 馬上回 PONG（就算自己正卡在 input() 也不會拖到），
+# PONG 算一次 RTT，其他遊戲訊息放進 queue 給遊戲迴圈拿。PING 帶 t0，PONG 帶回 t0 與對方的收/送時間 t1、t2，
+# 收到時是 t3（NTP 的算法）：
+#   rtt    = (t3 - t0) - (t2 - t1)
+#   offset = ((t1 - t0) + (t2 - t3)) / 2     對方時鐘比我快多少
+# RTT 用 TCP 的 SRTT/RTTVAR 平滑（1/8、1/4）；offset 取最近幾次裡 RTT 最小那次的（排隊最少、最準）。
+# 舊版對手不認得 PING：A 看 HELLO、B 看 START 有沒有帶 "ping": true，有才開始送。
+PING_INTERVAL = 2.0
+STALL_AFTER = 3 * PING_INTERVAL     # 這麼久沒收到對方任何東西就算卡住
+OFFSET_WINDOW = 8
+
+class LinkStats:
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rtt_min = None
+        self.offset = 0.0
+        self.samples = 0
+        self.stalls = 0
+        self.active = False         # 有在送 PING 才談得上「卡住」（不然對方只是在想）
+        self.last_heard = time.time()
+        self.window = deque(maxlen=OFFSET_WINDOW)   # (rtt, offset)
+
+    def add(self, t0, t1, t2, t3):
+        rtt = max((t3 - t0) - (t2 - t1), 0.0)
+        off = ((t1 - t0) + (t2 - t3)) / 2
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rtt_min = rtt if self.rtt_min is None else min(self.rtt_min, rtt)
+        self.window.append((rtt, off))
+        self.offset = min(self.window)[1]
+        self.samples += 1
+
+    def stalled(self) -> bool:
+        return self.active and time.time() - self.last_heard > STALL_AFTER
+
+    def summary(self) -> dict:
+        """給 UI 與 lobby 的摘要（毫秒）。"""
+        if not self.samples:
+            return {"samples": 0, "stalled": self.stalled(), "stalls": self.stalls}
+        return {
+            "rtt_ms": round(self.srtt * 1e3, 2),
+            "rttvar_ms": round(self.rttvar * 1e3, 2),
+            "rtt_min_ms": round(self.rtt_min * 1e3, 2),
+            "offset_ms": round(self.offset * 1e3, 2),
+            "samples": self.samples,
+            "stalled": self.stalled(),
+            "stalls": self.stalls,
+        }
+
+class PeerChannel:
+    """
+    包住對戰用的 TCP 連線。send 可以從多條執行緒呼叫；recv 只給遊戲迴圈用，
+    timeout 到了丟 socket.timeout，對方斷線丟 ConnectionError（之後每次都一樣）。
+    start() 之前只能 send（讀取執行緒還沒開）。
+    """
+    def __init__(self, conn, buf=b"", ping_interval=PING_INTERVAL):
+        self.conn = conn
+        self.buf = buf
+        self.ping_interval = ping_interval
+        self.link = LinkStats()
+        self.inbox = queue.Queue()
+        self.notices = queue.Queue()    # TURN_WARNING / FORFEIT：出牌輸入到一半也要看得到
+        self.send_lock = threading.Lock()
+        self.stop_flag = {"stop": False}
+        self._pinging = False
+
+    def start(self):
+        threading.Thread(target=self._reader, daemon=True).start()
+
+    def enable_ping(self):
+        if self._pinging:
+            return
+        self._pinging = True
+        self.link.active = True
+        self.link.last_heard = time.time()
+        threading.Thread(target=self._pinger, daemon=True).start()
+
+    def send(self, obj: dict):
+        with self.send_lock:
+            send_json_line(self.conn, obj)
+
+    def recv(self, timeout=None) -> dict:
+        try:
+            msg = self.inbox.get(timeout=timeout)
+        except queue.Empty:
+            raise socket.timeout("peer channel recv timed out")
+        if msg is None:
+            self.inbox.put(None)    # 之後再 recv 也一樣是斷線
+            raise ConnectionError("Peer closed")
+        return msg
+
+    def close(self):
+        # shutdown 才會讓卡在 recv 的讀取執行緒醒來；socket 本身還是由呼叫端 close
+        self.stop_flag["stop"] = True
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _reader(self):
+        buf = self.buf
+        try:
+            while True:
+                msg, buf = recv_json_line(self.conn, buf)
+                now = time.time()
+                if self.link.stalled():
+                    self.link.stalls += 1
+                self.link.last_heard = now
+                t = msg.get("type")
+                if t == "PING":
+                    self.send({"type": "PONG", "t0": msg.get("t0"), "t1": now, "t2": time.time()})
+                elif t == "TURN_WARNING":
+                    self.notices.put(msg)
+                elif t == "PONG":
+                    try:
+                        self.link.add(float(msg["t0"]), float(msg["t1"]), float(msg["t2"]), now)
+                    except (KeyError, TypeError, ValueError):
+                        pass
+                else:
+                    if t == "FORFEIT":
+                        self.notices.put(msg)
+                    self.inbox.put(msg)
+        except (OSError, ValueError, ConnectionError):
+            pass
+        finally:
+            self.stop_flag["stop"] = True
+            self.inbox.put(None)
+
+    def _pinger(self):
+        while not self.stop_flag["stop"]:
+            try:
+                self.send({"type": "PING", "t0": time.time()})
+            except OSError:
+                break
+            time.sleep(self.ping_interval)
+
+# ===== 回合時限 =====
+# 每回合兩邊同時出牌，時鐘由 A（主機）掌握：回合開始算起 TURN_SECS 秒，剩 TURN_WARNING_AT 秒時送 TURN_WARNING，
+# 超過 TURN_SECS + TURN_GRACE 還沒出牌的一方判負（FORFEIT），這場直接結束、不問 rematch。
+# B 用 MOVE 帶來的 "turn" 在本機倒數，只是備援；以 A 的 FORFEIT 為準。
+TURN_SECS = float(os.environ.get("TT_TURN_SECS", "60"))
+TURN_WARNING_AT = 10.0
+TURN_GRACE = 2.0        # 網路延遲、對方剛好在最後一刻送出
+REMATCH_SECS = 5.0
+INPUT_POLL = 0.25
+
+class TurnTimeout(Exception):
+    pass
+
+class TurnClock:
+    def __init__(self, secs=TURN_SECS, warn_at=TURN_WARNING_AT):
+        self.secs = secs
+        self.deadline = time.time() + secs
+        self.warn_at = warn_at
+        self.warned = False
+
+    def left(self) -> float:
+        return self.deadline - time.time()
+
+    def due_warning(self) -> bool:
+        """到了警告時間回 True（只有一次）。"""
+        if not self.warned and self.left() <= self.warn_at:
+            self.warned = True
+            return True
+        return False
+
+def timed_input(prompt: str, deadline=None, poll=None) -> str:
+    """
+    有時限的 input()：用 select 等 stdin，每 INPUT_POLL 秒呼叫一次 poll()（可以印警告，或丟 TurnTimeout 中止），
+    到 deadline 丟 TurnTimeout。deadline 是 None 就是原本的 input()。
+    """
+    if deadline is None:
+        return input(prompt)
+    print(prompt, end="", flush=True)
+    while True:
+        left = deadline - time.time()
+        if left <= 0:
+            print()
+            raise TurnTimeout()
+        if poll:
+            poll()
+        try:
+            ready, _, _ = select.select([sys.stdin], [], [], min(left, INPUT_POLL))
+        except (OSError, ValueError):
+            return input()      # stdin 不能 select（例如 Windows 的 console），只好照舊等
+        if ready:
+            line = sys.stdin.readline()
+            if not line:
+                raise EOFError
+            return line.rstrip("\n")
+
 class GameUI:
     @staticmethod
     def show_game_start(target_wins: int):
@@ -39,17 +243,17 @@ class GameUI:
         print(f"{op_name}'s cards:")
         print("[ " + " ".join(map(str, cards)) + " ]")
     @staticmethod
-    def get_player_move():
+    def get_player_move(deadline=None, poll=None):
         while True:
             try:
-                choice = input("你要出幾張牌？(1 or 2): ").strip()
+                choice = timed_input("你要出幾張牌？(1 or 2): ", deadline, poll).strip()
                 if choice not in ["1","2"]:
                     print("請輸入 1 或 2")
                     continue
                 pick = []
                 k = int(choice)
                 while len(pick) < k:
-                    c = int(input(f"選第 {len(pick)+1} 張 (1..7): "))
+                    c = int(timed_input(f"選第 {len(pick)+1} 張 (1..7): ", deadline, poll))
                     if c < 1 or c > 7:
                         print("請輸入 1..7")
                         continue
@@ -61,6 +265,13 @@ class GameUI:
             except ValueError:
                 print("請輸入數字")
 
+    @staticmethod
+    def ask_rematch(deadline=None) -> bool:
+        try:
+            return timed_input("Rematch? (y/n): ", deadline).strip().lower() == "y"
+        except TurnTimeout:
+            return False
+
     @staticmethod
     def show_round_result(my_play, op_play, winner, my_wins, op_wins):
         print(f"回合結果：你出 {my_play}，對手出 {op_play}；勝者 = {winner}")
@@ -75,26 +286,86 @@ class GameUI:
             print(f"最終比分：對手 {a_wins} : {b_wins} 你")
         print(f"勝者：{winner}")
 
+    @staticmethod
+    def show_link(link: dict):
+        if link.get("stalled"):
+            print("（對手好一陣子沒有回應，連線可能卡住了）")
+        elif link.get("samples"):
+            print(f"連線：RTT {link['rtt_ms']:.1f} ms（±{link['rttvar_ms']:.1f}），"
+                  f"對方時鐘 {link['offset_ms']:+.1f} ms")
+
+    @staticmethod
+    def show_turn_warning(remaining: float, mine=True):
+        if mine:
+            print(f"\n[!] 剩 {remaining:.0f} 秒，時間到沒出牌就判負")
+        else:
+            print(f"[!] 等對手出牌，對手剩 {remaining:.0f} 秒")
+
+    @staticmethod
+    def show_forfeit(loser_is_me: bool, reason: str):
+        why = {"timeout": "超時", "invalid_move": "出牌不合法"}.get(reason, reason)
+        if loser_is_me:
+            print(f"=== 你{why}判負 ===")
+        else:
+            print(f"=== 對手{why}判負，你獲勝 ===")
+
     def print_info(self, msg: str):
         print(f"[INFO] {msg}")
 
+def match_summary(plays, rematch=False) -> dict:
+    """自己這場的出牌摘要（plays：每回合出的牌），跟勝負的 status_report 一起送給 lobby，player_stats 用。"""
+    return {
+        "first": rules.cards_to_mask(plays[0]) if plays else 0,
+        "rounds": len(plays),
+        "card_sum": sum(sum(p) for p in plays),
+        "rematch": bool(rematch),
+    }
+
+# 牌號 -> bit；不在 1..7 的牌查不到（當作沒有這張）
+_CARD_BIT = {c: 1 << (c - 1) for c in range(1, rules.NUM_CARDS + 1)}
+
+def _card_bit(card):
+    # 不合法的牌（含 list 之類 unhashable 的輸入）一律當 0，跟舊版一樣走 "error"
+    try:
+        return _CARD_BIT.get(card, 0)
+    except TypeError:
+        return 0
+
 class pls:
+    """手牌用 7 bit bitmask 存。
+    cards 回傳唯讀的 tuple（每次從 mask 查表），要改手牌請用 use_cards 或整個指定 cards = [...]，
+    不能再 .cards.remove() / .append()。"""
+    __slots__ = ("winRound", "mask")
+
     def __init__(self):
         self.winRound = 0
-        self.cards = [i for i in range(1,8)]
+        self.mask = rules.FULL_HAND
+    @property
+    def cards(self):
+        return rules.MASK_CARDS[self.mask]
+    @cards.setter
+    def cards(self, cards):
+        self.mask = rules.cards_to_mask(cards)
     def show_cards(self):
         print("This is your cards!!")
         print("[ " + " ".join(map(str, self.cards)) + " ]")      
     def use_cards(self, cards_to_use):
+        play = 0
         for card in cards_to_use:
-            if card not in self.cards:
+            bit = _card_bit(card)
+            if not bit & self.mask or bit & play:
                 print(f"Card {card} is not fucking available!")
                 return "error"
-        for card in cards_to_use:
-            self.cards.remove(card)
-        return sum(cards_to_use)
+            play |= bit
+        self.mask &= ~play
+        return rules.MASK_SUM[play]
+    def has_card(self, card):
+        return bool(_card_bit(card) & self.mask)
+    def plays(self):
+        """目前所有合法的 1 張 / 2 張出法（bitmask tuple，查表）。"""
+        return rules.LEGAL_PLAYS[self.mask]
     def has_cards(self):
-        return len(self.cards) > 0
+        return self.mask != 0
     def show_opponent_cards(self):
         print("Opponent's cards:")
         print("[ " + " ".join(map(str, self.cards)) + " ]")
@@ -196,13 +467,11 @@ class gameplay:
         print(f"PlayerA: {str_a} = {score_a}")
         print(f"PlayerB: {str_b} = {score_b}")
 
-        if score_a == score_b:
-            score_a += random.choice([0.1, -0.1])
-
-        if score_a < score_b:
+        winner, _ = rules.resolve_round(score_a, score_b)
+        if winner == "B":
             print("\nPlayerB wins this round!")
             self.roundWin(2)
-        elif score_a > score_b:
+        else:
             print("\nPlayerA wins this round!")
             self.roundWin(1)
             
@@ -216,7 +485,65 @@ def main():
     for _ in range(5):
         gg.operates()
 
-def start_status_reporter(lobby_sock, username, stats_provider):
+def _drain_lobby(lobby_sock, hb):
+    """
+    非阻塞地把 lobby 送來的東西讀掉（登入後主執行緒不會再讀 lobby socket）。
+    HEARTBEAT 就更新心跳間隔，其他（例如舊版 lobby 回的 ERROR_UNKNOWN_ACTION）直接丟掉。
+    lobby 的回覆沒有分隔符號，用 raw_decode 一個一個拆。
+    """
+    data = b""
+    alive = True
+    while True:
+        try:
+            chunk = lobby_sock.recv(4096, socket.MSG_DONTWAIT)
+        except (BlockingIOError, InterruptedError):
+            break
+        if not chunk:
+            alive = False
+            break
+        data += chunk
+    text = data.decode("utf-8", "replace")
+    dec = json.JSONDecoder()
+    i = 0
+    while True:
+        i = text.find("{", i)
+        if i < 0:
+            break
+        try:
+            obj, i = dec.raw_decode(text, i)
+        except ValueError:
+            i += 1
+            continue
+        if isinstance(obj, dict) and obj.get("type") == "HEARTBEAT":
+            hb["interval"] = float(obj.get("interval", hb["interval"]))
+    return alive
+
+def _resume_lobby(lobby_sock, peer, username, token, tries=8):
+    """
+    lobby 重啟（連線斷掉）時：重新連上、用登入時拿到的 resume token 接回原本的 session。
+    成功後把新連線 dup2 到舊 socket 的 fd 上，主執行緒手上的 lobby_sock 物件不用換。
+    """
+    for k in range(tries):
+        try:
+            new = socket.create_connection(peer, timeout=5.0)
+        except OSError:
+            time.sleep(min(0.2 * 2 ** k, 5.0))
+            continue
+        try:
+            new.sendall(json.dumps({"action": "resume", "username": username, "token": token}).encode("utf-8"))
+            resp = new.recv(1024)
+            new.settimeout(None)    # fd 要是 blocking 的，dup2 之後舊 socket 才不會變成非阻塞
+            if resp.startswith(b"{") and json.loads(resp).get("type") == "RESUME_OK":
+                os.dup2(new.fileno(), lobby_sock.fileno())
+                return json.loads(resp)
+            return None
+        except (OSError, ValueError):
+            return None
+        finally:
+            new.close()
+    return None
+
+def start_status_reporter(lobby_sock, username, stats_provider, interval=5.0, resume_token=None):
     """
     stats_provider(): -> dict like
       {
@@ -224,24 +551,59 @@ def start_status_reporter(lobby_sock, username, stats_provider):
         "losses_delta": int,
         "in_game": bool,
       }
+    狀態有變（或 delta 不是 0）才送 status_report（lobby 會寫 DB），
+    其他時候只送很小的 ping，lobby 只在記憶體裡更新存活時間。
+    心跳間隔由 lobby 決定：ping 帶上目前用的間隔，不一樣 lobby 才回 HEARTBEAT。
+    有 resume_token 的話，lobby 斷線（例如重啟）會自動重連並接回 session。
     """
     stop_flag = {"stop": False}
+    hb = {"interval": interval}
+    try:
+        peer = lobby_sock.getpeername()
+    except OSError:
+        peer = None
+
+    def _reconnect():
+        if not (resume_token and peer) or stop_flag["stop"]:
+            return False
+        resp = _resume_lobby(lobby_sock, peer, username, resume_token)
+        if resp:
+            hb["interval"] = float(resp.get("heartbeat", hb["interval"]))
+            eventlog.info("lobby_resumed", user=username, heartbeat=hb["interval"])
+            return True
+        eventlog.warn("lobby_lost", user=username, peer=peer)
+        print("[!] lost the lobby connection and could not resume the session")
+        stop_flag["stop"] = True
+        return False
 
     def _loop():
+        last = None
         while not stop_flag["stop"]:
             try:
                 status = stats_provider() or {}
-                payload = {
-                    "action": "status_report",
-                    "username": username,
-                    "status": status,
-                }
+                changed = status != last or any(v for k, v in status.items() if k.endswith("_delta"))
+                if changed:
+                    payload = {
+                        "action": "status_report",
+                        "username": username,
+                        "status": status,
+                        # 第一次送 0，lobby 馬上回目前的間隔
+                        "hb": hb["interval"] if last is not None else 0,
+                    }
+                    last = dict(status)
+                else:
+                    payload = {"action": "ping", "username": username, "hb": hb["interval"]}
                 lobby_sock.sendall(json.dumps(payload).encode("utf-8"))
+                # 上一輪的 HEARTBEAT 回覆這時候早就到了
+                if not _drain_lobby(lobby_sock, hb):
+                    _reconnect()
+            except (BrokenPipeError, ConnectionResetError):
+                _reconnect()
             except Exception as e:
                 # 不影響主要遊戲流程
-                pass
+                eventlog.debug("reporter_error", user=username, err=repr(e))
             finally:
-                time.sleep(5.0)
+                time.sleep(hb["interval"])
 
     t = threading.Thread(target=_loop, daemon=True)
     t.start()